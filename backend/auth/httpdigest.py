@@ -13,8 +13,7 @@ from hashlib import md5
 from typing import Annotated
 from ..logger import custom_logger
 
-config = get_config()
-logger = custom_logger(__name__, debug=config.DEBUG)
+logger = custom_logger(__name__)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -0,0 +1,146 @@
+"""
+Load test of /api/rss queries served by a sync route on the threadpool
+and by an async route on the aiosqlite engine, with many concurrent clients.
+The response cache is left out, every request runs the query.
+
+    python -m backend.benchmarks.bench_api --rows 20000 --requests 1000 --concurrency 10 100 200
+"""
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Annotated
+
+import httpx
+from fastapi import FastAPI, Depends
+from sqlmodel import SQLModel, Session, insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..database import create_db_engine, create_async_db_engine, migrate_db, analyze_db
+from ..models import RSSItem
+from ..query import query_rss_page, async_query_rss_page
+from .bench_sqlite import example_rows, percentile, SOURCES
+
+
+def create_app(url: str) -> FastAPI:
+    """the query of /api/rss behind a sync and an async route"""
+    engine = create_db_engine(url)
+    async_engine = create_async_db_engine(url)
+
+    def get_session():
+        with Session(engine) as session:
+            yield session
+
+    async def get_async_session():
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+
+    app = FastAPI()
+
+    def time_range():
+        return datetime.now() - timedelta(days=7), datetime.now()
+
+    @app.get("/sync")
+    def sync_route(session: Annotated[Session, Depends(get_session)]):
+        items, _ = query_rss_page(session, SOURCES, *time_range(), max_number=100)
+        return items
+
+    @app.get("/async")
+    async def async_route(session: Annotated[AsyncSession, Depends(get_async_session)]):
+        items, _ = await async_query_rss_page(session, SOURCES, *time_range(), max_number=100)
+        return items
+
+    return app
+
+
+def serve(url: str, port: int):
+    import uvicorn
+    # idle keep-alive connections must outlive the slowest request, or clients reuse closed ones
+    uvicorn.run(create_app(url), host="127.0.0.1", port=port, log_level="warning", timeout_keep_alive=120)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def load(base_url: str, path: str, n_requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(n_requests):
+        queue.put_nowait(None)
+
+    async def client_loop(client: httpx.AsyncClient):
+        nonlocal errors
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            resp = await client.get(path)
+            latencies.append(time.perf_counter() - start)
+            errors += resp.status_code != 200
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        # warm up connections and caches
+        await asyncio.gather(*(client.get(path) for _ in range(concurrency)))
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "rps": n_requests / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000, help="rows in the table")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per run")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 200], help="concurrent clients")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        url = f"sqlite:///{Path(tmp_dir) / 'bench.db'}"
+        engine = create_db_engine(url)
+        SQLModel.metadata.create_all(engine)
+        migrate_db(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(RSSItem), example_rows(0, args.rows))
+        analyze_db(engine)
+        engine.dispose()
+
+        port = free_port()
+        server = multiprocessing.Process(target=serve, args=(url, port), daemon=True)
+        server.start()
+        base_url = f"http://127.0.0.1:{port}"
+        for _ in range(100):
+            try:
+                httpx.get(f"{base_url}/docs")
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+
+        try:
+            for concurrency in args.concurrency:
+                for path in ["/sync", "/async"]:
+                    result = asyncio.run(load(base_url, path, args.requests, concurrency))
+                    print(
+                        f"{path:7s} concurrency={concurrency:4d} rps={result['rps']:7.1f} "
+                        f"p50={result['p50_ms']:8.2f}ms p99={result['p99_ms']:8.2f}ms errors={result['errors']}"
+                    )
+        finally:
+            server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+End-to-end ingest -> rate -> query benchmark, fully offline.
+Feeds of the rss.yml journals are generated (or recorded with --record and replayed with --fixtures)
+and served locally, papers are rated by a mock /chat/completions with configurable latency and failures.
+
+    python -m backend.benchmarks.bench_e2e --sizes 1000 10000 --save bench.json
+    python -m backend.benchmarks.bench_e2e --sizes 1000 10000 --compare bench.json
+
+With --compare, the run fails if a throughput or a median latency regresses more than --tolerance.
+p99 latencies are reported but not checked, a single stall in a few dozen queries moves them.
+"""
+import argparse
+import json
+import logging
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlmodel import SQLModel, Session, select, func
+
+from ..config import get_config, AppSettings
+from ..database import create_db_engine, migrate_db, analyze_db
+from ..models import RSS_Journal, RSSItem
+from ..query import query_rss_page
+from ..rater.queue import drain_rating_queue
+from ..rss import retrieve_all
+from .fixtures import FixtureServer, MockLLMServer, example_journal_feed, record_feeds
+from .bench_sqlite import percentile
+
+QUERY_REPEAT = 50
+
+
+def quiet_logs():
+    """per paper logs of the backend would dominate the timings"""
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("backend"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def bench_config(config: AppSettings, llm_url: str, concurrency: int, batch_size: int) -> AppSettings:
+    llm_api = config.LLM_API.model_copy(update={
+        "base_url": llm_url,
+        "api_key": "mock",
+        "max_concurrency": concurrency,
+        "requests_per_minute": None,
+        "tokens_per_minute": None,
+        "batch_size": batch_size,
+    })
+    rating_queue = config.RATING_QUEUE.model_copy(update={"batch_size": 1000})
+    return config.model_copy(update={"LLM_API": llm_api, "RATING_QUEUE": rating_queue})
+
+
+def latencies_ms(fn, repeat: int = QUERY_REPEAT) -> dict:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {"p50_ms": statistics.median(latencies), "p99_ms": percentile(latencies, 0.99)}
+
+
+def bench_queries(session: Session, sources: list[str]) -> dict:
+    """the queries of the dashboard: first page, following pages, other orders and search"""
+    since, until = datetime.now() - timedelta(days=365), datetime.now() + timedelta(days=1)
+
+    def walk_pages(pages: int = 5, **kwargs):
+        cursor = None
+        for _ in range(pages):
+            _, cursor = query_rss_page(session, sources, since, until, cursor=cursor, **kwargs)
+            if cursor is None:
+                break
+
+    return {
+        "query_first_page": latencies_ms(lambda: query_rss_page(session, sources, since, until)),
+        "query_5_pages": latencies_ms(lambda: walk_pages()),
+        "query_by_published": latencies_ms(
+            lambda: query_rss_page(session, sources, since, until, order_by="published")
+        ),
+        "query_search": latencies_ms(
+            lambda: query_rss_page(session, sources, since, until, q="chorus wave", order_by="rank")
+        ),
+    }
+
+
+def run_scenario(journals: dict[str, RSS_Journal], feeds: dict[str, bytes], config: AppSettings,
+                 llm: MockLLMServer) -> dict:
+    """ingest the feeds into a fresh database, rate everything, then query"""
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp_dir, FixtureServer(feeds) as fixtures:
+        engine = create_db_engine(f"sqlite:///{Path(tmp_dir) / 'bench.db'}", config.SQLITE)
+        SQLModel.metadata.create_all(engine)
+        migrate_db(engine)
+        local_journals = {
+            key: journal.model_copy(update={"feed": fixtures.url(f"{key}.xml")})
+            for key, journal in journals.items()
+        }
+
+        with Session(engine) as session:
+            start = time.perf_counter()
+            results = retrieve_all(local_journals, session=session, fetch_config=config.RSS_FETCH, use_cache=False)
+            ingest_s = time.perf_counter() - start
+            errors = {key: r["error"] for key, r in results.items() if "error" in r}
+            if errors:
+                raise RuntimeError(f"Ingest failed: {errors}")
+            n_items = session.exec(select(func.count()).select_from(RSSItem)).one()
+            result.update({"items": n_items, "ingest_s": ingest_s, "ingest_items_per_s": n_items / ingest_s})
+
+            requests_before, failures_before = llm.requests, llm.failures
+            start = time.perf_counter()
+            rated = drain_rating_queue(session, config)
+            rate_s = time.perf_counter() - start
+            result.update({
+                "rate_s": rate_s,
+                "rate_papers_per_s": rated["rated"] / rate_s if rate_s else 0,
+                "rate_failed": rated["failed"],
+                "llm_requests": llm.requests - requests_before,
+                "llm_injected_failures": llm.failures - failures_before,
+            })
+
+            analyze_db(engine)
+            sources = [journal.source for journal in journals.values()]
+            result.update(bench_queries(session, sources))
+        engine.dispose()
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """regressions of throughputs (*_per_s) and median latencies (*_p50_ms) beyond the tolerance"""
+    regressions = []
+    for size, scenario in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(size)
+        if base is None:
+            continue
+        for key, value in scenario.items():
+            old = base.get(key)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            if key.endswith("_per_s") and value < old * (1 - tolerance):
+                regressions.append(f"{size}: {key} {old:.1f} -> {value:.1f}")
+            elif key.endswith("_p50_ms") and value > old * (1 + tolerance):
+                regressions.append(f"{size}: {key} {old:.2f} -> {value:.2f}")
+    return regressions
+
+
+def flatten(scenario: dict) -> dict:
+    flat = {}
+    for key, value in scenario.items():
+        if isinstance(value, dict):
+            flat.update({f"{key}_{sub}": sub_value for sub, sub_value in value.items()})
+        else:
+            flat[key] = value
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="items per scenario, e.g. 1000 10000 100000")
+    parser.add_argument("--fixtures", default=None, help="replay recorded *.xml feeds instead of generated ones")
+    parser.add_argument("--record", default=None, help="record the live feeds of rss.yml into this directory and exit")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds of the mock LLM per request")
+    parser.add_argument("--failure-rate", type=float, default=0.02, help="fraction of LLM requests answered 429")
+    parser.add_argument("--concurrency", type=int, default=32, help="LLM requests in flight")
+    parser.add_argument("--batch-size", type=int, default=1, help="papers per LLM request")
+    parser.add_argument("--save", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="baseline JSON file to check regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    quiet_logs()
+    config = get_config()
+    journals = config.RSS_JOURNALS
+
+    if args.record is not None:
+        failed = record_feeds(journals, args.record)
+        print(f"Recorded {len(journals) - len(failed)} feeds into {args.record}, failed: {failed}")
+        return
+
+    results = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "latency": args.latency,
+            "failure_rate": args.failure_rate,
+            "concurrency": args.concurrency,
+            "batch_size": args.batch_size,
+        },
+        "scenarios": {},
+    }
+
+    with MockLLMServer(latency=args.latency, failure_rate=args.failure_rate) as llm:
+        config = bench_config(config, llm.base_url, args.concurrency, args.batch_size)
+
+        scenarios = {}
+        if args.fixtures is not None:
+            feeds = {path.name: path.read_bytes() for path in Path(args.fixtures).glob("*.xml")}
+            recorded = {key: journal for key, journal in journals.items() if f"{key}.xml" in feeds}
+            scenarios["recorded"] = (recorded, feeds)
+        for size in args.sizes:
+            per_journal = max(1, size // len(journals))
+            feeds = {
+                f"{key}.xml": example_journal_feed(journal, per_journal, seed=seed)
+                for seed, (key, journal) in enumerate(journals.items())
+            }
+            scenarios[str(size)] = (journals, feeds)
+
+        for name, (scenario_journals, feeds) in scenarios.items():
+            scenario = flatten(run_scenario(scenario_journals, feeds, config, llm))
+            results["scenarios"][name] = scenario
+            print(
+                f"{name:>8s} items={scenario['items']:7d} "
+                f"ingest={scenario['ingest_items_per_s']:8.0f}/s "
+                f"rate={scenario['rate_papers_per_s']:7.0f}/s (failed {scenario['rate_failed']}, "
+                f"{scenario['llm_injected_failures']} injected 429) "
+                f"first page p50/p99={scenario['query_first_page_p50_ms']:.2f}/{scenario['query_first_page_p99_ms']:.2f}ms "
+                f"5 pages={scenario['query_5_pages_p50_ms']:.2f}/{scenario['query_5_pages_p99_ms']:.2f}ms "
+                f"by published={scenario['query_by_published_p50_ms']:.2f}/{scenario['query_by_published_p99_ms']:.2f}ms "
+                f"search={scenario['query_search_p50_ms']:.2f}/{scenario['query_search_p99_ms']:.2f}ms"
+            )
+
+    if args.save is not None:
+        Path(args.save).write_text(json.dumps(results, indent=2))
+
+    if args.compare is not None:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression beyond {args.tolerance:.0%} against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
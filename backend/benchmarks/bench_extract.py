@@ -0,0 +1,75 @@
+"""
+Per-entry cost of mapping feed entries to RSSItem fields: the compiled extractors of RSS_Journal
+against the previous per-entry reflection over the schema. feedparser itself is not timed.
+
+    python -m backend.benchmarks.bench_extract --feeds 4 --entries 500 --repeat 5
+"""
+import argparse
+import time
+from datetime import datetime
+
+import feedparser
+
+from ..models import RSS_Journal, RSSItem, DateFormat
+from .bench_parse import FIXTURE_JOURNAL, load_fixtures
+
+
+def reflection_extract(journal: RSS_Journal, feed) -> dict:
+    """the mapping as done before extractors were compiled, decided again for every entry"""
+    item_obj = {}
+    for field_name in RSSItem.model_fields.keys():
+        if field_name == "source":
+            item_obj[field_name] = journal.source
+        elif field_name == "uuid":
+            continue
+        elif hasattr(journal, field_name):
+            if isinstance(getattr(journal, field_name), str):
+                item_obj[field_name] = getattr(feed, getattr(journal, field_name))
+            elif isinstance(getattr(journal, field_name), DateFormat):
+                date_format: DateFormat = getattr(journal, field_name)
+                item_obj[field_name] = datetime.strptime(getattr(feed, date_format.datestr), date_format.format)
+    return item_obj
+
+
+def time_per_entry(fn, entries: list, repeat: int) -> float:
+    """best microseconds per entry over `repeat` runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for entry in entries:
+            fn(entry)
+        best = min(best, time.perf_counter() - start)
+    return best / len(entries) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default=None, help="directory of recorded *.xml feeds")
+    parser.add_argument("--feeds", type=int, default=4, help="generated feeds")
+    parser.add_argument("--entries", type=int, default=500, help="entries per generated feed")
+    parser.add_argument("--repeat", type=int, default=5, help="runs, the best one is reported")
+    args = parser.parse_args()
+
+    journal = RSS_Journal.model_validate(FIXTURE_JOURNAL)
+    entries = [
+        entry
+        for content in load_fixtures(args.fixtures, args.feeds, args.entries)
+        for entry in feedparser.parse(content).entries
+    ]
+    assert reflection_extract(journal, entries[0]) == journal.extract(entries[0])
+    print(f"{len(entries)} entries")
+
+    cases = {
+        "reflection": lambda entry: reflection_extract(journal, entry),
+        "compiled": journal.extract,
+        "reflection + validate": lambda entry: RSSItem.model_validate(reflection_extract(journal, entry)),
+        "compiled + validate": lambda entry: RSSItem.model_validate(journal.extract(entry)),
+    }
+    results = {name: time_per_entry(fn, entries, args.repeat) for name, fn in cases.items()}
+    for name, per_entry in results.items():
+        print(f"{name:22s} {per_entry:7.2f} us/entry")
+    print(f"extraction speedup {results['reflection'] / results['compiled']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Start-up cost of the backend: importing its modules in a fresh interpreter,
+whether that already read the config, and the first read and a reload of the config.
+
+    python -m backend.benchmarks.bench_import --repeat 5
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ["backend.config", "backend.rss", "backend.crons", "backend.main"]
+
+# run in a fresh interpreter, prints the import time and whether the config was read by it
+IMPORT_SCRIPT = """
+import time, importlib
+start = time.perf_counter()
+importlib.import_module({module!r})
+elapsed = time.perf_counter() - start
+import backend.config
+print(elapsed, backend.config._config is not None)
+"""
+
+
+def backend_self_time(module: str) -> float:
+    """seconds spent in the code of backend modules themselves, from -X importtime"""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+    ).stderr
+    total = 0
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, _, name = line.removeprefix("import time:").split("|")
+        if name.strip().startswith("backend") and self_us.strip().isdigit():
+            total += int(self_us)
+    return total / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per module")
+    args = parser.parse_args()
+
+    for module in MODULES:
+        times, loaded = [], False
+        for _ in range(args.repeat):
+            output = subprocess.run(
+                [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+                capture_output=True, text=True, check=True,
+            ).stdout.split()
+            times.append(float(output[-2]))
+            loaded = output[-1] == "True"
+        print(
+            f"import {module:16s} {statistics.median(times) * 1000:8.1f} ms, "
+            f"backend code {backend_self_time(module) * 1000:6.1f} ms, "
+            f"config read at import: {'yes' if loaded else 'no'}"
+        )
+
+    from ..config import get_config, reload_config
+    start = time.perf_counter()
+    get_config()
+    print(f"first get_config:         {(time.perf_counter() - start) * 1000:8.1f} ms")
+    start = time.perf_counter()
+    get_config()
+    print(f"get_config:               {(time.perf_counter() - start) * 1e6:8.1f} us")
+    start = time.perf_counter()
+    reload_config()
+    print(f"reload_config:            {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
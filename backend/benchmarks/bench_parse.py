@@ -0,0 +1,96 @@
+"""
+Feed parsing in the calling thread versus a process pool, as done by `retrieve_all`.
+Recorded feeds (*.xml) are read from --fixtures, otherwise arXiv-like feeds are generated.
+
+    python -m backend.benchmarks.bench_parse --feeds 16 --entries 500 --processes 1 2 4
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from ..models import RSS_Journal
+from ..rss import parse_feed_rows
+
+FIXTURE_JOURNAL = {
+    "feed": "https://example.org/arxiv.xml",
+    "source": "arXiv physics.space-ph",
+    "authors": "author",
+    "affiliation": None,
+    "published": {"datestr": "published", "format": "%a, %d %b %Y %H:%M:%S %z"},
+}
+
+
+def example_feed(n_entries: int, seed: int = 0) -> bytes:
+    """an arXiv-like RSS 2.0 listing"""
+    entries = []
+    for i in range(n_entries):
+        entries.append(f"""<item>
+<title>Observations of whistler-mode chorus waves {seed}-{i} in the outer radiation belt</title>
+<link>https://arxiv.org/abs/2501.{seed:02d}{i:04d}</link>
+<description>arXiv:2501.{seed:02d}{i:04d} Announce Type: new Abstract: {"Whistler-mode chorus scatters energetic electrons into the loss cone and accelerates them to relativistic energies. " * 8}</description>
+<dc:creator>A. Author, B. Author, C. Author</dc:creator>
+<pubDate>Mon, 06 Jan 2025 {i % 24:02d}:00:00 -0500</pubDate>
+</item>""")
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<channel>
+<title>physics.space-ph updates on arXiv.org</title>
+{"".join(entries)}
+</channel>
+</rss>
+""".encode()
+
+
+def load_fixtures(fixtures: str | None, n_feeds: int, n_entries: int) -> list[bytes]:
+    if fixtures is not None:
+        return [path.read_bytes() for path in sorted(Path(fixtures).glob("*.xml"))]
+    return [example_feed(n_entries, seed) for seed in range(n_feeds)]
+
+
+def parse_serial(journal: RSS_Journal, contents: list[bytes]) -> int:
+    return sum(len(parse_feed_rows(journal, content)) for content in contents)
+
+
+def parse_pool(journal: RSS_Journal, contents: list[bytes], processes: int) -> tuple[int, float]:
+    """rows parsed, and seconds spent starting the pool"""
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        # start the workers before timing, spawn imports the backend in each of them
+        list(pool.map(abs, range(processes)))
+        startup = time.perf_counter() - start
+        futures = [pool.submit(parse_feed_rows, journal, content) for content in contents]
+        return sum(len(future.result()) for future in futures), startup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default=None, help="directory of recorded *.xml feeds")
+    parser.add_argument("--feeds", type=int, default=16, help="generated feeds")
+    parser.add_argument("--entries", type=int, default=500, help="entries per generated feed")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4], help="pool sizes")
+    args = parser.parse_args()
+
+    journal = RSS_Journal.model_validate(FIXTURE_JOURNAL)
+    contents = load_fixtures(args.fixtures, args.feeds, args.entries)
+    print(f"{len(contents)} feeds, {sum(map(len, contents)) / 1e6:.1f} MB, {os.cpu_count()} CPUs")
+
+    start = time.perf_counter()
+    n_rows = parse_serial(journal, contents)
+    serial = time.perf_counter() - start
+    print(f"serial       {serial:7.2f}s  {n_rows / serial:8.0f} entries/s")
+
+    for processes in args.processes:
+        start = time.perf_counter()
+        n_rows, startup = parse_pool(journal, contents, processes)
+        elapsed = time.perf_counter() - start - startup
+        print(
+            f"processes={processes:<2d} {elapsed:7.2f}s  {n_rows / elapsed:8.0f} entries/s  "
+            f"speedup {serial / elapsed:4.2f}x  (+{startup:.2f}s pool startup)"
+        )
+
+
+if __name__ == "__main__":
+    main()
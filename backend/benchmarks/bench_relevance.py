@@ -0,0 +1,101 @@
+"""
+relevance_score of a whole table: the set-based UPDATE on the first run,
+after a weight change and incrementally, against a per-row loop over ORM objects.
+A weight change should take well under a second at 100k rows, the exit code is 1 if
+the median of --repeat changes takes longer than --target seconds.
+
+    python -m backend.benchmarks.bench_relevance --rows 100000
+"""
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from sqlmodel import SQLModel, Session, select, insert
+
+from ..config import get_config
+from ..database import create_db_engine, migrate_db
+from ..models import RSSItem, RelevanceScore
+from ..relevance import update_relevance, journal_source_weights
+from .bench_sqlite import example_rows, SOURCES
+
+# a weight change should rescore 100k rows in well under a second
+TARGET_SECONDS = 1.0
+
+
+def per_row_relevance(session: Session, config) -> float:
+    """the straightforward version: score every ORM object in Python and flush them one by one"""
+    relevance_config = config.RELEVANCE
+    weights = journal_source_weights(config)
+    reference = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    start = time.perf_counter()
+    rows = session.exec(select(RSSItem, RelevanceScore).join(RelevanceScore, RelevanceScore.item_uuid == RSSItem.uuid))
+    for paper, relevance in rows.all():
+        if paper.llm_score is None:
+            continue
+        text = f"{paper.title} {paper.summary}".lower()
+        hits = sum(keyword.lower() in text for keyword in relevance_config.keywords)
+        age_days = max((reference - paper.published).total_seconds(), 0) / 86400
+        recency = (1 - relevance_config.recency_weight) + relevance_config.recency_weight * 0.5 ** (
+            age_days / relevance_config.recency_half_life_days
+        )
+        relevance.relevance_score = (
+            relevance_config.llm_weight * paper.llm_score
+            + relevance_config.keyword_weight * min(hits, relevance_config.max_keyword_hits)
+        ) * weights.get(paper.source, 1.0) * recency
+        session.add(relevance)
+    session.commit()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="rows in rss_items")
+    parser.add_argument("--no-baseline", action="store_true", help="skip the per-row version")
+    parser.add_argument("--repeat", type=int, default=5, help="weight changes timed")
+    parser.add_argument("--target", type=float, default=TARGET_SECONDS, help="seconds allowed for a weight change")
+    args = parser.parse_args()
+
+    config = get_config()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_db_engine(f"sqlite:///{Path(tmp_dir) / 'bench.db'}", config.SQLITE)
+        SQLModel.metadata.create_all(engine)
+        migrate_db(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(RSSItem), example_rows(0, args.rows))
+
+        with Session(engine) as session:
+            result = update_relevance(session, config)
+            print(f"first run:      {result['seconds'] * 1000:8.1f} ms, {result['changed']} rows written")
+
+            result = update_relevance(session, config)
+            print(f"incremental:    {result['seconds'] * 1000:8.1f} ms, {result['changed']} rows written")
+
+            # each change moves every score, the median of the changes is compared to the target
+            weight_changes = []
+            for i in range(args.repeat):
+                weighted = config.model_copy(update={"RELEVANCE": config.RELEVANCE.model_copy(update={
+                    "journal_weights": {SOURCES[0]: 1.5}, "llm_weight": 1.2 + i / 10,
+                })})
+                result = update_relevance(session, weighted)
+                weight_changes.append(result["seconds"])
+            weight_change = statistics.median(weight_changes)
+            print(f"weight change:  {weight_change * 1000:8.1f} ms, {result['changed']} rows written, "
+                  f"{weight_change / args.target:.0%} of the {args.target * 1000:.0f} ms target"
+                  f"{'' if weight_change <= args.target else ', MISSED'}")
+
+            if not args.no_baseline:
+                elapsed = per_row_relevance(session, config)
+                print(f"per-row ORM:    {elapsed * 1000:8.1f} ms")
+        engine.dispose()
+
+    if weight_change > args.target:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
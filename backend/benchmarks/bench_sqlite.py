@@ -0,0 +1,143 @@
+"""
+Read latency of /api/rss queries during a concurrent bulk write,
+with the default SQLite settings and with the tuned engine.
+Large write transactions spill the page cache, which locks out readers in rollback journal mode.
+
+    python -m backend.benchmarks.bench_sqlite --rows 20000 --batches 4 --batch-size 5000
+"""
+import argparse
+import multiprocessing
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlmodel import SQLModel, Session, insert
+from sqlalchemy.exc import OperationalError
+
+from ..config import SQLite_Config
+from ..database import create_db_engine, migrate_db, analyze_db
+from ..models import RSSItem
+from ..query import query_rss_page
+from ..rss import store_items
+
+SOURCES = [f"Journal {i}" for i in range(10)]
+
+# sqlite defaults, with the 5 s timeout of the python driver
+DEFAULT_SQLITE = SQLite_Config(
+    journal_mode="DELETE", synchronous="FULL", busy_timeout=5000, mmap_size=0, cache_size=-2000,
+)
+
+
+def example_rows(start: int, n: int) -> list[dict]:
+    now = datetime.now()
+    return [
+        {
+            "uuid": f"{i:032x}",
+            "title": f"Paper {i} on chorus waves",
+            "link": f"https://example.org/paper/{i}",
+            "summary": "Whistler-mode chorus scatters energetic electrons. " * 10,
+            "source": SOURCES[i % len(SOURCES)],
+            "published": now - timedelta(minutes=i),
+            "llm_score": (i % 50) / 10,
+        }
+        for i in range(start, start + n)
+    ]
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def write(url: str, sqlite_config: SQLite_Config, rows: int, batches: int, batch_size: int, done):
+    """bulk write as the ingest cron does, exit code is the number of failed batches"""
+    engine = create_db_engine(url, sqlite_config)
+    failed = 0
+    try:
+        for batch in range(batches):
+            items = [RSSItem(**row) for row in example_rows(rows + batch * batch_size, batch_size)]
+            try:
+                with Session(engine) as session:
+                    store_items(items, session)
+            except OperationalError:
+                failed += 1
+    finally:
+        done.set()
+    raise SystemExit(failed)
+
+
+def run(sqlite_config: SQLite_Config, rows: int, batches: int, batch_size: int, readers: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_db_engine(f"sqlite:///{Path(tmp_dir) / 'bench.db'}", sqlite_config)
+        SQLModel.metadata.create_all(engine)
+        migrate_db(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(RSSItem), example_rows(0, rows))
+        analyze_db(engine)
+
+        reads = []
+        done = multiprocessing.Event()
+        # the writer runs in its own process, so that readers wait on SQLite locks, not on the GIL
+        writer = multiprocessing.Process(
+            target=write, args=(str(engine.url), sqlite_config, rows, batches, batch_size, done)
+        )
+
+        def read():
+            while not done.is_set():
+                start = time.perf_counter()
+                error = None
+                try:
+                    with Session(engine) as session:
+                        query_rss_page(
+                            session, SOURCES, datetime.now() - timedelta(days=7), datetime.now(),
+                            max_number=100, order_by="llm_score",
+                        )
+                except OperationalError as err:
+                    error = str(err.orig)
+                reads.append((time.perf_counter() - start, error))
+
+        threads = [threading.Thread(target=read) for _ in range(readers)]
+        start = time.perf_counter()
+        writer.start()
+        for thread in threads:
+            thread.start()
+        writer.join()
+        elapsed = time.perf_counter() - start
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+
+    latencies = [latency for latency, _ in reads]
+    return {
+        "reads": len(latencies),
+        "read_p50_ms": statistics.median(latencies) * 1000,
+        "read_p99_ms": percentile(latencies, 0.99) * 1000,
+        "read_max_ms": max(latencies) * 1000,
+        "write_rows_per_s": batches * batch_size / elapsed,
+        "errors": sum(1 for _, error in reads if error is not None) + writer.exitcode,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000, help="rows in the table before writing")
+    parser.add_argument("--batches", type=int, default=4, help="write transactions")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows per write transaction")
+    parser.add_argument("--readers", type=int, default=2, help="concurrent reader threads")
+    args = parser.parse_args()
+
+    for name, sqlite_config in [("default", DEFAULT_SQLITE), ("tuned", SQLite_Config())]:
+        result = run(sqlite_config, args.rows, args.batches, args.batch_size, args.readers)
+        print(
+            f"{name:8s} reads={result['reads']:6d} "
+            f"p50={result['read_p50_ms']:7.2f}ms p99={result['read_p99_ms']:7.2f}ms "
+            f"max={result['read_max_ms']:7.2f}ms "
+            f"write={result['write_rows_per_s']:8.0f} rows/s errors={result['errors']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
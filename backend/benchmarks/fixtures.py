@@ -0,0 +1,231 @@
+"""
+Offline stand-ins for the benchmarks: feeds generated for the journals of rss.yml or recorded
+from the publishers, a local HTTP server for them, and a mock OpenAI-compatible /chat/completions.
+"""
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import httpx
+
+from ..models import RSS_Journal, DateFormat
+
+# feedparser attributes the generator can produce, and the RSS element producing each
+ENTRY_ELEMENTS = {
+    "title": "title",
+    "link": "link",
+    "summary": "description",
+    "author": "dc:creator",
+    "published": "pubDate",
+    "updated": "dc:date",
+}
+WORDS = (
+    "whistler chorus wave electron radiation belt magnetosphere reconnection substorm plasma "
+    "ionosphere aurora solar wind shock particle acceleration scattering instability spacecraft "
+    "observation simulation model dynamics energetic field current sheet turbulence"
+).split()
+
+
+def journal_elements(journal: RSS_Journal) -> dict[str, str]:
+    """feedparser attribute read by each string or date field of the journal schema"""
+    attributes = {}
+    for field_name in ("title", "link", "summary", "authors", "affiliation", "published"):
+        schema = getattr(journal, field_name, None)
+        if isinstance(schema, str):
+            attributes[schema] = None
+        elif isinstance(schema, DateFormat):
+            attributes[schema.datestr] = schema.format
+    unknown = set(attributes) - set(ENTRY_ELEMENTS)
+    if unknown:
+        raise ValueError(f"Can not generate {unknown} for {journal.source}, record the real feed instead")
+    return attributes
+
+
+def example_journal_feed(journal: RSS_Journal, n_entries: int, seed: int = 0, start: int = 0) -> bytes:
+    """
+    RSS 2.0 feed with the fields and date formats expected by the journal schema.
+    Entries `start` to `start + n_entries` have unique links, so feeds of later runs overlap.
+    """
+    rng = random.Random(seed)
+    attributes = journal_elements(journal)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+
+    items = []
+    for i in range(start, start + n_entries):
+        published = now - timedelta(minutes=i)
+        values = {
+            "title": " ".join(rng.choices(WORDS, k=10)).capitalize(),
+            "link": f"{journal.feed.rstrip('/')}/paper/{seed}/{i}",
+            "summary": " ".join(rng.choices(WORDS, k=120)),
+            "author": ", ".join(f"{chr(65 + rng.randrange(26))}. Author" for _ in range(4)),
+        }
+        for attribute, date_format in attributes.items():
+            if attribute in ("published", "updated"):
+                if date_format is None:
+                    values[attribute] = format_datetime(published, usegmt=True)
+                else:
+                    values[attribute] = published.strftime(date_format)
+
+        order = ["title", "link", "summary"] + [a for a in attributes if a not in ("title", "link", "summary")]
+        elements = "".join(
+            f"<{ENTRY_ELEMENTS[attribute]}>{escape(values[attribute])}</{ENTRY_ELEMENTS[attribute]}>"
+            for attribute in order
+        )
+        items.append(f"<item>{elements}</item>")
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/"><channel>'
+        f"<title>{escape(journal.source)}</title>{''.join(items)}</channel></rss>"
+    ).encode()
+
+
+def record_feeds(journals: dict[str, RSS_Journal], directory: str | Path) -> dict[str, str]:
+    """download the live feeds as fixtures, return the journals that failed"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    failed = {}
+    for key, journal in journals.items():
+        try:
+            resp = httpx.get(journal.feed, follow_redirects=True, timeout=30)
+            resp.raise_for_status()
+        except httpx.HTTPError as err:
+            failed[key] = repr(err)
+            continue
+        (directory / f"{key}.xml").write_bytes(resp.content)
+    return failed
+
+
+class LocalServer(ThreadingHTTPServer):
+    # the default backlog of 5 resets connections of concurrent clients
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class FixtureServer:
+    """serve feed bodies by path on a local port, in a background thread"""
+
+    def __init__(self, feeds: dict[str, bytes] | None = None):
+        self.feeds = feeds or {}
+        fixtures = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # headers and body are separate writes, with Nagle the body waits for the delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                body = fixtures.feeds.get(self.path.lstrip("/"))
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/rss+xml")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = LocalServer(("127.0.0.1", 0), Handler)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def url(self, name: str) -> str:
+        return f"{self.base_url}/{name}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MockLLMServer(FixtureServer):
+    """
+    OpenAI-compatible /chat/completions answering after `latency` seconds,
+    with 429 and Retry-After for a `failure_rate` fraction of requests.
+    Batch prompts get one result per `### index` heading.
+    """
+
+    def __init__(self, latency: float = 0.02, failure_rate: float = 0.0, retry_after: float = 0.1, seed: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with mock.lock:
+                    mock.requests += 1
+                    fail = mock.rng.random() < mock.failure_rate
+                    mock.failures += fail
+                time.sleep(mock.latency)
+
+                if fail:
+                    self.send_json(429, {"error": "rate limited"}, {"Retry-After": str(mock.retry_after)})
+                    return
+                prompt = body["messages"][0]["content"]
+                self.send_json(200, mock.completion(prompt, body.get("model", "mock")))
+
+            def send_json(self, status: int, content: dict, headers: dict | None = None):
+                data = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = LocalServer(("127.0.0.1", 0), Handler)
+
+    def completion(self, prompt: str, model: str) -> dict:
+        # scores depend on the prompt only, so reruns give the same ratings
+        def score(text: str) -> float:
+            return (sum(map(ord, text)) % 51) / 10
+
+        indices = re.findall(r"### (\d+)", prompt)
+        if indices:
+            content = {"results": [
+                {"index": int(index), "comment": "mock batch", "score": score(prompt + index)}
+                for index in indices
+            ]}
+        else:
+            content = {"comment": "mock", "score": score(prompt)}
+
+        return {
+            "id": "mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": json.dumps(content)},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": len(prompt), "completion_tokens": 50, "total_tokens": len(prompt) + 50},
+        }
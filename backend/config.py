@@ -1,10 +1,12 @@
 from pydantic_settings import BaseSettings
-from pydantic import ConfigDict, BaseModel
-from functools import lru_cache
+from pydantic import ConfigDict, BaseModel, StringConstraints
+from threading import Lock
+from typing import Literal, Annotated, Callable
 from yaml import safe_load
 from dotenv import load_dotenv
 import os
 from .models import RSS_Journal
+from .response_cache import bump_version
 import logging
 
 # no level is specified, to prevent circular import
@@ -19,6 +21,26 @@ class LLM_Config(BaseModel):
     prompt: str
     model_args: dict = {}
 
+    # concurrent rating engine
+    timeout: float = 60
+    # requests in flight at the same time
+    max_concurrency: int = 4
+    # None means no limit
+    requests_per_minute: int | None = None
+    tokens_per_minute: int | None = None
+    # retries on 429, 5xx and network errors, with exponential backoff
+    max_retries: int = 5
+    # rated papers are written back to database every N papers
+    commit_batch_size: int = 20
+
+    # batch mode: rate N papers in one request, 1 means disabled
+    batch_size: int = 1
+    # rate papers one by one if their result in a batch is invalid
+    batch_fallback: bool = True
+    # `{papers}` is replaced by all papers formatted with `batch_paper_template`
+    batch_prompt: str = ""
+    batch_paper_template: str = "### {index}\n期刊: {source}\n标题：{title}\n摘要: {summary}\n"
+
     @classmethod
     def mock(cls):
         return cls(
@@ -29,6 +51,134 @@ class LLM_Config(BaseModel):
         )
     
 
+# profile names are written into the SQL of their partial indexes, so only word characters
+ProfileName = Annotated[str, StringConstraints(pattern=r"^\w+$")]
+
+
+class Profile_Config(BaseModel):
+    """
+    a named rating profile, e.g. the research interest of one person.
+    Settings not given are taken from LLM_API, so profiles share its endpoint and limits
+    """
+    prompt: str
+    model_name: str | None = None
+    model_args: dict | None = None
+    batch_prompt: str | None = None
+    # papers published in these days are rated for the profile, also the ones stored before it was added
+    backfill_days: int = 30
+
+    def llm_config(self, llm_config: LLM_Config) -> LLM_Config:
+        """LLM_API with the settings of this profile"""
+        overrides = self.model_dump(include={"prompt", "model_name", "model_args", "batch_prompt"}, exclude_none=True)
+        return llm_config.model_copy(update=overrides)
+
+
+class RSSFetch_Config(BaseModel):
+    """settings of the concurrent feed fetcher"""
+    # seconds allowed for a single feed, including connect and download
+    timeout: float = 30
+    # total connections shared by all feeds
+    max_connections: int = 16
+    # concurrent requests to the same host, to be polite to publishers
+    max_per_host: int = 2
+    # None means the feedparser user agent, some publishers block httpx default
+    user_agent: str | None = None
+    # worker processes parsing downloaded feeds, 0 parses in the calling thread
+    parse_processes: int = 0
+
+
+class RatingQueue_Config(BaseModel):
+    """settings of the incremental rating worker"""
+    # the worker also polls the queue regularly, in case a wakeup is missed
+    interval_minutes: int = 10
+    # papers loaded from the queue at a time
+    batch_size: int = 50
+    # papers failing this many times are left to the daily sweeper
+    max_attempts: int = 3
+
+
+class Prefilter_Config(BaseModel):
+    """local relevance model skipping the LLM for papers it is confident to be irrelevant"""
+    enabled: bool = False
+    # papers rated below this by the LLM count as irrelevant
+    irrelevant_below: float = 1.0
+    # probability of being irrelevant needed to skip the LLM
+    threshold: float = 0.95
+    # score given to skipped papers, they are marked as auto_scored
+    auto_score: float = 0.0
+    # the model is not used if its precision on held-out ratings is lower,
+    # or if it skipped fewer held-out papers than min_holdout_skipped, too few to tell its precision
+    min_precision: float = 0.95
+    min_holdout_skipped: int = 20
+    # LLM ratings needed to train, and the share held out for the report
+    min_samples: int = 200
+    holdout: float = 0.2
+    # retrain when the LLM ratings grew by this share
+    retrain_growth: float = 0.1
+    # columns of the hashed features
+    n_features: int = 2 ** 18
+
+
+class Relevance_Config(BaseModel):
+    """weights of relevance_score, the default order of the dashboard"""
+    # llm_score is 0 to 5
+    llm_weight: float = 1.0
+    # added per keyword found in title or summary, up to max_keyword_hits
+    keywords: list[str] = []
+    keyword_weight: float = 0.5
+    max_keyword_hits: int = 3
+    # multiplier by rss.yml key or source name, 1 if not given
+    journal_weights: dict[str, float] = {}
+    # share of the score decaying with age, and the days to lose half of it
+    recency_weight: float = 0.3
+    recency_half_life_days: float = 30
+
+
+class Dedup_Config(BaseModel):
+    """near-duplicate papers across feeds, found by MinHash/LSH on title and summary"""
+    enabled: bool = True
+    # words per shingle, texts with fewer shingles are too short to compare
+    shingle_size: int = 3
+    min_shingles: int = 5
+    # signature of bands * rows hashes, papers sharing a band are candidates
+    bands: int = 10
+    rows: int = 5
+    # Jaccard similarity of the shingles of a candidate to be a duplicate
+    threshold: float = 0.8
+    seed: int = 1
+
+
+class SQLite_Config(BaseModel):
+    """connection settings of the SQLite engine, applied as PRAGMAs on every connection"""
+    # WAL lets the API read while crons write
+    journal_mode: Literal["WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY"] = "WAL"
+    # NORMAL is durable in WAL mode, except for the last commits on power loss
+    synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    # milliseconds to wait for a lock before "database is locked"
+    busy_timeout: int = 5000
+    # bytes of the database file memory-mapped, 0 disables
+    mmap_size: int = 256 * 1024 * 1024
+    # pages if positive, KiB if negative
+    cache_size: int = -64000
+    # connections kept open, and extra ones allowed under load
+    pool_size: int = 5
+    max_overflow: int = 10
+    # seconds to wait for a free connection
+    pool_timeout: float = 30
+
+
+class Profiling_Config(BaseModel):
+    """settings of the profiler started from /api/profile"""
+    # profiles are written here for download
+    directory: str = "backend/logs/profiles"
+    # seconds between stack samples of the sampling profiler
+    sampling_interval: float = 0.005
+    # a profile stops after this many seconds, whatever was asked
+    max_seconds: float = 600
+    # profiles kept on disk, the oldest are deleted
+    keep: int = 20
+
+
 class ADMIN_Config(BaseModel):
     username: str = 'admin'
     realm: str = "admin-panel"
@@ -41,14 +191,27 @@ class AppSettings(BaseSettings):
     """
     LLM_API: LLM_Config = LLM_Config.mock()
     ADMIN_PANEL: ADMIN_Config = ADMIN_Config()
+    RSS_FETCH: RSSFetch_Config = RSSFetch_Config()
+    RATING_QUEUE: RatingQueue_Config = RatingQueue_Config()
+    PREFILTER: Prefilter_Config = Prefilter_Config()
+    RELEVANCE: Relevance_Config = Relevance_Config()
+    DEDUP: Dedup_Config = Dedup_Config()
+    # rating profiles by name, besides the default one of LLM_API
+    PROFILES: dict[ProfileName, Profile_Config] = {}
+    PROFILING: Profiling_Config = Profiling_Config()
 
     SQLITE_URL: str = "sqlite:///database.db"
+    SQLITE: SQLite_Config = SQLite_Config()
     RSS_SCHEMA_YML: str = "backend/config/rss.yml"
     DEBUG: bool = False
 
     HOST: str = "0.0.0.0"
     PORT: int = 8000
     BASE_URL: str = "/"
+    # number of rendered responses kept in memory for /api/rss and friends
+    RESPONSE_CACHE_SIZE: int = 256
+    # seconds between checks of the config files for changes, which are then reloaded, 0 disables
+    CONFIG_WATCH_SECONDS: int = 10
 
     RSS_JOURNALS: dict[str, RSS_Journal] = {}
 
@@ -57,8 +220,19 @@ class AppSettings(BaseSettings):
     )
 
 
-@lru_cache
-def get_config():
+# fields read once at startup, changing them needs a restart
+RESTART_FIELDS = ("SQLITE_URL", "SQLITE", "HOST", "PORT", "BASE_URL", "RESPONSE_CACHE_SIZE")
+
+# the current config, loaded at the first call of get_config and swapped as a whole on reload
+_config: AppSettings | None = None
+# modification times of the files it was read from, by path
+_config_files: dict[str, float] = {}
+_config_lock = Lock()
+# called with (new, old) after every reload
+_listeners: list[Callable[[AppSettings, AppSettings], None]] = []
+
+
+def config_path() -> str:
     if os.path.isfile(".env"):
         load_dotenv(".env")
 
@@ -74,13 +248,24 @@ def get_config():
             f"Config file not found: {app_config_path}. Using default config: {default_config_path}."
         )
         app_config_path = "backend/config/default.yml"
+    return app_config_path
+
 
+def file_mtimes(paths) -> dict[str, float]:
+    """modification times, None for missing files"""
+    return {path: os.path.getmtime(path) if os.path.isfile(path) else None for path in paths}
+
+
+def load_config() -> tuple[AppSettings, dict[str, float]]:
+    """read and validate the config and the journal schemas, with the modification times of both files"""
+    app_config_path = config_path()
     with open(app_config_path, "r", encoding="utf-8") as fp:
         app_config:dict = safe_load(fp.read())
 
-    with open(
-        app_config.get("RSS_SCHEMA_YML", "backend/rss/rss.yml"), "r", encoding="utf-8"
-    ) as fp:
+    rss_schema_path = app_config.get("RSS_SCHEMA_YML", "backend/rss/rss.yml")
+    # taken before reading, so a write during the reload is seen by the next check
+    mtimes = file_mtimes([app_config_path, rss_schema_path])
+    with open(rss_schema_path, "r", encoding="utf-8") as fp:
         rss_schema_raw = safe_load(fp.read())
 
     rss_schemas = {}
@@ -92,5 +277,64 @@ def get_config():
 
     app_config_model = AppSettings.model_validate(app_config)
 
-    return app_config_model
+    return app_config_model, mtimes
+
+
+def get_config() -> AppSettings:
+    """
+    The current config, read at the first call.
+    A reload replaces it by a new object, a job or request should keep the one it got for a consistent view.
+    """
+    config = _config
+    if config is None:
+        with _config_lock:
+            if _config is None:
+                _set_config(*load_config())
+            config = _config
+    return config
+
+
+def _set_config(config: AppSettings, mtimes: dict[str, float]):
+    global _config, _config_files
+    _config, _config_files = config, mtimes
+
+
+def config_changed() -> bool:
+    """whether a file of the config was modified since it was read"""
+    files = _config_files
+    return _config is not None and file_mtimes(files) != files
+
+
+def on_config_reload(listener: Callable[[AppSettings, AppSettings], None]):
+    """call `listener(new, old)` after every reload"""
+    _listeners.append(listener)
+
+
+def reload_config(only_if_changed: bool = False) -> AppSettings | None:
+    """
+    Read the config files again and swap the current config, None if `only_if_changed` and they were not.
+    An invalid config raises and the current one stays, requests and jobs see either the old or the new one.
+    """
+    with _config_lock:
+        old = _config
+        if only_if_changed and (old is None or not config_changed()):
+            return None
+        try:
+            config, mtimes = load_config()
+        except Exception:
+            # not retried by the file watch until the files change again
+            _set_config(old, file_mtimes(_config_files))
+            raise
+        _set_config(config, mtimes)
 
+    bump_version("config")
+    if old is not None:
+        restart = [field for field in RESTART_FIELDS if getattr(old, field) != getattr(config, field)]
+        if restart:
+            logger.warning(f"Config reloaded, changes of {', '.join(restart)} need a restart")
+        for listener in _listeners:
+            try:
+                listener(config, old)
+            except Exception:
+                logger.exception(f"Config reload listener {listener.__qualname__} failed")
+    return config
@@ -1,15 +1,25 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime
 from .models import AllowExtraModel
-from .rss import retrieve
-from .rater.req_openai_compat import rate_all_db
-from .config import get_config
-from .database import get_db_session
+from .rss import retrieve_all, retrieve_summary
+from .rater.req_openai_compat import rate_all_db, rate_papers, papers_to_rate, LLMResponse
+from .rater.queue import drain_rating_queue
+from .rater.profiles import rate_profiles
+from .config import AppSettings, get_config, reload_config, on_config_reload
+from .database import get_db_session, get_engine, analyze_db
+from .relevance import update_relevance
+from .dedup import rebuild_duplicates
+from .rater.prefilter import trained_prefilter
 from contextlib import contextmanager
 from .logger import custom_logger
+from .jobs import JobProgress
+from .profiling import profiled
+from .models import RSSItem
 
-config = get_config()
-logger = custom_logger(__name__, debug=config.DEBUG)
+logger = custom_logger(__name__)
+
+# set by init_crons, so that ingest can wake up the rating worker
+scheduler: BackgroundScheduler | None = None
 
 class APS_Jobs(AllowExtraModel):
     id: str
@@ -17,31 +27,168 @@ class APS_Jobs(AllowExtraModel):
     next_run_time: datetime
 
 
+@profiled
 def cron_retreive():
     """Cron job to retrieve RSS feeds"""
     config = get_config()
     with contextmanager(get_db_session)() as session:
-        for journal in config.RSS_JOURNALS.values():
-            retrieve(journal, session=session, update_duplicate=False)
-            logger.info(f"Cron job to retrieve {journal.source} completed.")
+        results = retrieve_all(config.RSS_JOURNALS, session=session, update_duplicate=False)
+        update_relevance(session, config)
+        for journal_key, result in results.items():
+            if "error" in result:
+                logger.warning(f"Cron job to retrieve {journal_key} failed: {result['error']}")
+            elif result.get("skipped"):
+                logger.info(f"Cron job to retrieve {journal_key} skipped, feed not modified.")
+            else:
+                logger.info(f"Cron job to retrieve {journal_key} completed.")
 
+    # keep the query planner statistics in line with the growing table
+    analyze_db(get_engine())
     logger.info("Cron job to retrieve ALL RSS feeds completed.")
 
+    if any(result.get("new") for result in results.values()):
+        wakeup_rating_queue()
+
+@profiled
+def cron_rate_queue():
+    """Job to rate papers in the rating queue, then the new papers of the other profiles"""
+    config = get_config()
+    with contextmanager(get_db_session)() as session:
+        drain_rating_queue(session, config)
+        update_relevance(session, config)
+        rate_profiles(session, config)
+
+def wakeup_rating_queue():
+    """Run the rating queue job now, instead of waiting for the next poll"""
+    if scheduler is None:
+        return
+    job = scheduler.get_job('cron_rate_queue')
+    if job:
+        job.modify(next_run_time=datetime.now())
+        logger.debug("Rating queue job woken up.")
+
+@profiled
 def cron_rate():
-    """Cron job to rate papers"""
+    """Cron job to rate papers, sweeping everything the rating queue left behind"""
     logger.info("Cron job to rate papers started.")
 
     config = get_config()
     with contextmanager(get_db_session)() as session:
         rate_all_db(session, config, rerate=False)
+        update_relevance(session, config)
+        rate_profiles(session, config)
 
     logger.info("Cron job to rate papers completed.")
 
+@profiled
+def job_retrieve(progress: JobProgress, journal_keys: list[str], force: bool = False):
+    """
+    Background job of /api/rss/update, reports the result of every journal,
+    and the counts over all of them as the result of the job
+    """
+    config = get_config()
+    journals = {key: config.RSS_JOURNALS[key] for key in journal_keys}
+    progress.set_total(len(journals))
+
+    def on_result(journal_key: str, result: dict):
+        progress.item(journal_key, result, failed="error" in result)
+
+    with contextmanager(get_db_session)() as session:
+        results = retrieve_all(
+            journals, session=session, update_duplicate=True,
+            fetch_config=config.RSS_FETCH, use_cache=not force, on_result=on_result,
+        )
+        progress.set_result(retrieve_summary(results))
+        update_relevance(session, config)
+
+    if any(result.get("new") for result in results.values()):
+        wakeup_rating_queue()
+
+@profiled
+def job_rate(progress: JobProgress, rerate: bool = False, link: str | None = None, use_cache: bool = True):
+    """Background job of /api/rss/rate, reports the rating of every paper"""
+    config = get_config()
+
+    def on_rated(paper: RSSItem, resp: LLMResponse | None):
+        if resp is None:
+            progress.item(paper.link, {"error": "rating failed"}, failed=True)
+        else:
+            progress.item(paper.link, {"comment": resp.comment, "score": resp.score})
+
+    with contextmanager(get_db_session)() as session:
+        papers = session.exec(papers_to_rate(rerate, link)).all()
+        if link is not None and not papers:
+            raise ValueError(f"Paper {link} not found in database")
+        # rated papers are skipped unless rerate
+        progress.set_total(sum(1 for paper in papers if rerate or paper.llm_score is None))
+        rate_papers(papers, config, rerate=rerate, session=session, use_cache=use_cache, on_rated=on_rated)
+        update_relevance(session, config)
+
+@profiled
+def job_relevance(progress: JobProgress, full: bool = True):
+    """Background job of /api/rss/relevance, the counts of the computation as the result"""
+    with contextmanager(get_db_session)() as session:
+        progress.set_result(update_relevance(session, get_config(), full=full))
+
+@profiled
+def job_rebuild_duplicates(progress: JobProgress):
+    """Background job of /api/rss/duplicates/rebuild, the papers indexed and duplicates found as the result"""
+    with contextmanager(get_db_session)() as session:
+        progress.set_result(rebuild_duplicates(session, get_config().DEDUP))
+
+@profiled
+def job_prefilter(progress: JobProgress, retrain: bool = False):
+    """Background job of /api/rss/prefilter, the report of the pre-filter as the result"""
+    config = get_config()
+    with contextmanager(get_db_session)() as session:
+        prefilter = trained_prefilter(session, config, retrain=retrain)
+    if prefilter is None:
+        raise ValueError("Not enough LLM ratings of both classes to train the pre-filter")
+    progress.set_result({"enabled": config.PREFILTER.enabled, **prefilter.report})
+
+def cron_watch_config():
+    """Job to reload the config when its files changed"""
+    try:
+        if reload_config(only_if_changed=True) is not None:
+            logger.info("Config files changed, config reloaded.")
+    except Exception:
+        logger.exception("Config files changed, but the new config is invalid. Keeping the current one.")
+
+def add_watch_job(scheduler: BackgroundScheduler, config: AppSettings):
+    """Check the config files every CONFIG_WATCH_SECONDS, if enabled"""
+    if config.CONFIG_WATCH_SECONDS > 0:
+        scheduler.add_job(
+            cron_watch_config, 'interval', seconds=config.CONFIG_WATCH_SECONDS,
+            id='cron_watch_config', max_instances=1, coalesce=True, replace_existing=True,
+        )
+    elif scheduler.get_job('cron_watch_config'):
+        scheduler.remove_job('cron_watch_config')
+
+def reschedule_jobs(config: AppSettings, old: AppSettings):
+    """Apply the intervals of a reloaded config to the jobs, other jobs keep their next run"""
+    if scheduler is None:
+        return
+    if config.RATING_QUEUE.interval_minutes != old.RATING_QUEUE.interval_minutes:
+        scheduler.reschedule_job('cron_rate_queue', trigger='interval', minutes=config.RATING_QUEUE.interval_minutes)
+        logger.info(f"Rating queue job rescheduled every {config.RATING_QUEUE.interval_minutes} minutes.")
+    if config.CONFIG_WATCH_SECONDS != old.CONFIG_WATCH_SECONDS:
+        add_watch_job(scheduler, config)
+
 def init_crons():
     """Initialize cron jobs"""
+    global scheduler
+    config = get_config()
+
     scheduler = BackgroundScheduler()
     scheduler.add_job(cron_retreive, 'cron', hour=3 , id='cron_retrieve', max_instances=1)
     scheduler.add_job(cron_rate, 'cron', hour=4, id='cron_rate', max_instances=1)
+    # rate queued papers on ingest, and drain leftovers from the last run on start
+    scheduler.add_job(
+        cron_rate_queue, 'interval', minutes=config.RATING_QUEUE.interval_minutes,
+        id='cron_rate_queue', max_instances=1, next_run_time=datetime.now(),
+    )
+    add_watch_job(scheduler, config)
+    on_config_reload(reschedule_jobs)
     scheduler.start()
 
     logger.info("Cron jobs initialized.")
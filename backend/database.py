@@ -1,21 +1,274 @@
-from .config import get_config
-from sqlmodel import create_engine, Session, SQLModel
+from .config import get_config, SQLite_Config
+from sqlmodel import create_engine, Session, SQLModel, text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import Engine, event, make_url, literal
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.exc import DatabaseError
+from threading import Lock
+from typing import Iterable
+
+from .metrics import listen_query_metrics
 
-sqlite_url = get_config().SQLITE_URL
 connection_args = {"check_same_thread": False}
 
-# database engine
-# TODO is this thread safe / ok to call multiple times?
-engine = create_engine(sqlite_url, connect_args=connection_args)
+# SQLite limits the number of variables in one statement,
+# long lists of values, or of rows to insert, are sent in chunks of this many
+SQLITE_CHUNK_SIZE = 500
+
+
+def sqlite_pragmas(sqlite_config: SQLite_Config, in_memory: bool = False) -> list[str]:
+    """PRAGMAs run on every new connection"""
+    pragmas = [
+        f"PRAGMA synchronous = {sqlite_config.synchronous}",
+        f"PRAGMA busy_timeout = {int(sqlite_config.busy_timeout)}",
+        f"PRAGMA mmap_size = {int(sqlite_config.mmap_size)}",
+        f"PRAGMA cache_size = {int(sqlite_config.cache_size)}",
+    ]
+    # in-memory databases have no journal file
+    if not in_memory:
+        pragmas.insert(0, f"PRAGMA journal_mode = {sqlite_config.journal_mode}")
+    return pragmas
+
+
+def engine_args(url: str, sqlite_config: SQLite_Config) -> tuple[bool, dict]:
+    """whether the database is in memory, and the pool arguments of `create_engine`"""
+    in_memory = make_url(url).database in (None, "", ":memory:")
+    if in_memory:
+        # in-memory databases keep the default single connection pool of SQLAlchemy
+        return in_memory, {}
+    return in_memory, {
+        "pool_size": sqlite_config.pool_size,
+        "max_overflow": sqlite_config.max_overflow,
+        "pool_timeout": sqlite_config.pool_timeout,
+    }
+
+
+def listen_sqlite_pragmas(engine: Engine, pragmas: list[str]):
+    """run `pragmas` on every new connection of a sync engine, or the sync side of an async one"""
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def create_db_engine(url: str, sqlite_config: SQLite_Config | None = None) -> Engine:
+    """
+    Engine with the pool and PRAGMAs of `sqlite_config`.
+    """
+    sqlite_config = sqlite_config or SQLite_Config()
+    in_memory, pool_args = engine_args(url, sqlite_config)
+
+    engine = create_engine(url, connect_args=connection_args, **pool_args)
+    listen_sqlite_pragmas(engine, sqlite_pragmas(sqlite_config, in_memory))
+    listen_query_metrics(engine)
+    return engine
+
+
+def create_async_db_engine(url: str, sqlite_config: SQLite_Config | None = None) -> AsyncEngine:
+    """
+    Async engine on the same database through aiosqlite, with the same pool and PRAGMAs.
+    `url` is the sync url, e.g. sqlite:///database.db
+    """
+    sqlite_config = sqlite_config or SQLite_Config()
+    in_memory, pool_args = engine_args(url, sqlite_config)
+
+    async_url = make_url(url).set(drivername="sqlite+aiosqlite")
+    async_engine = create_async_engine(async_url, connect_args=connection_args, **pool_args)
+    listen_sqlite_pragmas(async_engine.sync_engine, sqlite_pragmas(sqlite_config, in_memory))
+    listen_query_metrics(async_engine.sync_engine)
+    return async_engine
+
+
+# database engines, shared by the API and the crons, created at their first use.
+# the async engine serves async routes without holding a threadpool worker.
+# SQLITE_URL and SQLITE are read once, they are not changed by a config reload
+_engines: dict[str, Engine | AsyncEngine] = {}
+_engines_lock = Lock()
+
+def get_engine() -> Engine:
+    with _engines_lock:
+        if "sync" not in _engines:
+            config = get_config()
+            _engines["sync"] = create_db_engine(config.SQLITE_URL, config.SQLITE)
+        return _engines["sync"]
+
+def get_async_engine() -> AsyncEngine:
+    with _engines_lock:
+        if "async" not in _engines:
+            config = get_config()
+            _engines["async"] = create_async_db_engine(config.SQLITE_URL, config.SQLITE)
+        return _engines["async"]
+
+def __getattr__(name: str):
+    """`engine`, `async_engine` and `sqlite_url` of the module, created lazily"""
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    if name == "sqlite_url":
+        return get_config().SQLITE_URL
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_db_session():
     """dependency to get a database session
     TODO: make this doesn't rely on fastapi
     """
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         yield session
 
+async def get_async_db_session():
+    """
+    dependency to get an async database session, for async routes.
+    Objects are not expired on commit, as they can not be lazy loaded again outside of await
+    """
+    async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
+        yield session
+
+# indexes replaced by later versions of the models
+OBSOLETE_INDEXES = [
+    "ix_rss_items_llm_score_published_source",
+    "ix_rss_items_relevance_score_published_source",
+    "ix_rss_items_published_source",
+    "ix_rss_items_source_published",
+    # the keyset index starts with relevance_score, a second index only slowed down its updates
+    "ix_rss_items_relevance_score",
+    # relevance_score moved to relevance_scores
+    "ix_rss_items_relevance_score_keyset",
+]
+
+# columns replaced by later versions of the models, dropped after their indexes
+OBSOLETE_COLUMNS = {
+    # relevance_score and its keyword hits moved to relevance_scores, see backend/relevance.py
+    "rss_items": ["relevance_score", "keyword_hits"],
+}
+
+# full-text index of rss_items, the text is not copied but read from rss_items by rowid.
+# triggers keep it in sync on insert, upsert, rating and delete
+FTS_COLUMNS = ["title", "summary", "authors", "llm_comments"]
+FTS_STATEMENTS = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS rss_items_fts USING fts5(
+        {", ".join(FTS_COLUMNS)},
+        content='rss_items', content_rowid='rowid', tokenize='porter unicode61'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS rss_items_fts_insert AFTER INSERT ON rss_items BEGIN
+        INSERT INTO rss_items_fts(rowid, {", ".join(FTS_COLUMNS)})
+        VALUES (new.rowid, {", ".join("new." + c for c in FTS_COLUMNS)});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS rss_items_fts_delete AFTER DELETE ON rss_items BEGIN
+        INSERT INTO rss_items_fts(rss_items_fts, rowid, {", ".join(FTS_COLUMNS)})
+        VALUES ('delete', old.rowid, {", ".join("old." + c for c in FTS_COLUMNS)});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS rss_items_fts_update AFTER UPDATE OF {", ".join(FTS_COLUMNS)} ON rss_items BEGIN
+        INSERT INTO rss_items_fts(rss_items_fts, rowid, {", ".join(FTS_COLUMNS)})
+        VALUES ('delete', old.rowid, {", ".join("old." + c for c in FTS_COLUMNS)});
+        INSERT INTO rss_items_fts(rowid, {", ".join(FTS_COLUMNS)})
+        VALUES (new.rowid, {", ".join("new." + c for c in FTS_COLUMNS)});
+    END""",
+]
+
 def init_db():
     """Initialize the database"""
     # init database
-    SQLModel.metadata.create_all(engine)
\ No newline at end of file
+    engine = get_engine()
+    SQLModel.metadata.create_all(engine)
+    migrate_db(engine)
+
+def migrate_db(engine: Engine):
+    """
+    Bring an existing database up to the current models.
+    `create_all` only creates missing tables, so indexes added later are created here.
+    """
+    with engine.begin() as conn:
+        # links must be unique before the unique index can be built,
+        # keep the rated copy or the earliest one
+        conn.execute(text("""
+            DELETE FROM rss_items WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, ROW_NUMBER() OVER (
+                        PARTITION BY link ORDER BY llm_score IS NULL, rowid
+                    ) AS rn FROM rss_items
+                ) WHERE rn > 1
+            )
+        """))
+
+        add_missing_columns(conn)
+
+        for index_name in OBSOLETE_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+        drop_obsolete_columns(conn)
+
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        for statement in FTS_STATEMENTS:
+            conn.execute(text(statement))
+
+    check_fts(engine)
+    analyze_db(engine)
+
+def add_missing_columns(conn):
+    """
+    Append columns added to the models after the table was created, with their scalar default.
+    SQLite can only add columns at the end, which is all we need.
+    """
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table.name})"))}
+        if not existing:
+            continue
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"
+            if column.default is not None and column.default.is_scalar:
+                default = literal(column.default.arg).compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+                ddl += f" DEFAULT {default}"
+            conn.execute(text(ddl))
+
+def drop_obsolete_columns(conn):
+    """Drop the columns of OBSOLETE_COLUMNS still in an existing database, SQLite rewrites the table for each"""
+    for table_name, columns in OBSOLETE_COLUMNS.items():
+        existing = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table_name})"))}
+        for column in columns:
+            if column in existing:
+                conn.execute(text(f"ALTER TABLE {table_name} DROP COLUMN {column}"))
+
+def check_fts(engine: Engine):
+    """
+    Rebuild the full-text index if it is out of sync with rss_items,
+    e.g. created on an existing database, or rowids changed by VACUUM.
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO rss_items_fts(rss_items_fts, rank) VALUES ('integrity-check', 1)"))
+    except DatabaseError:
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO rss_items_fts(rss_items_fts) VALUES ('rebuild')"))
+
+def analyze_db(engine: Engine):
+    """
+    Refresh statistics of the query planner.
+    Without them, SQLite can not tell the skip-scan on score indexes is cheaper than sorting.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+def create_profile_indexes(conn, profiles: Iterable[str]):
+    """
+    A partial index of the scores of each profile, in the order of /api/rss by llm_score.
+    Like the llm_score index of rss_items, the planner can skip-scan it for a time range,
+    an index led by the profile would be read in full or sorted.
+    New indexes are analyzed, the planner does not use them without statistics.
+    Names are word characters only, checked by the config, as they are written into the SQL.
+    """
+    existing = set(conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+    for name in profiles:
+        index_name = f"ix_profile_scores_{name}_llm_score_keyset"
+        if index_name in existing:
+            continue
+        conn.execute(text(
+            f'CREATE INDEX "{index_name}" ON profile_scores (llm_score, published, item_uuid, source) '
+            f"WHERE profile = '{name}'"
+        ))
+        conn.execute(text(f'ANALYZE "{index_name}"'))
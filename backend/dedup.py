@@ -0,0 +1,205 @@
+"""
+Near-duplicate papers across feeds, e.g. overlapping subject feeds of a journal,
+or entries published again under a new link.
+Word shingles of the normalized title and summary are reduced to a MinHash signature,
+its bands are stored in `minhash_buckets`, papers sharing a bucket are candidates,
+and candidates are confirmed by the Jaccard similarity of their shingles.
+A duplicate points to its canonical paper by `canonical_uuid` and copies its rating.
+"""
+from functools import lru_cache
+from sqlmodel import Session, select, delete, update
+from sqlalchemy import bindparam
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import hashlib
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+
+from .models import RSSItem, MinHashBucket
+from .config import Dedup_Config
+from .database import SQLITE_CHUNK_SIZE
+from .response_cache import bump_version
+from .relevance import refresh_relevance
+from .logger import custom_logger
+
+logger = custom_logger(__name__)
+
+TAG_PATTERN = re.compile(r"<[^>]+>")
+WORD_PATTERN = re.compile(r"\w+")
+# Mersenne prime of the hash permutations, multiplier and shingle hash are below 2^32,
+# so (a * x + b) does not overflow uint64
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+HASH_MASK = np.uint64((1 << 32) - 1)
+SHINGLE_MULTIPLIER = np.uint64(1000003)
+
+
+def shingles(title: str, summary: str | None, dedup_config: Dedup_Config) -> np.ndarray:
+    """
+    Sorted unique 32 bit hashes of the word n-grams of the text, without markup, case and accents.
+    The hash of an n-gram is combined from the hashes of its words, in NumPy.
+    """
+    text = unicodedata.normalize("NFKD", f"{title} {summary or ''}")
+    words = WORD_PATTERN.findall(TAG_PATTERN.sub(" ", text).lower())
+    size = dedup_config.shingle_size
+    n_shingles = len(words) - size + 1
+    if n_shingles <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    word_hashes = np.fromiter((zlib.crc32(word.encode()) for word in words), dtype=np.uint64, count=len(words))
+    combined = np.zeros(n_shingles, dtype=np.uint64)
+    for offset in range(size):
+        # wraps around modulo 2^64
+        combined = combined * SHINGLE_MULTIPLIER + word_hashes[offset:offset + n_shingles]
+    return np.unique(combined & HASH_MASK)
+
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    if not len(a) or not len(b):
+        return 0.0
+    common = len(np.intersect1d(a, b, assume_unique=True))
+    return common / (len(a) + len(b) - common)
+
+
+@lru_cache(maxsize=4)
+def permutations(n_hashes: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 32, size=n_hashes, dtype=np.uint64)
+    b = rng.integers(0, 1 << 32, size=n_hashes, dtype=np.uint64)
+    return a, b
+
+
+def minhash(shingle_hashes: np.ndarray, dedup_config: Dedup_Config) -> np.ndarray:
+    """the minimum of every hash permutation over the shingles"""
+    a, b = permutations(dedup_config.bands * dedup_config.rows, dedup_config.seed)
+    return (((np.outer(a, shingle_hashes) + b[:, None]) % MERSENNE_PRIME) & HASH_MASK).min(axis=1)
+
+
+def lsh_buckets(signature: np.ndarray, dedup_config: Dedup_Config) -> list[int]:
+    """one bucket per band, numbered so equal bands at different positions do not collide"""
+    buckets = []
+    for band, rows in enumerate(signature.reshape(dedup_config.bands, dedup_config.rows)):
+        digest = hashlib.blake2b(rows.tobytes(), digest_size=8, salt=band.to_bytes(8, "little")).digest()
+        # SQLite integers are signed 64 bits
+        buckets.append(int.from_bytes(digest, "little", signed=True))
+    return buckets
+
+
+def bucket_members(session: Session, buckets: list[int]) -> dict[int, set[str]]:
+    """indexed papers of the buckets"""
+    members: dict[int, set[str]] = {}
+    for i in range(0, len(buckets), SQLITE_CHUNK_SIZE):
+        for bucket, item_uuid in session.exec(
+            select(MinHashBucket.bucket, MinHashBucket.item_uuid)
+            .where(MinHashBucket.bucket.in_(buckets[i:i + SQLITE_CHUNK_SIZE]))
+        ).all():
+            members.setdefault(bucket, set()).add(item_uuid)
+    return members
+
+
+def link_duplicates(session: Session, rows: list[dict], dedup_config: Dedup_Config) -> dict[str, str]:
+    """
+    Index stored rows (dicts with uuid, title and summary), in order,
+    and link the near-duplicates of indexed papers, also of earlier rows in `rows`.
+    Duplicates get `canonical_uuid` and the rating of the canonical paper, if it has one,
+    only canonical papers are indexed. Not committed, return {duplicate uuid: canonical uuid}.
+    """
+    if not dedup_config.enabled or not rows:
+        return {}
+
+    row_shingles, row_buckets = {}, {}
+    for row in rows:
+        row_hashes = shingles(row["title"], row["summary"], dedup_config)
+        if len(row_hashes) >= dedup_config.min_shingles:
+            row_shingles[row["uuid"]] = row_hashes
+            row_buckets[row["uuid"]] = lsh_buckets(minhash(row_hashes, dedup_config), dedup_config)
+
+    # buckets and candidate texts of the whole batch are read at once
+    members = bucket_members(session, list({bucket for buckets in row_buckets.values() for bucket in buckets}))
+    candidates = list({item_uuid for uuids in members.values() for item_uuid in uuids} - row_shingles.keys())
+    known: dict[str, np.ndarray] = {}
+    for i in range(0, len(candidates), SQLITE_CHUNK_SIZE):
+        for item_uuid, title, summary in session.exec(
+            select(RSSItem.uuid, RSSItem.title, RSSItem.summary)
+            .where(RSSItem.uuid.in_(candidates[i:i + SQLITE_CHUNK_SIZE]))
+        ).all():
+            known[item_uuid] = shingles(title, summary, dedup_config)
+
+    linked = {}
+    indexed = []
+    for item_uuid, buckets in row_buckets.items():
+        row_hashes = row_shingles[item_uuid]
+        similarity, canonical = max(
+            (
+                (jaccard(row_hashes, known[other]), other)
+                for other in set().union(*(members.get(bucket, ()) for bucket in buckets))
+                if other != item_uuid and other in known
+            ),
+            default=(0.0, None),
+        )
+        if canonical is not None and similarity >= dedup_config.threshold:
+            linked[item_uuid] = canonical
+            continue
+
+        # later rows of the batch are compared to this one
+        known[item_uuid] = row_hashes
+        for bucket in buckets:
+            members.setdefault(bucket, set()).add(item_uuid)
+        indexed.extend({"bucket": bucket, "item_uuid": item_uuid} for bucket in buckets)
+
+    conn = session.connection()
+    if indexed:
+        conn.execute(sqlite_insert(MinHashBucket).on_conflict_do_nothing(), indexed)
+    if linked:
+        conn.execute(
+            update(RSSItem).where(RSSItem.uuid == bindparam("duplicate")).values(canonical_uuid=bindparam("canonical")),
+            [{"duplicate": duplicate, "canonical": canonical} for duplicate, canonical in linked.items()],
+        )
+        copy_canonical_ratings(session, list(set(linked.values())), only_unrated=True)
+        logger.info(f"{len(linked)} near-duplicates linked to their canonical papers")
+    return linked
+
+
+def copy_canonical_ratings(session: Session, canonical_uuids: list[str], only_unrated: bool = False):
+    """
+    Give the duplicates of these papers their rating, in one UPDATE per chunk.
+    With `only_unrated`, duplicates rated before they were linked keep their rating. Not committed
+    """
+    canonical = aliased(RSSItem)
+    for i in range(0, len(canonical_uuids), SQLITE_CHUNK_SIZE):
+        chunk = canonical_uuids[i:i + SQLITE_CHUNK_SIZE]
+        statement = update(RSSItem).where(
+            RSSItem.canonical_uuid == canonical.uuid, canonical.uuid.in_(chunk), canonical.llm_score.is_not(None)
+        )
+        if only_unrated:
+            statement = statement.where(RSSItem.llm_score.is_(None))
+        session.exec(
+            statement.values(
+                llm_score=canonical.llm_score,
+                llm_comments=canonical.llm_comments,
+                auto_scored=canonical.auto_scored,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        refresh_relevance(session, select(RSSItem.uuid).where(RSSItem.canonical_uuid.in_(chunk)))
+
+
+def rebuild_duplicates(session: Session, dedup_config: Dedup_Config) -> dict:
+    """
+    Index all papers again, oldest first, e.g. after changing DEDUP or for papers stored before it.
+    Duplicates found keep a rating of their own if they have one.
+    """
+    session.exec(delete(MinHashBucket))
+    session.exec(update(RSSItem).values(canonical_uuid=None))
+    rows = [
+        {"uuid": item_uuid, "title": title, "summary": summary}
+        for item_uuid, title, summary in session.exec(
+            select(RSSItem.uuid, RSSItem.title, RSSItem.summary).order_by(RSSItem.published, RSSItem.uuid)
+        ).all()
+    ]
+    linked = link_duplicates(session, rows, dedup_config)
+    session.commit()
+    bump_version("data")
+    return {"papers": len(rows), "duplicates": len(linked)}
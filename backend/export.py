@@ -0,0 +1,141 @@
+from sqlmodel import Session, select
+from datetime import datetime
+from typing import Iterator
+import csv
+import io
+import json
+import zlib
+
+from .models import RSSItem, RSSItemPublic, RelevanceScore
+from .database import get_engine
+from .query import filter_rss_items
+from .logger import custom_logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = custom_logger(__name__)
+
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+}
+EXPORT_COMPRESSIONS = {
+    "gzip": ("application/gzip", "gz"),
+    "zstd": ("application/zstd", "zst"),
+}
+EXPORT_COLUMNS = list(RSSItemPublic.model_fields)
+# rows fetched from the cursor and encoded at once
+EXPORT_CHUNK_SIZE = 1000
+
+
+def check_export_args(fmt: str, compression: str | None):
+    """raise ValueError if the format or compression is not available"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format: {fmt}, choose from {list(EXPORT_FORMATS)}")
+    if compression is not None and compression not in EXPORT_COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}, choose from {list(EXPORT_COMPRESSIONS)}")
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression needs the `zstandard` package")
+
+
+def export_media_type(fmt: str, compression: str | None) -> tuple[str, str]:
+    """media type and file name of the export"""
+    media_type, extension = EXPORT_FORMATS[fmt]
+    filename = f"rss_items.{extension}"
+    if compression is not None:
+        media_type, compressed_extension = EXPORT_COMPRESSIONS[compression]
+        filename += f".{compressed_extension}"
+    return media_type, filename
+
+
+def iter_rows(sources: list[str] | None, time_since: datetime | None,
+              time_until: datetime | None, q: str | None = None) -> Iterator[list[dict]]:
+    """
+    Stream rows of rss_items with their relevance_score in chunks, oldest first.
+    Plain columns are selected and fetched from the cursor chunk by chunk,
+    so no ORM object is kept and memory use does not depend on the table size.
+    The session is owned by the generator, as it outlives the request handler.
+    """
+    columns = [
+        RelevanceScore.relevance_score if name == "relevance_score" else getattr(RSSItem, name)
+        for name in EXPORT_COLUMNS
+    ]
+    selection = select(*columns).outerjoin(RelevanceScore, RelevanceScore.item_uuid == RSSItem.uuid)
+    selection = filter_rss_items(selection, sources, time_since, time_until, q)
+    selection = selection.order_by(RSSItem.published, RSSItem.uuid)
+    selection = selection.execution_options(yield_per=EXPORT_CHUNK_SIZE)
+
+    with Session(get_engine()) as session:
+        result = session.exec(selection)
+        for partition in result.partitions():
+            yield [dict(zip(EXPORT_COLUMNS, row)) for row in partition]
+
+
+def encode_ndjson(rows: list[dict], header: bool = False) -> bytes:
+    lines = [json.dumps(row, ensure_ascii=False, default=datetime.isoformat) for row in rows]
+    return "".join(line + "\n" for line in lines).encode()
+
+
+def encode_csv(rows: list[dict], header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    if header:
+        writer.writeheader()
+    for row in rows:
+        writer.writerow({
+            key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in row.items()
+        })
+    return buffer.getvalue().encode()
+
+
+def compressor(compression: str | None):
+    """streaming compressor with compress/flush, None if not compressed"""
+    if compression == "gzip":
+        # wbits=31 writes the gzip header and trailer
+        return zlib.compressobj(wbits=31)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+
+def stream_export(
+    fmt: str = "ndjson",
+    compression: str | None = None,
+    sources: list[str] | None = None,
+    time_since: datetime | None = None,
+    time_until: datetime | None = None,
+    q: str | None = None,
+    chunks: Iterator[list[dict]] | None = None,
+) -> Iterator[bytes]:
+    """
+    Encode the export chunk by chunk, as NDJSON or CSV, optionally compressed.
+    `chunks` replaces the database rows, mostly for tests.
+    """
+    check_export_args(fmt, compression)
+    encode = encode_ndjson if fmt == "ndjson" else encode_csv
+    compress = compressor(compression)
+    if chunks is None:
+        chunks = iter_rows(sources, time_since, time_until, q)
+
+    n_rows = 0
+    header = True
+    for rows in chunks:
+        data = encode(rows, header=header)
+        header = False
+        n_rows += len(rows)
+        if compress is not None:
+            data = compress.compress(data)
+        if data:
+            yield data
+
+    # an empty CSV still has its header
+    if header and fmt == "csv":
+        data = encode([], header=True)
+        yield compress.compress(data) if compress is not None else data
+    if compress is not None:
+        yield compress.flush()
+    logger.info(f"Exported {n_rows} items as {fmt}, compression: {compression}")
@@ -0,0 +1,143 @@
+from apscheduler.schedulers.base import BaseScheduler
+from collections import OrderedDict
+from datetime import datetime
+from pydantic import BaseModel
+from threading import Lock
+from typing import Callable, Literal
+import json
+import uuid
+
+from .logger import custom_logger
+
+logger = custom_logger(__name__)
+
+
+class Job(BaseModel):
+    """a background job submitted from the API"""
+    id: str
+    kind: str
+    params: dict = {}
+    state: Literal["pending", "running", "done", "failed"] = "pending"
+    submitted: datetime
+    started: datetime | None = None
+    finished: datetime | None = None
+    # items to process, None until known
+    total: int | None = None
+    done: int = 0
+    failed: int = 0
+    # per item results, e.g. by journal key or paper link
+    results: dict[str, dict] = {}
+    # summary of the whole job, e.g. counts over all items
+    result: dict = {}
+    # error of the job itself
+    error: str | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.state in ("pending", "running")
+
+
+class JobProgress:
+    """handle given to the job function to report progress"""
+
+    def __init__(self, registry: "JobRegistry", job_id: str):
+        self.registry = registry
+        self.job_id = job_id
+
+    def set_total(self, total: int):
+        with self.registry.lock:
+            self.registry.jobs[self.job_id].total = total
+
+    def set_result(self, result: dict):
+        with self.registry.lock:
+            self.registry.jobs[self.job_id].result = result
+
+    def item(self, key: str, result: dict, failed: bool = False):
+        with self.registry.lock:
+            job = self.registry.jobs[self.job_id]
+            job.results[key] = result
+            job.done += 1
+            job.failed += failed
+
+
+class JobRegistry:
+    """
+    Background jobs run on the APScheduler of the crons, tracked in memory.
+    A job submitted again with the same kind and params while still active is not run twice,
+    the active one is returned instead. Only the last `max_finished` finished jobs are kept.
+    """
+
+    def __init__(self, max_finished: int = 100):
+        self.max_finished = max_finished
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def dedup_key(kind: str, params: dict) -> str:
+        return json.dumps([kind, params], sort_keys=True, default=str)
+
+    def submit(self, scheduler: BaseScheduler, kind: str, params: dict,
+               fn: Callable[..., None]) -> tuple[Job, bool]:
+        """
+        Run `fn(progress, **params)` in the background.
+        Return the job, and whether it was created or an active duplicate.
+        """
+        key = self.dedup_key(kind, params)
+        with self.lock:
+            for job in self.jobs.values():
+                if job.active and self.dedup_key(job.kind, job.params) == key:
+                    return job.model_copy(deep=True), False
+
+            job = Job(id=uuid.uuid4().hex, kind=kind, params=params, submitted=datetime.now())
+            self.jobs[job.id] = job
+            self._prune()
+            snapshot = job.model_copy(deep=True)
+
+        # without a trigger, the job runs once right away on the executor threads
+        scheduler.add_job(
+            self._run, id=f"job_{job.id}", name=f"job {kind}", args=[job.id, fn],
+            misfire_grace_time=None,
+        )
+        logger.info(f"Job {job.id} ({kind}) submitted with {params}")
+        return snapshot, True
+
+    def _run(self, job_id: str, fn: Callable[..., None]):
+        with self.lock:
+            job = self.jobs[job_id]
+            job.state = "running"
+            job.started = datetime.now()
+            params = dict(job.params)
+
+        try:
+            fn(JobProgress(self, job_id), **params)
+        except Exception as err:
+            logger.exception(f"Job {job_id} failed: {err!r}")
+            with self.lock:
+                job.state = "failed"
+                job.error = repr(err)
+                job.finished = datetime.now()
+            return
+
+        with self.lock:
+            job.state = "done"
+            job.finished = datetime.now()
+        logger.info(f"Job {job_id} ({job.kind}) done, {job.done} items, {job.failed} failed")
+
+    def _prune(self):
+        """forget the oldest finished jobs, called with the lock held"""
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str) -> Job | None:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.model_copy(deep=True) if job is not None else None
+
+    def list(self) -> list[Job]:
+        with self.lock:
+            return [job.model_copy(deep=True) for job in self.jobs.values()]
+
+
+# jobs submitted from the API
+job_registry = JobRegistry()
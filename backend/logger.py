@@ -1,33 +1,60 @@
 import logging
-from .config import AppSettings, get_config
+from .config import AppSettings, get_config, on_config_reload
 
 # class CustomAdapter(logging.LoggerAdapter):
 #     def process(self, msg, kwargs):
 #         custom_prefix = self.extra.get("custom_prefix", "")
 #         return f"[{custom_prefix}] {msg}", kwargs
 
+
+class AppLogHandler(logging.Handler):
+    """
+    Console and file output shared by all loggers of the app, so the log file is opened once.
+    Set up from the config at the first record rather than at import, and again on reload.
+    """
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.handlers: list[logging.Handler] | None = None
+
+    def configure(self, config: AppSettings, old: AppSettings | None = None):
+        level = logging.DEBUG if config.DEBUG else logging.INFO
+        formatter = logging.Formatter(
+            '[%(asctime)s|%(name)s|%(levelname)s] %(message)s')
+        # create console handler and file handler, the file is opened by the first record
+        ch = logging.StreamHandler()
+        fh = logging.FileHandler(config.LOG_OUTPUT, encoding='utf-8', delay=True)
+        for handler in (ch, fh):
+            handler.setLevel(level)
+            handler.setFormatter(formatter)
+
+        # the reentrant lock of the handler, held by emit
+        with self.lock:
+            old_handlers, self.handlers = self.handlers, [ch, fh]
+        for handler in old_handlers or []:
+            handler.close()
+
+    def emit(self, record: logging.LogRecord):
+        if self.handlers is None:
+            self.configure(get_config())
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+app_log_handler = AppLogHandler()
+on_config_reload(app_log_handler.configure)
+
+
 # TODO merge uvicorn logging as well
 # https://stackoverflow.com/questions/77001129/how-to-configure-fastapi-logging-so-that-it-works-both-with-uvicorn-locally-and
-def custom_logger(logger_name, debug=False):
-    config = get_config()
-
+def custom_logger(logger_name):
+    """logger writing to the shared console and file output, levels follow DEBUG of the config"""
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG)
-    # create file handler that logs debug and higher level messages
-    fh = logging.FileHandler(config.LOG_OUTPUT, encoding='utf-8')
-    fh.setLevel(logging.DEBUG if config.DEBUG else logging.INFO)
-    # create console handler with a higher log level
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG if config.DEBUG else logging.INFO)
-    # create formatter and add it to the handlers
-    formatter = logging.Formatter(
-        '[%(asctime)s|%(name)s|%(levelname)s] %(message)s')
-    ch.setFormatter(formatter)
-    fh.setFormatter(formatter)
-    # add the handlers to logger
-    logger.addHandler(ch)
-    logger.addHandler(fh)
+    if app_log_handler not in logger.handlers:
+        logger.addHandler(app_log_handler)
     # logger_adapter = CustomAdapter(logger, {"custom_prefix": prefix})
     logger.propagate = False
-    
-    return logger
\ No newline at end of file
+
+    return logger
@@ -1,9 +1,12 @@
-from fastapi import FastAPI, HTTPException, Depends, Query, APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Depends, Query, APIRouter, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse, FileResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.staticfiles import StaticFiles
 from sqlmodel import SQLModel, create_engine, Session, select, or_
 import sqlite3
-from typing import List, Annotated
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import List, Annotated, Callable, Awaitable
+import inspect
 import os
 import re
 import asyncio
@@ -17,16 +20,25 @@ import logging
 import mimetypes
 
 from .models import RSSItem, RSS_Journal
-from .config import AppSettings, get_config
+from .config import AppSettings, get_config, reload_config, RESTART_FIELDS
 from .logger import custom_logger
-from .rater.req_openai_compat import rate_all_db, rate_papers, LLMResponse
-from .rss import retrieve
-from .database import get_db_session, init_db
-from .crons import init_crons, get_cron_jobs
+from .rater.req_openai_compat import rate_papers, LLMResponse
+from .rater.cache import evict_llm_cache
+from .database import get_db_session, get_async_db_session, init_db
+from .query import parse_date, async_query_rss_page
+from .crons import (
+    init_crons, get_cron_jobs, job_retrieve, job_rate, job_relevance, job_rebuild_duplicates, job_prefilter,
+)
+from .jobs import Job, job_registry
+from .response_cache import ResponseCache, CachedResponse, get_version
+from .export import stream_export, check_export_args, export_media_type
+from .metrics import MetricsMiddleware, registry as metrics_registry, PROMETHEUS_CONTENT_TYPE
+from .profiling import ProfilingMiddleware, ProfileMode, ProfileTarget, profiler
 from .auth.httpdigest import auth_admin, security
 
+# read at import for the app settings below, routes get the current config by ConfigDep
 config = get_config()
-logger = custom_logger(__name__, debug=config.DEBUG)
+logger = custom_logger(__name__)
 
 # 加载环境变量
 # load config
@@ -39,6 +51,38 @@ ConfigDep = Annotated[AppSettings, Depends(get_config)]
 # TODO put this in separate module
 # ================
 SessionDep = Annotated[Session, Depends(get_db_session)]
+AsyncSessionDep = Annotated[AsyncSession, Depends(get_async_db_session)]
+# ================
+
+
+# response cache
+# ================
+response_cache = ResponseCache(max_size=config.RESPONSE_CACHE_SIZE)
+
+async def cached_json_response(
+    request: Request, depends_on: tuple[str, ...], build: Callable[[], tuple[object, dict] | Awaitable],
+    extra_key: tuple = (),
+) -> Response:
+    """
+    Serve a JSON response from the cache, keyed by path, normalized query parameters,
+    the versions it depends on and `extra_key`. `build` returns the content and extra headers on a miss,
+    it may be a coroutine function.
+    Clients revalidating with If-None-Match get 304 if nothing changed.
+    """
+    params = tuple(sorted(request.query_params.multi_items()))
+    key = (request.url.path, params, tuple(get_version(name) for name in depends_on), extra_key)
+
+    cached: CachedResponse | None = response_cache.get(key)
+    if cached is None:
+        result = build()
+        content, headers = await result if inspect.isawaitable(result) else result
+        cached = CachedResponse(JSONResponse(content=jsonable_encoder(content)).body, headers)
+        response_cache.put(key, cached)
+
+    headers = {**cached.headers, "ETag": cached.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == cached.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers=headers)
 # ================
 
 
@@ -62,14 +106,17 @@ app = FastAPI(
     redoc_url=f"{config.BASE_URL}/api/redoc",
     openapi_url=f"{config.BASE_URL}/api/openapi.json",
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(ProfilingMiddleware, exclude_prefix=f"{config.BASE_URL.rstrip('/')}/api/profile")
 
 router = APIRouter()
 
 # routes
 # ================
 @router.get("/api/rss")
-def get_rss_items(
-    session: SessionDep,
+async def get_rss_items(
+    request: Request,
+    session: AsyncSessionDep,
     config: ConfigDep,
     journal: Annotated[list[str] | None, Query(alias="journal")] = None,
     time_since: Annotated[str | None, Query(alias="time_since")] = None,
@@ -77,101 +124,125 @@ def get_rss_items(
     max_number: Annotated[int | None, Query(alias="max_number")] = 100,
     order_by: Annotated[str | None, Query(alias="order_by")] = "llm_score",
     desc: Annotated[bool, Query(alias="desc")] = True,
+    cursor: Annotated[str | None, Query(alias="cursor")] = None,
+    q: Annotated[str | None, Query(alias="q")] = None,
+    collapse: Annotated[bool, Query(alias="collapse")] = True,
+    profile: Annotated[str | None, Query(alias="profile")] = None,
 ):
     """
-    Get all RSS items
+    Get all RSS items.
+    `max_number` is the page size, if the page is full, the cursor of the next page
+    is returned in the `X-Next-Cursor` header.
+    `q` is a full-text search, use `order_by=rank` to order by relevance to it.
+    Near-duplicates from other feeds are listed once, unless `collapse=false`.
+    With a `profile` of PROFILES, its scores and comments are returned as `llm_score` and `llm_comments`.
     """
-    selection = select(RSSItem)
     # choose the journal
     # TODO support short names
     if journal is not None:
-        selection = selection.where(or_(RSSItem.source == j for j in journal))
+        sources = journal
     else:
         # if journal is not provided, get all provided in the config
         # NOTE: if journal are removed from rss.yml, but paper are still in db
         # we decide to return only journals that are activated in the config
-        all_journals = [j.source for j in config.RSS_JOURNALS.values()]
-        selection = selection.where(RSSItem.source.in_(all_journals))
-
-
-    def parse_date(time_since: str, default: datetime) -> datetime:
-        # choose the time since
-        if time_since is not None:
-            if re.match(r'\d{4}-\d{2}-\d{2}', time_since):
-                time_since_dt = datetime.strptime(time_since, "%Y-%m-%d")
-            elif re.match(r'\d{4}-\d{2}', time_since):
-                time_since_dt = datetime.strptime(time_since, "%Y-%m")
-            elif re.match(r'\d+', time_since):
-                if int(time_since) < 1e8:
-                    # if the time since is less than 1e8, treat it as days
-                    time_since_dt = datetime.now() - timedelta(days=int(time_since))
-                else:
-                    # if the time since is greater than 1e8, treat it as timestamp
-                    time_since_dt = datetime.fromtimestamp(int(time_since))
-            else:
-                # default to 7 days
-                time_since_dt = datetime.now() - timedelta(days=7)
-        else:
-            # default to 7 days
-            time_since_dt = default
-        return time_since_dt
-    
+        sources = [j.source for j in config.RSS_JOURNALS.values()]
+
+    if profile is not None and profile not in config.PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown profile: {profile}")
+
     time_since_dt = parse_date(time_since, datetime.now() - timedelta(days=7))
     time_until_dt = parse_date(time_until, datetime.now())
 
-    selection = selection.where(RSSItem.published >= time_since_dt).where(RSSItem.published <= time_until_dt)
-    # limit the number of items
-    if max_number is not None:
-        selection = selection.limit(max_number)
-    else:
-        # fallback to default number
-        selection = selection.limit(100)
-
+    async def build():
+        try:
+            items, next_cursor = await async_query_rss_page(
+                session, sources, time_since_dt, time_until_dt,
+                max_number=max_number, order_by=order_by, desc=desc, cursor=cursor, q=q, collapse=collapse,
+                profile=profile,
+            )
+        except ValueError as err:
+            raise HTTPException(status_code=400, detail=str(err))
 
-    # order by
-    if order_by is not None and order_by in RSSItem.__fields__:
-        if desc:
-            selection = selection.order_by(getattr(RSSItem, order_by).desc())
-        else:
-            selection = selection.order_by(getattr(RSSItem, order_by))
+        headers = {}
+        if next_cursor is not None:
+            headers["X-Next-Cursor"] = next_cursor
+        return items, headers
 
-    # default order by published date descending
-    selection = selection.order_by(RSSItem.published.desc())
+    # relative time ranges move with the clock, so they are cached for a minute at most
+    time_range_key = tuple(dt.replace(second=0, microsecond=0) for dt in (time_since_dt, time_until_dt))
+    return await cached_json_response(request, ("data", "config"), build, extra_key=time_range_key)
 
-    items = session.exec(selection).all()
 
-    return items
+@router.get("/api/rss/export", dependencies=[Depends(auth_admin)])
+def export_rss_items(
+    journal: Annotated[list[str] | None, Query(alias="journal")] = None,
+    time_since: Annotated[str | None, Query(alias="time_since")] = None,
+    time_until: Annotated[str | None, Query(alias="time_until")] = None,
+    q: Annotated[str | None, Query(alias="q")] = None,
+    fmt: Annotated[str, Query(alias="format")] = "ndjson",
+    compression: Annotated[str | None, Query(alias="compression")] = None,
+):
+    """
+    Stream RSS items as NDJSON or CSV, optionally compressed with gzip or zstd.
+    Filters are the same as /api/rss, but without them the whole table is exported,
+    including journals removed from the config.
+    """
+    try:
+        check_export_args(fmt, compression)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+
+    time_since_dt = parse_date(time_since, None)
+    time_until_dt = parse_date(time_until, None)
+
+    media_type, filename = export_media_type(fmt, compression)
+    return StreamingResponse(
+        stream_export(
+            fmt, compression,
+            sources=journal, time_since=time_since_dt, time_until=time_until_dt, q=q,
+        ),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 @router.get("/api/rss/sources")
-def get_rss_journals(config: ConfigDep):
+async def get_rss_journals(request: Request, config: ConfigDep):
     """
     """
-    journals = [j.model_dump(mode='json') for j in config.RSS_JOURNALS.values()]
+    def build():
+        journals = [j.model_dump(mode='json') for j in config.RSS_JOURNALS.values()]
+        return journals, {}
 
-    return JSONResponse(content=journals)
+    return await cached_json_response(request, ("config",), build)
 
 @router.get("/api/rss/llm_prompt")
-def get_llm_prompt(config: ConfigDep):
+async def get_llm_prompt(request: Request, config: ConfigDep):
     """
     Get the LLM prompt
     """
-    llm_prompt = config.LLM_API.model_dump(mode='json')
-    # remove the api key
-    llm_prompt['api_key'] = "********"
-    return JSONResponse(content=llm_prompt)
+    def build():
+        llm_prompt = config.LLM_API.model_dump(mode='json')
+        # remove the api key
+        llm_prompt['api_key'] = "********"
+        return llm_prompt, {}
+
+    return await cached_json_response(request, ("config",), build)
 
 
 
 
 @router.get("/api/rss/update", dependencies=[Depends(auth_admin)])
-def update_rss(session: SessionDep, config: ConfigDep, journal_name: Annotated[str, Query(alias='j')] = "all", ):
+def update_rss(
+    config: ConfigDep,
+    journal_name: Annotated[str, Query(alias='j')] = "all",
+    force: Annotated[bool, Query(alias="force")] = False,
+):
     """
-    Update from RSS sources
+    Update from RSS sources in a background job. Unchanged feeds are skipped unless `force` is set.
+    Returns the job id, follow the results at /api/jobs/{job_id},
+    its `result` counts the journals (total, skipped, failed) and the inserted and updated papers.
     """
-    # get the journal config
-    journal_configs = config.RSS_JOURNALS
-
     if not journal_name or journal_name in ["all", ""]:
         target_journals = list(config.RSS_JOURNALS.keys())
     elif journal_name in config.RSS_JOURNALS:
@@ -179,28 +250,74 @@ def update_rss(session: SessionDep, config: ConfigDep, journal_name: Annotated[s
     else:
         raise HTTPException(status_code=404, detail="Journal not found")
 
-    all_results = {}
-    for journal_key in target_journals:
-        journal_schema = journal_configs[journal_key]
-        results = retrieve(journal_schema, session=session, update_duplicate=True)
-
-        all_results[journal_key] = results
-
-    return JSONResponse(content=all_results)
+    job, created = job_registry.submit(
+        app.schedulers, "retrieve", {"journal_keys": target_journals, "force": force}, job_retrieve
+    )
+    return job_response(job, created)
 
 @router.get("/api/rss/rate", dependencies=[Depends(auth_admin)])
 def rate_rss(
-    session: SessionDep,
-    config: ConfigDep,
     rerate: Annotated[bool, Query(alias="force")] = False,
     link: Annotated[str | None, Query(alias="paper")] = None,
+    use_cache: Annotated[bool, Query(alias="cache")] = True,
 ):
     """
-    Rate all RSS items
+    Rate RSS items in a background job.
+    Returns the job id, follow the results at /api/jobs/{job_id}.
     """
-    rate_results = rate_all_db(session, config, rerate=rerate, specify_paper_link=link)
-        
-    return JSONResponse(content=rate_results)
+    job, created = job_registry.submit(
+        app.schedulers, "rate", {"rerate": rerate, "link": link, "use_cache": use_cache}, job_rate
+    )
+    return job_response(job, created)
+
+@router.get("/api/rss/prefilter", dependencies=[Depends(auth_admin)])
+def get_prefilter_report(
+    retrain: Annotated[bool, Query(alias="retrain")] = False,
+):
+    """
+    Precision and recall of the local pre-filter on held-out LLM ratings, at the configured
+    threshold and along a curve of thresholds, to tune PREFILTER before enabling it.
+    Precision is the share of auto-scored papers the LLM also found irrelevant.
+    The pre-filter is trained if needed in a background job, the report is its `result`,
+    follow it at /api/jobs/{job_id}. The job fails if there are too few ratings to train.
+    """
+    job, created = job_registry.submit(app.schedulers, "prefilter", {"retrain": retrain}, job_prefilter)
+    return job_response(job, created)
+
+@router.get("/api/rss/relevance", dependencies=[Depends(auth_admin)])
+def update_relevance_web(
+    full: Annotated[bool, Query(alias="full")] = True,
+):
+    """
+    Compute relevance_score in a background job, of all papers by default, or only of those without one.
+    Returns the job id, follow the results at /api/jobs/{job_id}.
+    """
+    job, created = job_registry.submit(app.schedulers, "relevance", {"full": full}, job_relevance)
+    return job_response(job, created)
+
+@router.get("/api/rss/duplicates/rebuild", dependencies=[Depends(auth_admin)])
+def rebuild_duplicates_web():
+    """
+    Find near-duplicates among all papers again in a background job, e.g. after changing DEDUP,
+    or for papers stored before duplicates were detected.
+    Returns the job id, follow the results at /api/jobs/{job_id}.
+    """
+    job, created = job_registry.submit(app.schedulers, "rebuild_duplicates", {}, job_rebuild_duplicates)
+    return job_response(job, created)
+
+@router.get("/api/llm_cache/evict", dependencies=[Depends(auth_admin)])
+def evict_llm_cache_web(
+    session: SessionDep,
+    model_name: Annotated[str | None, Query(alias="model")] = None,
+    days: Annotated[int | None, Query(alias="days")] = None,
+):
+    """
+    Evict cached LLM responses of a model and/or older than some days
+    """
+    older_than = datetime.now() - timedelta(days=days) if days is not None else None
+    evicted = evict_llm_cache(session, model_name=model_name, older_than=older_than)
+
+    return JSONResponse(content={"evicted": evicted})
 
 # crons
 # ================
@@ -232,6 +349,98 @@ def trigger_cron_now(job_name: str):
         raise HTTPException(status_code=404, detail="Job not found")
 
 
+# jobs
+# ================
+def job_response(job: Job, created: bool) -> JSONResponse:
+    """202 with the job id, `duplicate` if an identical job was already running"""
+    return JSONResponse(status_code=202, content={
+        "job_id": job.id,
+        "state": job.state,
+        "duplicate": not created,
+        "status_url": f"{config.BASE_URL.rstrip('/')}/api/jobs/{job.id}",
+    })
+
+@router.get("/api/jobs", dependencies=[Depends(auth_admin)])
+def get_jobs():
+    """
+    Get the background jobs, without per item results
+    """
+    jobs = [job.model_dump(mode='json', exclude={"results"}) for job in job_registry.list()]
+    return JSONResponse(content={"jobs": jobs})
+
+@router.get("/api/jobs/{job_id}", dependencies=[Depends(auth_admin)])
+def get_job(job_id: str):
+    """
+    Get the progress, per item results and errors of a background job
+    """
+    job = job_registry.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JSONResponse(content=job.model_dump(mode='json'))
+
+
+# metrics
+# ================
+@router.get("/api/metrics", dependencies=[Depends(auth_admin)])
+def get_metrics():
+    """
+    Metrics of ingest, rating and API routes in the Prometheus text format
+    """
+    return Response(content=metrics_registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+# profiling
+# ================
+@router.get("/api/profile/start", dependencies=[Depends(auth_admin)])
+def start_profile(
+    mode: Annotated[ProfileMode, Query(alias="mode")] = "sampling",
+    seconds: Annotated[float, Query(alias="seconds", gt=0)] = 30,
+    runs: Annotated[int | None, Query(alias="runs", gt=0)] = None,
+    target: Annotated[ProfileTarget, Query(alias="target")] = "all",
+):
+    """
+    Start profiling for `seconds`, or until `runs` requests or cron runs of `target` are done.
+    `sampling` samples the stacks of all threads into collapsed stacks for flame graphs,
+    `cprofile` profiles every run into a pstats file.
+    """
+    try:
+        session = profiler.start(mode=mode, seconds=seconds, max_runs=runs, target=target)
+    except RuntimeError as err:
+        raise HTTPException(status_code=409, detail=str(err))
+    return JSONResponse(content=session.model_dump(mode='json'))
+
+@router.get("/api/profile/stop", dependencies=[Depends(auth_admin)])
+def stop_profile():
+    """
+    Stop the running profile now and write its output
+    """
+    session = profiler.stop()
+    if session is None:
+        raise HTTPException(status_code=404, detail="No profile running")
+    return JSONResponse(content=session.model_dump(mode='json'))
+
+@router.get("/api/profile", dependencies=[Depends(auth_admin)])
+def get_profiles():
+    """
+    Get the running and kept profiles
+    """
+    sessions = [session.model_dump(mode='json') for session in profiler.list()]
+    return JSONResponse(content={"profiles": sessions})
+
+@router.get("/api/profile/{profile_id}/download", dependencies=[Depends(auth_admin)])
+def download_profile(profile_id: str):
+    """
+    Download the output of a finished profile
+    """
+    session = profiler.get(profile_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    path = profiler.path(session)
+    if path is None or not path.is_file():
+        raise HTTPException(status_code=409, detail="Profile is still running")
+    return FileResponse(path, filename=path.name, media_type="application/octet-stream")
+
+
 # config
 # ================
 @router.get("/api/config", dependencies=[Depends(auth_admin)])
@@ -248,6 +457,27 @@ async def get_config_web(config: ConfigDep, show_secrets: bool = False):
 
     return JSONResponse(config_dict)
 
+@router.get("/api/config/reload", dependencies=[Depends(auth_admin)])
+def reload_config_web(config: ConfigDep):
+    """
+    Read the config files again and apply them without a restart:
+    journals, prompts and profiles are used by the next job, jobs are rescheduled.
+    An invalid config is rejected with 400 and the current one stays.
+    """
+    try:
+        new_config = reload_config()
+    except Exception as e:
+        logger.exception("Config reload failed")
+        raise HTTPException(status_code=400, detail=f"Invalid config: {e}")
+
+    return JSONResponse(content={
+        "status": "success",
+        "journals": len(new_config.RSS_JOURNALS),
+        "profiles": list(new_config.PROFILES),
+        # changed, but only applied after a restart
+        "restart_required": [field for field in RESTART_FIELDS if getattr(config, field) != getattr(new_config, field)],
+    })
+
 # mount the frontend
 mimetypes.add_type("application/javascript", ".js", True)
 mimetypes.add_type("application/javascript", ".mjs", True)
@@ -0,0 +1,223 @@
+from contextvars import ContextVar
+from threading import Lock
+from typing import Iterable
+import bisect
+import time
+
+from sqlalchemy import Engine, event
+
+# latency buckets in seconds, from a cached query to a slow LLM answer
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: dict[str, str] | None = None) -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{escape_label(value)}"' for name, value in (extra or {}).items()]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """a metric family with label values as keys, updated from any thread"""
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = Lock()
+        self.values: dict[tuple, object] = {}
+
+    def label_values(self, labels: dict[str, str]) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += self.samples()
+        return "\n".join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self.label_values(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f"{self.name}{format_labels(self.label_names, key)} {value}" for key, value in values]
+
+
+class Histogram(Metric):
+    """
+    Bucket counts, sum and count of observations.
+    Counts are kept per bucket and made cumulative when rendered.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # counts of each bucket and +Inf, then the sum
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def count(self, **labels) -> int:
+        state = self.values.get(self.label_values(labels))
+        return sum(state[:-1]) if state is not None else 0
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = sorted((key, list(state)) for key, state in self.values.items())
+
+        lines = []
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), state[:-1]):
+                cumulative += count
+                labels = format_labels(self.label_names, key, {"le": str(bound)})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {state[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """metrics of this process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = MetricsRegistry()
+
+# ingest
+FEED_FETCH_SECONDS = registry.histogram(
+    "rss_feed_fetch_seconds", "Time to download a feed", ["journal", "status"])
+FEED_PARSE_SECONDS = registry.histogram(
+    "rss_feed_parse_seconds", "Time to parse a downloaded feed into rows", ["journal"])
+FEED_ITEMS = registry.counter(
+    "rss_feed_items_total", "Feed items by outcome of the upsert: inserted, updated or unchanged",
+    ["journal", "result"])
+
+# rating
+LLM_REQUEST_SECONDS = registry.histogram(
+    "llm_request_seconds", "Latency of LLM API requests, each retry counted", ["model", "status"])
+LLM_TOKENS = registry.counter(
+    "llm_tokens_total", "Tokens reported in the usage of LLM responses", ["model", "kind"])
+RATINGS = registry.counter(
+    "llm_ratings_total", "Rated papers by outcome: rated, cached, auto (pre-filter) or failed", ["result"])
+
+# API
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "http_request_seconds", "Latency of API requests until the response is sent", ["route", "method", "status"])
+DB_QUERY_SECONDS = registry.histogram(
+    "db_query_seconds", "Time of database statements, by the API route running them", ["route"])
+
+
+# route of the request running in the current context, "background" for crons and jobs
+current_route: ContextVar[dict | None] = ContextVar("current_route", default=None)
+
+
+def route_label(scope: dict | None) -> str:
+    """path template of the matched route, so path parameters do not make new series"""
+    if scope is None:
+        return "background"
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def listen_query_metrics(engine: Engine):
+    """time the statements of a sync engine, or the sync side of an async one"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        DB_QUERY_SECONDS.observe(elapsed, route=route_label(current_route.get()))
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing API requests by route, method and status.
+    The timer stops when the last body chunk is sent, so streamed responses are timed in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        token = current_route.set(scope)
+
+        async def send_timed(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            current_route.reset(token)
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                route=route_label(scope), method=scope["method"], status=status,
+            )
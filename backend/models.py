@@ -1,7 +1,10 @@
-from typing import Optional, Annotated
+from typing import Optional, Annotated, Callable
+from operator import attrgetter
+from functools import lru_cache
 from datetime import datetime
 from sqlmodel import SQLModel, Field, Session, select
-from pydantic import BaseModel, ConfigDict, field_validator
+from pydantic import BaseModel, ConfigDict, PrivateAttr, field_validator
+from sqlalchemy import Index
 import uuid
 
 class AllowExtraModel(BaseModel):
@@ -11,8 +14,8 @@ class AllowExtraModel(BaseModel):
 
 # RSS
 # ==========================
-class RSSItem(SQLModel, table=True):
-    __tablename__ = "rss_items"
+class RSSItemBase(SQLModel):
+    """fields of a paper, stored in rss_items by RSSItem"""
 
     # use UUID as primary key
     uuid: str = Field(
@@ -20,7 +23,7 @@ class RSSItem(SQLModel, table=True):
     )  # RSS项ID
 
     title: str  # 标题
-    link: str  # 链接
+    link: str = Field(index=True, unique=True)  # 链接
     summary: str  # 摘要
     source: str  # 来源
     authors: Optional[str] = ""  # 作者
@@ -33,9 +36,120 @@ class RSSItem(SQLModel, table=True):
     llm_score: Optional[float] = Field(
         default=None, index=True
     )  # LLM相关性评分
-    relevance_score: Optional[float] = Field(
+    auto_scored: Optional[bool] = Field(
+        default=False
+    )  # 由本地预筛选评分，未请求LLM
+    canonical_uuid: Optional[str] = Field(
         default=None, index=True
-    )  # 最终相关性评分
+    )  # 近似重复文章的原文章ID，沿用其评分
+
+
+class RSSItem(RSSItemBase, table=True):
+    __tablename__ = "rss_items"
+    # composite indexes matching /api/rss: filter by source and published range,
+    # order by a score, then published and uuid as keyset of pagination.
+    # score leading indexes are read in order by skip-scan, no sorting is needed
+    __table_args__ = (
+        Index("ix_rss_items_llm_score_keyset", "llm_score", "published", "uuid", "source"),
+        Index("ix_rss_items_published_keyset", "published", "uuid", "source"),
+        Index("ix_rss_items_source_keyset", "source", "published", "uuid"),
+    )
+
+
+class RSSItemPublic(RSSItemBase):
+    """a paper as listed by /api/rss, with its relevance_score from relevance_scores"""
+    relevance_score: Optional[float] = None  # 最终相关性评分
+
+
+class RelevanceScore(SQLModel, table=True):
+    """
+    relevance_score of a paper, see `backend/relevance.py` for why it has its own table.
+    published, source and llm_score are copied from rss_items, /api/rss ordered by relevance_score
+    is served by its index.
+    Rows are copied again when the paper is stored, rated or updated, see `relevance.refresh_relevance`
+    """
+    __tablename__ = "relevance_scores"
+    __table_args__ = (
+        Index("ix_relevance_scores_keyset", "relevance_score", "published", "item_uuid", "source"),
+    )
+
+    item_uuid: str = Field(primary_key=True)  # rss_items.uuid
+    published: datetime
+    source: str
+    llm_score: Optional[float] = None  # LLM相关性评分
+    keyword_hits: int = 0  # 标题与摘要中出现的RELEVANCE关键词数
+    relevance_score: Optional[float] = None  # 最终相关性评分
+
+
+class ProfileScore(SQLModel, table=True):
+    """
+    rating of a paper for a named profile of PROFILES, no score yet means waiting to be rated.
+    published and source are copied from rss_items, so /api/rss?profile= is served by
+    the indexes of this table, each profile is a contiguous range of them.
+    The order by llm_score has a partial index per profile, see `database.create_profile_indexes`
+    """
+    __tablename__ = "profile_scores"
+    __table_args__ = (
+        Index("ix_profile_scores_published_keyset", "profile", "published", "item_uuid", "source"),
+    )
+
+    item_uuid: str = Field(primary_key=True)  # rss_items.uuid
+    profile: str = Field(primary_key=True)  # PROFILES中的名称
+    published: datetime
+    source: str
+    llm_comments: Optional[str] = Field(default="")  # LLM评价
+    llm_score: Optional[float] = Field(default=None)  # LLM相关性评分
+    attempts: int = 0  # 评分失败次数
+
+
+class MinHashBucket(SQLModel, table=True):
+    """
+    LSH buckets of the MinHash signatures of canonical papers, one row per band,
+    papers sharing a bucket are candidates of near-duplicates
+    """
+    __tablename__ = "minhash_buckets"
+
+    bucket: int = Field(primary_key=True)  # 签名一段的哈希，含段号
+    item_uuid: str = Field(primary_key=True, index=True)  # rss_items.uuid
+
+
+class RatingQueue(SQLModel, table=True):
+    """
+    papers waiting to be rated, filled when new items are stored
+    """
+    __tablename__ = "rating_queue"
+
+    item_uuid: str = Field(primary_key=True)  # rss_items.uuid
+    enqueued: datetime = Field(default_factory=datetime.now, index=True)
+    attempts: int = 0  # 评分失败次数
+
+
+class FeedCache(SQLModel, table=True):
+    """
+    validators of the last downloaded feed, used for conditional GET
+    """
+    __tablename__ = "feed_cache"
+
+    journal_key: str = Field(primary_key=True)  # rss.yml中的键
+    feed: str  # RSS链接
+    schema_hash: str  # rss.yml中配置的哈希，配置修改后缓存失效
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_hash: Optional[str] = None  # 内容的sha256
+    updated: datetime = Field(default_factory=datetime.now)
+
+
+class LLMCache(SQLModel, table=True):
+    """
+    parsed LLM responses keyed by hash of (model_name, model_args, prompt)
+    """
+    __tablename__ = "llm_cache"
+
+    key: str = Field(primary_key=True)  # sha256
+    model_name: str = Field(index=True)
+    comment: str
+    score: Optional[float] = None
+    created: datetime = Field(default_factory=datetime.now, index=True)
 
 
 class DateFormat(BaseModel):
@@ -43,6 +157,26 @@ class DateFormat(BaseModel):
     format: str
 
 
+@lru_cache(maxsize=4096)
+def parse_entry_date(date_str: str, format: str) -> datetime:
+    """strptime is the slowest part of the mapping, and entries of a feed often share their date"""
+    return datetime.strptime(date_str, format)
+
+
+class EntryDate:
+    """
+    getter parsing a date field of feed entries.
+    A class instead of a closure, so that compiled journals can be sent to parser processes
+    """
+
+    def __init__(self, datestr: str, format: str):
+        self.datestr = datestr
+        self.format = format
+
+    def __call__(self, entry) -> datetime:
+        return parse_entry_date(getattr(entry, self.datestr), self.format)
+
+
 class RSS_Journal(AllowExtraModel):
     """
     this is used to parse rss.yml to get correspondence with sqlmodels
@@ -58,4 +192,52 @@ class RSS_Journal(AllowExtraModel):
     affiliation: Optional[str] = Field(default="affiliation")
     published: DateFormat = Field(default="published")
 
+    # (RSSItem field, getter of feed entries), compiled once when the config is loaded
+    _extractors: list[tuple[str, Callable]] = PrivateAttr(default_factory=list)
+
+    def model_post_init(self, __context):
+        self._extractors = self.compile_extractors()
+
+    def model_copy(self, *, update=None, deep: bool = False) -> "RSS_Journal":
+        """copies with an update may change the schema, their extractors are compiled again"""
+        journal = super().model_copy(update=update, deep=deep)
+        if update:
+            journal._extractors = journal.compile_extractors()
+        return journal
+
+    def compile_extractors(self) -> list[tuple[str, Callable]]:
+        """
+        Decide once how each RSSItem field is read from feed entries:
+        - string: the entry attribute of that name
+        - DateFormat: the entry attribute parsed with the format
+        - None, or absent from the schema: not provided by the feed
+        source and uuid are not read from entries.
+        """
+        extractors = []
+        for field_name in RSSItem.model_fields.keys():
+            if field_name in ("source", "uuid") or not hasattr(self, field_name):
+                continue
+
+            schema = getattr(self, field_name)
+            if isinstance(schema, str):
+                extractors.append((field_name, attrgetter(schema)))
+            elif isinstance(schema, DateFormat):
+                extractors.append((field_name, EntryDate(schema.datestr, schema.format)))
+            elif schema is None:
+                continue
+            else:
+                raise NotImplementedError(
+                    f"Field {field_name} is type {type(schema)}, not implemented"
+                )
+        return extractors
+
+    def extract(self, entry) -> dict:
+        """
+        Fields of an RSSItem from a feed entry, with the compiled extractors
+        """
+        item_obj = {field_name: getter(entry) for field_name, getter in self._extractors}
+        # We usually give a custom source name
+        item_obj["source"] = self.source
+        return item_obj
+
 
@@ -0,0 +1,291 @@
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Callable, Literal
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import uuid
+
+from .config import get_config, Profiling_Config
+from .logger import custom_logger
+
+logger = custom_logger(__name__)
+
+ProfileMode = Literal["sampling", "cprofile"]
+ProfileTarget = Literal["requests", "crons", "all"]
+PROFILE_EXTENSIONS = {"sampling": "folded", "cprofile": "pstats"}
+
+# held while a cProfile runs, in any thread. Since Python 3.12 cProfile uses the
+# interpreter-wide sys.monitoring, so a second one can not be enabled at the same time
+_cprofile_lock = threading.Lock()
+
+
+class ProfileSession(BaseModel):
+    """a profile started from the API, for a time window and/or a number of runs"""
+    id: str
+    mode: ProfileMode
+    target: ProfileTarget
+    started: datetime
+    deadline: datetime
+    # stop after this many profiled requests or cron runs, None for the whole window
+    max_runs: int | None = None
+    runs: int = 0
+    # runs of the cprofile mode not profiled, as another run was profiled at the same time
+    skipped_runs: int = 0
+    # stacks taken by the sampling profiler
+    samples: int = 0
+    state: Literal["running", "done"] = "running"
+    finished: datetime | None = None
+    filename: str | None = None
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapsed_stack(thread_name: str, frame) -> str:
+    """root to leaf, separated by semicolons, as read by flamegraph.pl and speedscope"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    """sample the stacks of all other threads every `interval` seconds until stopped"""
+
+    def __init__(self, interval: float):
+        super().__init__(name="profile sampler", daemon=True)
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != self.ident:
+                    self.stacks[collapsed_stack(names.get(ident, str(ident)), frame)] += 1
+
+    def stop(self) -> Counter[str]:
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+class Profiler:
+    """
+    Profile the process on demand, one session at a time.
+    With the sampling mode, a thread samples the stacks of all threads, written as collapsed stacks.
+    With the cprofile mode, each hooked request or cron run is profiled on its own thread
+    and the results are merged into one pstats file. One run is profiled at a time,
+    runs overlapping it are skipped and counted in `skipped_runs`.
+    Hooks check `session` first, so they cost one attribute lookup while no profile runs.
+    """
+
+    def __init__(self, profiling_config: Profiling_Config | None = None):
+        self._config = profiling_config
+        self.lock = threading.Lock()
+        self.session: ProfileSession | None = None
+        self.sessions: OrderedDict[str, ProfileSession] = OrderedDict()
+        self._sampler: StackSampler | None = None
+        self._stats: pstats.Stats | None = None
+        self._timer: threading.Timer | None = None
+
+    @property
+    def config(self) -> Profiling_Config:
+        """PROFILING of the current config, unless given"""
+        return self._config or get_config().PROFILING
+
+    def start(self, mode: ProfileMode = "sampling", seconds: float = 30, max_runs: int | None = None,
+              target: ProfileTarget = "all") -> ProfileSession:
+        """raise RuntimeError if a profile is already running"""
+        seconds = min(seconds, self.config.max_seconds)
+        with self.lock:
+            if self.session is not None:
+                raise RuntimeError(f"Profile {self.session.id} is already running")
+
+            now = datetime.now()
+            session = ProfileSession(
+                id=uuid.uuid4().hex, mode=mode, target=target, max_runs=max_runs,
+                started=now, deadline=now + timedelta(seconds=seconds),
+            )
+            self._stats = None
+            if mode == "sampling":
+                self._sampler = StackSampler(self.config.sampling_interval)
+                self._sampler.start()
+            self._timer = threading.Timer(seconds, self.stop, args=[session.id])
+            self._timer.daemon = True
+            self._timer.start()
+
+            self.sessions[session.id] = session
+            self.session = session
+
+        logger.info(f"Profile {session.id} started: {mode} of {target} for {seconds}s, max runs: {max_runs}")
+        return session.model_copy()
+
+    def stop(self, session_id: str | None = None) -> ProfileSession | None:
+        """stop the running profile, if it is `session_id` when given, and write its output"""
+        with self.lock:
+            session = self.session
+            if session is None or (session_id is not None and session.id != session_id):
+                return None
+            self.session = None
+            sampler, self._sampler = self._sampler, None
+            stats, self._stats = self._stats, None
+            if self._timer is not None:
+                self._timer.cancel()
+
+        directory = Path(self.config.directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{session.id}.{PROFILE_EXTENSIONS[session.mode]}"
+        if sampler is not None:
+            stacks = sampler.stop()
+            session.samples = sum(stacks.values())
+            path.write_text("".join(f"{stack} {count}\n" for stack, count in stacks.most_common()))
+        elif stats is not None:
+            stats.dump_stats(path)
+        else:
+            # nothing was profiled in the window, an empty file is still downloadable
+            path.write_bytes(b"")
+
+        with self.lock:
+            session.filename = path.name
+            session.state = "done"
+            session.finished = datetime.now()
+            self._prune()
+
+        logger.info(f"Profile {session.id} done, {session.runs} runs, written to {path}")
+        return session.model_copy()
+
+    def _prune(self):
+        """delete the oldest finished profiles beyond `keep`, called with the lock held"""
+        finished = [session for session in self.sessions.values() if session.state == "done"]
+        for session in finished[:max(0, len(finished) - self.config.keep)]:
+            del self.sessions[session.id]
+            if session.filename is not None:
+                (Path(self.config.directory) / session.filename).unlink(missing_ok=True)
+
+    def get(self, session_id: str) -> ProfileSession | None:
+        with self.lock:
+            session = self.sessions.get(session_id)
+            return session.model_copy() if session is not None else None
+
+    def list(self) -> list[ProfileSession]:
+        with self.lock:
+            return [session.model_copy() for session in self.sessions.values()]
+
+    def path(self, session: ProfileSession) -> Path | None:
+        if session.filename is None:
+            return None
+        return Path(self.config.directory) / session.filename
+
+    # hooks
+    # ==========================
+    def wants(self, kind: Literal["requests", "crons"]) -> bool:
+        session = self.session
+        return session is not None and session.target in (kind, "all")
+
+    def begin_run(self) -> cProfile.Profile | None:
+        """
+        Start a cProfile on this thread if the session profiles each run,
+        None if it does not or another run is profiled, e.g. an outer run of this thread
+        """
+        session = self.session
+        if session is None or session.mode != "cprofile":
+            return None
+        if not _cprofile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as err:
+            # a profiler of another tool is active
+            _cprofile_lock.release()
+            logger.warning(f"Run not profiled: {err}")
+            return None
+        return profile
+
+    def end_run(self, profile: cProfile.Profile | None):
+        """merge the profile of the run and count it, stop when the session has enough runs"""
+        if profile is not None:
+            try:
+                profile.disable()
+            finally:
+                _cprofile_lock.release()
+
+        stop_id = None
+        with self.lock:
+            session = self.session
+            if session is None:
+                return
+            if profile is None and session.mode == "cprofile":
+                session.skipped_runs += 1
+                return
+            if profile is not None:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+            session.runs += 1
+            if session.max_runs is not None and session.runs >= session.max_runs:
+                stop_id = session.id
+
+        if stop_id is not None:
+            self.stop(stop_id)
+
+
+# the profiler of this process, started from /api/profile
+profiler = Profiler()
+
+
+def profiled(fn: Callable) -> Callable:
+    """profile the runs of a cron or background job while a profile of crons is running"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not profiler.wants("crons"):
+            return fn(*args, **kwargs)
+        profile = None
+        try:
+            profile = profiler.begin_run()
+            return fn(*args, **kwargs)
+        finally:
+            profiler.end_run(profile)
+    return wrapper
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling API requests while a profile of requests is running.
+    cProfile runs on the event loop thread, so it sees async routes, and other requests
+    served at the same time. Sync routes run in the threadpool, profile them with the sampling mode.
+    Requests of `exclude_prefix`, i.e. the profile endpoints themselves, are not counted.
+    """
+
+    def __init__(self, app, exclude_prefix: str = "/api/profile"):
+        self.app = app
+        self.exclude_prefix = exclude_prefix
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not profiler.wants("requests")
+            or scope["path"].startswith(self.exclude_prefix)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        profile = None
+        try:
+            profile = profiler.begin_run()
+            await self.app(scope, receive, send)
+        finally:
+            profiler.end_run(profile)
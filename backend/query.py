@@ -0,0 +1,356 @@
+from sqlmodel import Session, select, or_, and_, tuple_, func, literal_column, literal
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import table as sql_table, column as sql_column
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta
+import base64
+import json
+import re
+
+from .models import RSSItem, RSSItemPublic, ProfileScore, RelevanceScore
+
+
+def parse_date(time_since: str | None, default: datetime | None) -> datetime | None:
+    """
+    Parse the time filter of /api/rss.
+    Accepts YYYY-MM-DD, YYYY-MM, number of days, or a unix timestamp.
+    """
+    # choose the time since
+    if time_since is not None:
+        if re.match(r'\d{4}-\d{2}-\d{2}', time_since):
+            time_since_dt = datetime.strptime(time_since, "%Y-%m-%d")
+        elif re.match(r'\d{4}-\d{2}', time_since):
+            time_since_dt = datetime.strptime(time_since, "%Y-%m")
+        elif re.match(r'\d+', time_since):
+            if int(time_since) < 1e8:
+                # if the time since is less than 1e8, treat it as days
+                time_since_dt = datetime.now() - timedelta(days=int(time_since))
+            else:
+                # if the time since is greater than 1e8, treat it as timestamp
+                time_since_dt = datetime.fromtimestamp(int(time_since))
+        else:
+            # default to 7 days
+            time_since_dt = datetime.now() - timedelta(days=7)
+    else:
+        # default to 7 days
+        time_since_dt = default
+    return time_since_dt
+
+
+# FTS5 table created in `database.migrate_db`, joined to rss_items by rowid
+rss_items_fts = sql_table("rss_items_fts", sql_column("rowid"))
+# bm25 is lower for better matches, negate it so that descending means best first
+fts_rank = -func.bm25(literal_column("rss_items_fts"))
+
+
+def fts_query(q: str) -> str:
+    """
+    Quote every word of the user input as a prefix term, so FTS5 syntax can not be injected.
+    Terms are combined by AND.
+    """
+    terms = [term.replace('"', '""') for term in q.split()]
+    return " ".join(f'"{term}"*' for term in terms if term)
+
+
+def order_field(order_by: str | None, q: str | None = None) -> str | None:
+    """the field ordered before published, None if ordered by published only"""
+    if order_by == "rank" and q:
+        return "rank"
+    if order_by is not None and order_by in RSSItemPublic.model_fields and order_by != "published":
+        return order_by
+    return None
+
+
+def order_column(field: str | None):
+    """column expression of the ordered field"""
+    if field is None:
+        return None
+    if field == "rank":
+        return fts_rank
+    if field == "relevance_score":
+        return RelevanceScore.relevance_score
+    return getattr(RSSItem, field)
+
+
+def encode_cursor(item: RSSItemPublic, order_by: str | None, desc: bool, q: str | None = None,
+                  rank: float | None = None) -> str:
+    """
+    Cursor pointing after `item`, in the order of the query.
+    When ordered by rank, the rank of the item is given separately.
+    """
+    field = order_field(order_by, q)
+    if field == "rank":
+        value = rank
+    elif field is not None:
+        value = getattr(item, field)
+    else:
+        value = None
+
+    cursor = {
+        "o": field,
+        "d": desc,
+        "k": [value, item.published.isoformat(), item.uuid],
+    }
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(cursor: str, order_by: str | None, desc: bool, q: str | None = None) -> tuple:
+    """
+    Decode the keys of a cursor, raise ValueError if it is invalid or from another order
+    """
+    try:
+        cursor_obj = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        value, published, item_uuid = cursor_obj["k"]
+        published = datetime.fromisoformat(published)
+    except (ValueError, KeyError, TypeError) as err:
+        raise ValueError(f"Invalid cursor: {cursor}") from err
+
+    if cursor_obj.get("o") != order_field(order_by, q) or cursor_obj.get("d") != desc:
+        raise ValueError("Cursor was created with another order")
+    return value, published, item_uuid
+
+
+def after_cursor(field: str | None, desc: bool, keys: tuple, columns: tuple | None = None):
+    """
+    Condition of rows after the cursor keys (value, published, uuid).
+    NULL scores sort first in SQLite, so they are last in descending order.
+    `columns` are the (value, published, uuid) columns, if not the ones of rss_items.
+    """
+    value, published, item_uuid = keys
+    column, published_column, uuid_column = columns or (order_column(field), RSSItem.published, RSSItem.uuid)
+    tail = tuple_(published_column, uuid_column)
+    tail_keys = tuple_(published, item_uuid)
+
+    if field is None:
+        return tail < tail_keys if desc else tail > tail_keys
+
+    full = tuple_(column, published_column, uuid_column)
+    full_keys = tuple_(value, published, item_uuid)
+    if desc:
+        if value is None:
+            return and_(column.is_(None), tail < tail_keys)
+        return or_(column.is_(None), full < full_keys)
+    else:
+        if value is None:
+            return or_(column.is_not(None), and_(column.is_(None), tail > tail_keys))
+        return and_(column.is_not(None), full > full_keys)
+
+
+def filter_rss_items(selection, sources: list[str] | None, time_since: datetime | None,
+                     time_until: datetime | None, q: str | None = None, columns: tuple | None = None):
+    """
+    Filters of /api/rss shared with the export, None means no filter.
+    `columns` are the (source, published) columns filtered, if not the ones of rss_items.
+    """
+    source_column, published_column = columns or (RSSItem.source, RSSItem.published)
+    if sources is not None:
+        selection = selection.where(source_column.in_(sources))
+    if time_since is not None:
+        selection = selection.where(published_column >= time_since)
+    if time_until is not None:
+        selection = selection.where(published_column <= time_until)
+
+    if q:
+        selection = selection.join(
+            rss_items_fts, rss_items_fts.c.rowid == literal_column("rss_items.rowid")
+        ).where(literal_column("rss_items_fts").op("MATCH")(fts_query(q)))
+    return selection
+
+
+def collapse_duplicates(selection, sources: list[str] | None):
+    """hide near-duplicates whose canonical paper is in the same sources, so each paper is listed once"""
+    canonical = aliased(RSSItem)
+    listed = select(canonical.uuid).where(canonical.uuid == RSSItem.canonical_uuid)
+    if sources is not None:
+        listed = listed.where(canonical.source.in_(sources))
+    return selection.where(or_(RSSItem.canonical_uuid.is_(None), ~listed.exists()))
+
+
+def select_rss_items(
+    sources: list[str],
+    time_since: datetime,
+    time_until: datetime,
+    max_number: int | None = 100,
+    order_by: str | None = "llm_score",
+    desc: bool = True,
+    cursor: str | None = None,
+    q: str | None = None,
+    collapse: bool = False,
+    profile: str | None = None,
+):
+    """
+    Build the query of /api/rss.
+    The filter and order match the composite indexes of RSSItem,
+    see `backend/tests/test_database.py` for the expected query plans.
+    Pages are continued by keyset `cursor` on (order_by, published, uuid), instead of OFFSET,
+    raise ValueError if the cursor is invalid.
+    `q` searches title, summary, authors and LLM comments. Rows are (RSSItem, relevance_score),
+    with `order_by="rank"` they are (RSSItem, relevance_score, rank) ordered by bm25.
+    With `collapse`, near-duplicates are left out for their canonical paper.
+    With a `profile`, its scores are used, see `select_profile_items`.
+    Ordered by relevance_score, papers are read from relevance_scores, see `select_relevance_items`.
+    """
+    field = order_field(order_by, q)
+    if profile is not None:
+        return select_profile_items(profile, sources, time_since, time_until, max_number,
+                                    order_by, desc, cursor, q)
+    if field == "relevance_score":
+        return select_relevance_items(sources, time_since, time_until, max_number,
+                                      order_by, desc, cursor, q, collapse)
+
+    columns = [RSSItem, RelevanceScore.relevance_score]
+    if field == "rank":
+        columns.append(fts_rank.label("rank"))
+    # the score of each listed paper, found by its primary key
+    selection = select(*columns).outerjoin(RelevanceScore, RelevanceScore.item_uuid == RSSItem.uuid)
+
+    selection = filter_rss_items(selection, sources, time_since, time_until, q)
+    if collapse:
+        selection = collapse_duplicates(selection, sources)
+
+    if cursor is not None:
+        keys = decode_cursor(cursor, order_by, desc, q)
+        selection = selection.where(after_cursor(field, desc, keys))
+
+    # order by the field, then by published date and uuid in the same direction,
+    # so that a single index scan in either direction serves the order
+    order_columns = [RSSItem.published, RSSItem.uuid]
+    if field is not None:
+        order_columns.insert(0, order_column(field))
+    return order_and_limit(selection, order_columns, max_number, desc)
+
+
+def select_relevance_items(sources: list[str], time_since: datetime, time_until: datetime,
+                           max_number: int | None, order_by: str | None, desc: bool,
+                           cursor: str | None, q: str | None, collapse: bool):
+    """
+    Query of /api/rss ordered by relevance_score, rows are (RSSItem, relevance_score).
+    Filtered and ordered on relevance_scores by its keyset index, like the scores of a profile.
+    Papers get a row when they are stored, those stored before relevance_scores existed
+    are listed after the first `update_relevance`
+    """
+    selection = (
+        select(RSSItem, RelevanceScore.relevance_score)
+        .join(RelevanceScore, RelevanceScore.item_uuid == RSSItem.uuid)
+    )
+    selection = filter_rss_items(
+        selection, sources, time_since, time_until, q, columns=(RelevanceScore.source, RelevanceScore.published),
+    )
+    if collapse:
+        selection = collapse_duplicates(selection, sources)
+
+    if cursor is not None:
+        keys = decode_cursor(cursor, order_by, desc, q)
+        selection = selection.where(after_cursor(
+            "relevance_score", desc, keys,
+            columns=(RelevanceScore.relevance_score, RelevanceScore.published, RelevanceScore.item_uuid),
+        ))
+
+    order_columns = [RelevanceScore.relevance_score, RelevanceScore.published, RelevanceScore.item_uuid]
+    return order_and_limit(selection, order_columns, max_number, desc)
+
+
+def select_profile_items(profile: str, sources: list[str], time_since: datetime, time_until: datetime,
+                         max_number: int | None, order_by: str | None, desc: bool,
+                         cursor: str | None, q: str | None):
+    """
+    Query of /api/rss for a profile of PROFILES, rows are (RSSItem, score, comments) of the profile.
+    Filtered and ordered on profile_scores, by the partial index of the profile or the published index.
+    Near-duplicates have no profile scores, so they are always collapsed.
+    """
+    field = order_field(order_by, q)
+    if field not in (None, "llm_score"):
+        raise ValueError("Papers of a profile are ordered by llm_score or published")
+
+    selection = (
+        select(RSSItem, ProfileScore.llm_score, ProfileScore.llm_comments)
+        .join(ProfileScore, ProfileScore.item_uuid == RSSItem.uuid)
+        # the name is inlined, SQLite only matches the partial index of the profile to a literal
+        .where(ProfileScore.profile == literal(profile, literal_execute=True))
+    )
+    selection = filter_rss_items(
+        selection, sources, time_since, time_until, q, columns=(ProfileScore.source, ProfileScore.published),
+    )
+
+    if cursor is not None:
+        keys = decode_cursor(cursor, order_by, desc, q)
+        selection = selection.where(after_cursor(
+            field, desc, keys, columns=(ProfileScore.llm_score, ProfileScore.published, ProfileScore.item_uuid),
+        ))
+
+    order_columns = [ProfileScore.published, ProfileScore.item_uuid]
+    if field is not None:
+        order_columns.insert(0, ProfileScore.llm_score)
+    return order_and_limit(selection, order_columns, max_number, desc)
+
+
+def order_and_limit(selection, order_columns: list, max_number: int | None, desc: bool):
+    # limit the number of items, fallback to default number
+    selection = selection.limit(max_number if max_number is not None else 100)
+
+    if desc:
+        selection = selection.order_by(*(column.desc() for column in order_columns))
+    else:
+        selection = selection.order_by(*order_columns)
+
+    return selection
+
+
+def profile_item(item: RSSItem, score: float | None, comments: str | None) -> RSSItemPublic:
+    """a copy of the item with the score of a profile in place of the default one"""
+    return RSSItemPublic.model_validate({**item.model_dump(), "llm_score": score, "llm_comments": comments})
+
+
+def public_item(item: RSSItem, relevance_score: float | None) -> RSSItemPublic:
+    """a copy of the item with its relevance_score"""
+    return RSSItemPublic.model_validate({**item.model_dump(), "relevance_score": relevance_score})
+
+
+def rss_page(rows, max_number: int | None, order_by: str | None, desc: bool,
+             q: str | None, profile: str | None = None) -> tuple[list[RSSItemPublic], str | None]:
+    """items and cursor of the next page, if any, from the rows of `select_rss_items`"""
+    ranked = order_field(order_by, q) == "rank"
+    if profile is not None:
+        items = [profile_item(*row) for row in rows]
+    else:
+        items = [public_item(row[0], row[1]) for row in rows]
+
+    next_cursor = None
+    page_size = max_number if max_number is not None else 100
+    if items and len(items) == page_size:
+        next_cursor = encode_cursor(
+            items[-1], order_by, desc, q, rank=rows[-1][2] if ranked else None
+        )
+    return items, next_cursor
+
+
+def query_rss_page(session: Session, sources: list[str], time_since: datetime, time_until: datetime,
+                   max_number: int | None = 100, order_by: str | None = "llm_score", desc: bool = True,
+                   cursor: str | None = None, q: str | None = None,
+                   collapse: bool = False, profile: str | None = None) -> tuple[list[RSSItemPublic], str | None]:
+    """
+    Run the query of /api/rss, return the items and the cursor of the next page, if any
+    """
+    selection = select_rss_items(
+        sources, time_since, time_until,
+        max_number=max_number, order_by=order_by, desc=desc, cursor=cursor, q=q, collapse=collapse,
+        profile=profile,
+    )
+    rows = session.exec(selection).all()
+    return rss_page(rows, max_number, order_by, desc, q, profile)
+
+
+async def async_query_rss_page(session: AsyncSession, sources: list[str], time_since: datetime, time_until: datetime,
+                               max_number: int | None = 100, order_by: str | None = "llm_score", desc: bool = True,
+                               cursor: str | None = None, q: str | None = None, collapse: bool = False,
+                               profile: str | None = None) -> tuple[list[RSSItemPublic], str | None]:
+    """
+    Same as `query_rss_page`, on an async session
+    """
+    selection = select_rss_items(
+        sources, time_since, time_until,
+        max_number=max_number, order_by=order_by, desc=desc, cursor=cursor, q=q, collapse=collapse,
+        profile=profile,
+    )
+    rows = (await session.exec(selection)).all()
+    return rss_page(rows, max_number, order_by, desc, q, profile)
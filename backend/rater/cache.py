@@ -0,0 +1,62 @@
+import json
+import hashlib
+from datetime import datetime
+from sqlmodel import Session, select, delete
+from ..models import LLMCache
+from ..config import LLM_Config
+from ..database import SQLITE_CHUNK_SIZE
+from ..logger import custom_logger
+
+logger = custom_logger(__name__)
+
+
+def llm_cache_key(prompt: str, llm_config: LLM_Config) -> str:
+    """
+    Hash of everything that determines the LLM response
+    """
+    raw = json.dumps(
+        [llm_config.model_name, llm_config.model_args, prompt],
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def get_cached_responses(session: Session, keys: list[str]) -> dict[str, LLMCache]:
+    """
+    Look up cached responses by keys
+    """
+    unique_keys = list(set(keys))
+    cached = {}
+    for i in range(0, len(unique_keys), SQLITE_CHUNK_SIZE):
+        chunk = unique_keys[i:i + SQLITE_CHUNK_SIZE]
+        for record in session.exec(select(LLMCache).where(LLMCache.key.in_(chunk))).all():
+            cached[record.key] = record
+    return cached
+
+
+def add_cached_response(session: Session, key: str, llm_config: LLM_Config, comment: str, score: float | None):
+    """
+    Add a response to the cache, committed together with the rated papers
+    """
+    if score is None:
+        # invalid responses are not worth keeping
+        return
+    session.merge(LLMCache(key=key, model_name=llm_config.model_name, comment=comment, score=score))
+
+
+def evict_llm_cache(session: Session, model_name: str | None = None, older_than: datetime | None = None) -> int:
+    """
+    Evict cached responses of a model and/or created before a time.
+    Without any condition, the whole cache is cleared.
+    """
+    statement = delete(LLMCache)
+    if model_name is not None:
+        statement = statement.where(LLMCache.model_name == model_name)
+    if older_than is not None:
+        statement = statement.where(LLMCache.created < older_than)
+
+    result = session.exec(statement)
+    session.commit()
+    logger.info(f"Evicted {result.rowcount} cached LLM responses")
+    return result.rowcount
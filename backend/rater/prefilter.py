@@ -0,0 +1,297 @@
+"""
+Local relevance pre-filter, run before the LLM.
+A logistic regression on hashed TF-IDF features of title, summary and journal,
+trained on the papers the LLM already rated. Papers the model is confident to be
+irrelevant get `auto_score` and the `auto_scored` marker instead of an LLM request.
+"""
+from datetime import datetime
+from sqlmodel import Session, select, func
+from typing import Sequence
+import re
+import zlib
+
+import numpy as np
+
+from ..models import RSSItem
+from ..config import AppSettings, Prefilter_Config
+from ..logger import custom_logger
+
+logger = custom_logger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:-[a-z0-9]+)*")
+# a comma separated list of at least this many phrases in the prompt is a keyword list
+MIN_KEYWORDS = 5
+# a `##` section of the prompt whose heading has one of these lists unrelated keywords
+UNRELATED_HEADINGS = ("无关", "不相关", "unrelated", "irrelevant", "not relevant")
+# thresholds of the precision/recall curve in the report
+REPORT_THRESHOLDS = (0.5, 0.7, 0.8, 0.9, 0.95, 0.98, 0.99)
+# full batch Adam, the few hundred steps take seconds on 100k papers
+TRAIN_ITERATIONS = 300
+LEARNING_RATE = 0.05
+L2_PENALTY = 1e-5
+
+
+def paper_text(title: str, summary: str) -> str:
+    return f"{title} {title} {summary}"
+
+
+def prompt_keywords(prompt: str) -> tuple[list[str], list[str]]:
+    """
+    Phrases of the comma separated keyword lists in the prompt, split by its `##` sections
+    into related and unrelated keywords, by the heading of the section
+    """
+    related, unrelated = [], []
+    keywords = related
+    for line in prompt.splitlines():
+        if line.lstrip().startswith("#"):
+            heading = line.strip("# \t").lower()
+            keywords = unrelated if any(marker in heading for marker in UNRELATED_HEADINGS) else related
+            continue
+        phrases = [phrase.strip() for phrase in line.split(",") if phrase.strip()]
+        if len(phrases) >= MIN_KEYWORDS:
+            keywords.extend(phrases)
+    return related, unrelated
+
+
+class HashingTfidf:
+    """
+    Words and word bigrams hashed into `n_features` columns, weighted by sublinear TF and IDF,
+    rows normalized to unit length. The sparse matrix is kept as COO arrays.
+    """
+
+    def __init__(self, n_features: int):
+        self.n_features = n_features
+        self.idf = np.ones(n_features)
+        # token hashes are stable across processes, unlike hash()
+        self._columns: dict[str, int] = {}
+
+    def column(self, token: str) -> int:
+        col = self._columns.get(token)
+        if col is None:
+            col = self._columns[token] = zlib.crc32(token.encode()) % self.n_features
+        return col
+
+    def tokens(self, text: str, source: str) -> list[str]:
+        words = TOKEN_PATTERN.findall(text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])] + [f"source:{source}"]
+
+    def counts(self, docs: Sequence[tuple[str, str]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """rows, columns and counts of the (text, source) documents, duplicates summed"""
+        rows, cols = [], []
+        for row, (text, source) in enumerate(docs):
+            doc_cols = [self.column(token) for token in self.tokens(text, source)]
+            cols.extend(doc_cols)
+            rows.extend([row] * len(doc_cols))
+
+        keys = np.asarray(rows, dtype=np.int64) * self.n_features + np.asarray(cols, dtype=np.int64)
+        keys, counts = np.unique(keys, return_counts=True)
+        return keys // self.n_features, keys % self.n_features, counts
+
+    def fit(self, docs: Sequence[tuple[str, str]]) -> "HashingTfidf":
+        _, cols, _ = self.counts(docs)
+        document_frequency = np.bincount(cols, minlength=self.n_features)
+        self.idf = np.log((1 + len(docs)) / (1 + document_frequency)) + 1
+        return self
+
+    def transform(self, docs: Sequence[tuple[str, str]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        rows, cols, counts = self.counts(docs)
+        values = (1 + np.log(counts)) * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=len(docs)))
+        return rows, cols, values / norms[rows]
+
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-np.clip(x, -30, 30)))
+
+
+class RelevancePrefilter:
+    """logistic regression of P(irrelevant), on the sparse COO rows of `HashingTfidf`"""
+
+    def __init__(self, prefilter_config: Prefilter_Config):
+        self.config = prefilter_config
+        self.vectorizer = HashingTfidf(prefilter_config.n_features)
+        self.weights = np.zeros(prefilter_config.n_features)
+        self.bias = 0.0
+        self.report: dict = {}
+        self.n_rated = 0
+        # the rating prompt of the training labels
+        self.prompt = ""
+
+    @property
+    def active(self) -> bool:
+        """
+        Only trusted if the precision on held-out papers is high enough,
+        measured on enough skipped papers. Skipping none of them proves nothing.
+        """
+        precision = self.report.get("precision")
+        return bool(
+            precision is not None and precision >= self.config.min_precision
+            and self.report.get("n_skipped", 0) >= self.config.min_holdout_skipped
+        )
+
+    def decision(self, rows, cols, values, n_docs: int) -> np.ndarray:
+        return np.bincount(rows, weights=values * self.weights[cols], minlength=n_docs) + self.bias
+
+    def fit(self, docs: list[tuple[str, str]], irrelevant: np.ndarray, sample_weight: np.ndarray):
+        """
+        Minimize the weighted log loss with full batch Adam.
+        Only the columns used by the documents are trained, the bias is the last parameter.
+        """
+        self.vectorizer.fit(docs)
+        rows, cols, values = self.vectorizer.transform(docs)
+        used, cols = np.unique(cols, return_inverse=True)
+        n_docs, n_used = len(docs), len(used)
+        sample_weight = sample_weight / sample_weight.sum()
+
+        params = np.zeros(n_used + 1)
+        moment, velocity = np.zeros_like(params), np.zeros_like(params)
+        beta1, beta2 = 0.9, 0.999
+        for step in range(1, TRAIN_ITERATIONS + 1):
+            decision = np.bincount(rows, weights=values * params[cols], minlength=n_docs) + params[-1]
+            residual = (sigmoid(decision) - irrelevant) * sample_weight
+            gradient = np.append(
+                np.bincount(cols, weights=values * residual[rows], minlength=n_used) + L2_PENALTY * params[:-1],
+                residual.sum(),
+            )
+            moment = beta1 * moment + (1 - beta1) * gradient
+            velocity = beta2 * velocity + (1 - beta2) * gradient ** 2
+            params -= LEARNING_RATE * (moment / (1 - beta1 ** step)) / (
+                np.sqrt(velocity / (1 - beta2 ** step)) + 1e-8
+            )
+
+        self.weights = np.zeros(self.config.n_features)
+        self.weights[used] = params[:-1]
+        self.bias = float(params[-1])
+        return self
+
+    def predict_proba(self, docs: Sequence[tuple[str, str]]) -> np.ndarray:
+        """probability of each (text, source) document to be irrelevant"""
+        if not docs:
+            return np.zeros(0)
+        rows, cols, values = self.vectorizer.transform(docs)
+        return sigmoid(self.decision(rows, cols, values, len(docs)))
+
+    def paper_proba(self, papers: Sequence[RSSItem]) -> np.ndarray:
+        return self.predict_proba([(paper_text(paper.title, paper.summary), paper.source) for paper in papers])
+
+    def evaluate(self, docs: list[tuple[str, str]], irrelevant: np.ndarray) -> dict:
+        """
+        precision and recall of auto-scoring as irrelevant, at the configured and other thresholds.
+        The precision is None if no held-out paper would be skipped
+        """
+        proba = self.predict_proba(docs)
+
+        def at(threshold: float) -> dict:
+            skipped = proba >= threshold
+            true_skipped = int((skipped & irrelevant).sum())
+            return {
+                "threshold": threshold,
+                "precision": true_skipped / int(skipped.sum()) if skipped.any() else None,
+                "n_skipped": int(skipped.sum()),
+                "recall": true_skipped / int(irrelevant.sum()) if irrelevant.any() else 0.0,
+                "skipped": float(skipped.mean()) if len(docs) else 0.0,
+            }
+
+        return {
+            **at(self.config.threshold),
+            "curve": [at(threshold) for threshold in REPORT_THRESHOLDS],
+        }
+
+
+def rated_count(session: Session) -> int:
+    """papers rated by the LLM, the training data of the pre-filter"""
+    return session.exec(
+        select(func.count()).select_from(RSSItem)
+        .where(RSSItem.llm_score.is_not(None), RSSItem.auto_scored.is_not(True))
+    ).one()
+
+
+def train_prefilter(session: Session, config: AppSettings) -> RelevancePrefilter | None:
+    """
+    Train on the LLM ratings, with a held-out split by uuid hash for the report.
+    Related keywords of the prompt are added as relevant examples, so papers on them are less likely skipped,
+    unrelated keywords as irrelevant examples.
+    None if there are too few ratings or only one class.
+    """
+    prefilter_config = config.PREFILTER
+    records = session.exec(
+        select(RSSItem.uuid, RSSItem.title, RSSItem.summary, RSSItem.source, RSSItem.llm_score)
+        .where(RSSItem.llm_score.is_not(None), RSSItem.auto_scored.is_not(True))
+    ).all()
+    if len(records) < prefilter_config.min_samples:
+        logger.info(f"Pre-filter not trained, {len(records)} rated papers < {prefilter_config.min_samples}")
+        return None
+
+    docs = [(paper_text(title, summary), source) for _, title, summary, source, _ in records]
+    irrelevant = np.array([score < prefilter_config.irrelevant_below for *_, score in records])
+    holdout = np.array([
+        zlib.crc32(item_uuid.encode()) % 100 < prefilter_config.holdout * 100 for item_uuid, *_ in records
+    ])
+    if irrelevant[~holdout].all() or not irrelevant[~holdout].any():
+        logger.info("Pre-filter not trained, the ratings have a single class")
+        return None
+
+    # classes are balanced, so the bias does not just follow the share of irrelevant papers
+    train_docs = [doc for doc, held in zip(docs, holdout) if not held]
+    train_labels = irrelevant[~holdout]
+    sample_weight = np.where(train_labels, 0.5 / train_labels.mean(), 0.5 / (1 - train_labels.mean()))
+
+    related, unrelated = prompt_keywords(config.LLM_API.prompt)
+    train_docs += [(keyword, "") for keyword in related + unrelated]
+    train_labels = np.concatenate(
+        [train_labels, np.zeros(len(related), dtype=bool), np.ones(len(unrelated), dtype=bool)]
+    )
+    sample_weight = np.concatenate([sample_weight, np.ones(len(related) + len(unrelated))])
+
+    start = datetime.now()
+    prefilter = RelevancePrefilter(prefilter_config).fit(train_docs, train_labels, sample_weight)
+    prefilter.n_rated = len(records)
+    prefilter.prompt = config.LLM_API.prompt
+    prefilter.report = {
+        "trained": start.isoformat(),
+        "train_seconds": (datetime.now() - start).total_seconds(),
+        "n_train": len(train_docs),
+        "n_holdout": int(holdout.sum()),
+        "n_keywords": len(related),
+        "n_unrelated_keywords": len(unrelated),
+        **prefilter.evaluate([doc for doc, held in zip(docs, holdout) if held], irrelevant[holdout]),
+    }
+    prefilter.report["active"] = prefilter.active
+    precision = prefilter.report["precision"]
+    logger.info(
+        f"Pre-filter trained on {len(train_docs)} papers: "
+        f"precision {'n/a' if precision is None else f'{precision:.3f}'}, "
+        f"recall {prefilter.report['recall']:.3f}, {prefilter.report['n_skipped']} held-out papers skipped "
+        f"at threshold {prefilter_config.threshold}, {'active' if prefilter.active else 'not active'}"
+    )
+    return prefilter
+
+
+# the last trained pre-filter, retrained as ratings accumulate
+_prefilter: RelevancePrefilter | None = None
+
+
+def trained_prefilter(session: Session, config: AppSettings, retrain: bool = False) -> RelevancePrefilter | None:
+    """
+    The last trained pre-filter, enabled or not.
+    Retrained when the LLM ratings grew by `retrain_growth` since the last training,
+    or the settings or the rating prompt changed, as the labels and prompt keywords depend on it.
+    """
+    global _prefilter
+    prefilter_config = config.PREFILTER
+    n_rated = rated_count(session)
+    if (
+        retrain or _prefilter is None or _prefilter.config != prefilter_config
+        or _prefilter.prompt != config.LLM_API.prompt
+        or n_rated > _prefilter.n_rated * (1 + prefilter_config.retrain_growth)
+    ):
+        _prefilter = train_prefilter(session, config)
+    return _prefilter
+
+
+def load_prefilter(session: Session, config: AppSettings) -> RelevancePrefilter | None:
+    """the pre-filter to rate with, if enabled and trusted by its held-out precision"""
+    if not config.PREFILTER.enabled:
+        return None
+    prefilter = trained_prefilter(session, config)
+    return prefilter if prefilter is not None and prefilter.active else None
@@ -0,0 +1,151 @@
+"""
+Rating of the named profiles of PROFILES, besides the default profile of LLM_API stored in rss_items.
+Papers are fetched and stored once, their scores are kept per (paper, profile) in profile_scores,
+where rows without a score are the papers still to be rated for the profile.
+"""
+from datetime import datetime, timedelta
+from sqlmodel import Session, select, update, tuple_, literal
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import asyncio
+
+import httpx
+
+from ..models import RSSItem, ProfileScore
+from ..config import AppSettings, Profile_Config
+from ..response_cache import bump_version
+from ..database import create_profile_indexes
+from ..logger import custom_logger
+from .ratelimit import RateLimiter
+from .req_openai_compat import rate_papers_async, LLMResponse
+
+logger = custom_logger(__name__)
+
+
+def add_profile_papers(session: Session, config: AppSettings) -> dict[str, int]:
+    """
+    Papers published in the backfill window of each profile get a row to be rated, if they have none.
+    Near-duplicates are left out, they are listed with their canonical paper. Not committed
+    """
+    added = {}
+    for name, profile in config.PROFILES.items():
+        since = datetime.now() - timedelta(days=profile.backfill_days)
+        papers = select(RSSItem.uuid, literal(name), RSSItem.published, RSSItem.source).where(
+            RSSItem.published >= since, RSSItem.canonical_uuid.is_(None)
+        )
+        statement = sqlite_insert(ProfileScore).from_select(
+            ["item_uuid", "profile", "published", "source"], papers
+        ).on_conflict_do_nothing()
+        added[name] = session.exec(statement).rowcount
+    return added
+
+
+def pending_papers(session: Session, name: str, batch_size: int, max_attempts: int,
+                   after: tuple[datetime, str] | None = None) -> list[RSSItem]:
+    """
+    Unrated papers of a profile, newest first, continued after the (published, uuid) of the last batch.
+    Copies are returned, rating them does not touch the default scores in rss_items
+    """
+    selection = (
+        select(RSSItem)
+        .join(ProfileScore, ProfileScore.item_uuid == RSSItem.uuid)
+        .where(
+            ProfileScore.profile == name,
+            ProfileScore.llm_score.is_(None),
+            ProfileScore.attempts < max_attempts,
+        )
+        .order_by(ProfileScore.published.desc(), ProfileScore.item_uuid.desc())
+        .limit(batch_size)
+    )
+    if after is not None:
+        selection = selection.where(tuple_(ProfileScore.published, ProfileScore.item_uuid) < tuple_(*after))
+    return [
+        RSSItem.model_validate({**paper.model_dump(), "llm_score": None, "llm_comments": ""})
+        for paper in session.exec(selection).all()
+    ]
+
+
+def save_profile_scores(session: Session, name: str, results: dict[str, LLMResponse | None]):
+    """write the scores of a batch, papers without one count an attempt"""
+    scored = [
+        {"item_key": item_uuid, "profile_key": name, "score": resp.score, "comment": resp.comment}
+        for item_uuid, resp in results.items() if resp is not None and resp.score is not None
+    ]
+    failed = [
+        {"item_key": item_uuid, "profile_key": name}
+        for item_uuid, resp in results.items() if resp is None or resp.score is None
+    ]
+    row = (ProfileScore.item_uuid == bindparam("item_key")) & (ProfileScore.profile == bindparam("profile_key"))
+    conn = session.connection()
+    if scored:
+        conn.execute(
+            update(ProfileScore).where(row)
+            .values(llm_score=bindparam("score"), llm_comments=bindparam("comment")),
+            scored,
+        )
+    if failed:
+        conn.execute(update(ProfileScore).where(row).values(attempts=ProfileScore.attempts + 1), failed)
+    session.commit()
+    if scored:
+        bump_version("data")
+
+
+async def rate_profile(session: Session, name: str, profile: Profile_Config, config: AppSettings,
+                       client: httpx.AsyncClient, limiter: RateLimiter) -> dict:
+    """rate the pending papers of one profile batch by batch, each paper at most once per call"""
+    profile_config = config.model_copy(update={"LLM_API": profile.llm_config(config.LLM_API)})
+    queue_config = config.RATING_QUEUE
+    counts = {"rated": 0, "failed": 0}
+
+    after = None
+    while papers := pending_papers(session, name, queue_config.batch_size, queue_config.max_attempts, after):
+        after = (papers[-1].published, papers[-1].uuid)
+        results: dict[str, LLMResponse | None] = {}
+        await rate_papers_async(
+            papers, profile_config, use_cache=False, client=client, limiter=limiter,
+            on_rated=lambda paper, resp: results.__setitem__(paper.uuid, resp),
+        )
+        save_profile_scores(session, name, results)
+
+        n_rated = sum(resp is not None and resp.score is not None for resp in results.values())
+        counts["rated"] += n_rated
+        counts["failed"] += len(papers) - n_rated
+    return counts
+
+
+async def rate_profiles_async(session: Session, config: AppSettings,
+                              transport: httpx.AsyncBaseTransport | None = None) -> dict[str, dict]:
+    """
+    Rate the new papers of all profiles concurrently.
+    Profiles share one client and rate limiter, sized by LLM_API, as they use the same API.
+    `transport` is only used to replace the network in tests.
+    """
+    if not config.PROFILES:
+        return {}
+    # profiles added to the config get their index before their papers
+    create_profile_indexes(session.connection(), config.PROFILES)
+    added = add_profile_papers(session, config)
+    session.commit()
+
+    llm_config = config.LLM_API
+    limiter = RateLimiter(llm_config.requests_per_minute, llm_config.tokens_per_minute)
+    limits = httpx.Limits(max_connections=llm_config.max_concurrency)
+    # requests of all profiles wait for a connection of the shared pool, without a timeout
+    timeout = httpx.Timeout(llm_config.timeout, pool=None)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout, transport=transport) as client:
+        counts = await asyncio.gather(*(
+            rate_profile(session, name, profile, config, client, limiter)
+            for name, profile in config.PROFILES.items()
+        ))
+
+    results = {name: {"added": added[name], **count} for name, count in zip(config.PROFILES, counts)}
+    logger.info(f"Profiles rated: {results}")
+    return results
+
+
+def rate_profiles(session: Session, config: AppSettings) -> dict[str, dict]:
+    """
+    Rate the new papers of all profiles.
+    Must be called from a thread without a running event loop.
+    """
+    return asyncio.run(rate_profiles_async(session, config))
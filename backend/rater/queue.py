@@ -0,0 +1,92 @@
+from datetime import datetime
+from sqlmodel import Session, select, delete, or_, and_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from ..models import RSSItem, RatingQueue
+from ..config import AppSettings
+from ..database import SQLITE_CHUNK_SIZE
+from ..logger import custom_logger
+from .req_openai_compat import rate_papers
+from .prefilter import load_prefilter
+
+logger = custom_logger(__name__)
+
+
+def enqueue_papers(session: Session, uuids: list[str]):
+    """
+    Add papers to the rating queue, committed together with the papers themselves
+    """
+    now = datetime.now()
+    uuids = list(uuids)
+    # one statement per chunk, papers queued again start over
+    for start in range(0, len(uuids), SQLITE_CHUNK_SIZE):
+        statement = sqlite_insert(RatingQueue).values([
+            {"item_uuid": item_uuid, "enqueued": now, "attempts": 0}
+            for item_uuid in uuids[start:start + SQLITE_CHUNK_SIZE]
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=["item_uuid"],
+            set_={"enqueued": statement.excluded.enqueued, "attempts": 0},
+        )
+        session.exec(statement)
+
+
+def drain_rating_queue(session: Session, config: AppSettings) -> dict:
+    """
+    Rate queued papers batch by batch until the queue is empty.
+    Rated papers leave the queue, failed ones are retried up to `max_attempts`.
+    Each entry is tried at most once per call.
+    """
+    queue_config = config.RATING_QUEUE
+    rated_count = 0
+    failed_count = 0
+
+    base_selection = (
+        select(RatingQueue)
+        .where(RatingQueue.attempts < queue_config.max_attempts)
+        .order_by(RatingQueue.enqueued, RatingQueue.item_uuid)
+        .limit(queue_config.batch_size)
+    )
+    prefilter = load_prefilter(session, config)
+    selection = base_selection
+    while True:
+        entries = session.exec(selection).all()
+        if not entries:
+            break
+
+        # failed entries stay in the queue, continue after the last one
+        last = entries[-1]
+        selection = base_selection.where(or_(
+            RatingQueue.enqueued > last.enqueued,
+            and_(RatingQueue.enqueued == last.enqueued, RatingQueue.item_uuid > last.item_uuid),
+        ))
+
+        uuids = [entry.item_uuid for entry in entries]
+        papers = [
+            paper
+            for start in range(0, len(uuids), SQLITE_CHUNK_SIZE)
+            for paper in session.exec(
+                select(RSSItem).where(RSSItem.uuid.in_(uuids[start:start + SQLITE_CHUNK_SIZE]))
+            ).all()
+        ]
+        rate_papers(papers, config, rerate=False, session=session, prefilter=prefilter)
+
+        # papers removed from database, or rated elsewhere, also leave the queue
+        done = {paper.uuid for paper in papers if paper.llm_score is not None}
+        done.update(set(uuids) - {paper.uuid for paper in papers})
+        for entry in entries:
+            if entry.item_uuid not in done:
+                entry.attempts += 1
+                session.add(entry)
+        done_list = list(done)
+        for start in range(0, len(done_list), SQLITE_CHUNK_SIZE):
+            session.exec(delete(RatingQueue).where(
+                RatingQueue.item_uuid.in_(done_list[start:start + SQLITE_CHUNK_SIZE])
+            ))
+        session.commit()
+
+        rated_count += len(done)
+        failed_count += len(entries) - len(done)
+
+    if rated_count or failed_count:
+        logger.info(f"Rating queue drained: {rated_count} done, {failed_count} failed")
+    return {"rated": rated_count, "failed": failed_count}
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Async token bucket, refilled continuously at `rate_per_minute`.
+    The bucket may go into debt when the real cost turns out higher than estimated,
+    later acquirers then wait until it is paid back.
+    """
+
+    def __init__(self, rate_per_minute: float | None):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = rate_per_minute or 0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    @property
+    def unlimited(self) -> bool:
+        return not self.rate_per_minute
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate_per_minute / 60
+        )
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        """wait until `amount` tokens are available and take them"""
+        if self.unlimited:
+            return
+        # a single request larger than the bucket could never be served otherwise
+        amount = min(amount, self.capacity)
+
+        # the lock keeps waiters in FIFO order
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) * 60 / self.rate_per_minute)
+
+    def adjust(self, amount: float):
+        """take (or give back if negative) tokens without waiting"""
+        if self.unlimited:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter:
+    """requests/min and tokens/min limits of one LLM endpoint"""
+
+    def __init__(self, requests_per_minute: float | None, tokens_per_minute: float | None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def acquire(self, estimated_tokens: float):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimated_tokens)
+
+    def settle(self, estimated_tokens: float, used_tokens: float):
+        """correct the token bucket once the real usage is known"""
+        self.tokens.adjust(used_tokens - estimated_tokens)
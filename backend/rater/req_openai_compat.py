@@ -1,19 +1,37 @@
 # from openai import OpenAI
 import httpx
+import asyncio
+import random
+import json
+import time
+from contextlib import nullcontext
 from ..models import RSSItem, AllowExtraModel
-from ..config import AppSettings, LLM_Config, get_config
+from ..config import AppSettings, LLM_Config
 from sqlmodel import Session, select
 from pydantic import BaseModel, ValidationError
 from ..logger import custom_logger
-from typing import Sequence
+from typing import Sequence, Callable
+from .ratelimit import RateLimiter
+from .cache import llm_cache_key, get_cached_responses, add_cached_response
+from .prefilter import RelevancePrefilter, load_prefilter
+from ..response_cache import bump_version
+from ..dedup import copy_canonical_ratings
+from ..relevance import refresh_relevance
+from ..metrics import LLM_REQUEST_SECONDS, LLM_TOKENS, RATINGS
 
-config = get_config()
-logger = custom_logger(__name__, debug=config.DEBUG)
+logger = custom_logger(__name__)
 
 class LLMResponse(BaseModel):
     comment: str
     score: float | None
 
+class BatchLLMItem(BaseModel):
+    # papers are identified by index, or by link if the model echoes it
+    index: int | None = None
+    link: str | None = None
+    comment: str
+    score: float | None
+
 class SiliconflowMessageScheme(AllowExtraModel):
     role: str
     content: str
@@ -35,6 +53,13 @@ class SiliconflowResponseScheme(AllowExtraModel):
     usage: SiliconflowUsageScheme
 
 
+def record_usage(resp_obj: SiliconflowResponseScheme):
+    """count the tokens of a response, by the model that answered"""
+    usage = resp_obj.usage
+    LLM_TOKENS.inc(usage.prompt_tokens, model=resp_obj.model, kind="prompt")
+    LLM_TOKENS.inc(usage.completion_tokens, model=resp_obj.model, kind="completion")
+
+
 def generate_prompt(paper: RSSItem, llm_config: LLM_Config):
     """
     Generate the prompt for OpenAI API
@@ -45,9 +70,20 @@ def generate_prompt(paper: RSSItem, llm_config: LLM_Config):
     return prompt
 
 
-def request_llm_response(prompt: str, llm_config: LLM_Config):
+def generate_batch_prompt(papers: Sequence[RSSItem], llm_config: LLM_Config):
     """
-    Request the LLM response based on httpx client
+    Generate one prompt for several papers, the instructions are sent only once
+    """
+    papers_text = "\n".join(
+        llm_config.batch_paper_template.format(index=index, **paper.model_dump())
+        for index, paper in enumerate(papers)
+    )
+    return llm_config.batch_prompt.format(papers=papers_text)
+
+
+def llm_request_args(prompt: str, llm_config: LLM_Config):
+    """
+    url, headers and payload of a chat completion request
     """
     url = llm_config.base_url + "/chat/completions"
     messages = [
@@ -63,26 +99,96 @@ def request_llm_response(prompt: str, llm_config: LLM_Config):
         "Authorization": f"Bearer {llm_config.api_key}",
         "Content-Type": "application/json"
     }
+    return url, headers, payload
+
+
+def request_llm_response(prompt: str, llm_config: LLM_Config):
+    """
+    Request the LLM response based on httpx client
+    """
+    url, headers, payload = llm_request_args(prompt, llm_config)
 
+    start = time.perf_counter()
     resp = httpx.request(
         "POST",
         url,
         headers=headers,
         json=payload,
-        timeout=60,
+        timeout=llm_config.timeout,
     )
+    LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, model=llm_config.model_name, status=resp.status_code)
 
     if resp.status_code != 200:
         logger.warning(f"OpenAI API request failed: {resp.status_code}, {resp.text}")
-        raise httpx.HTTPStatusError(f"OpenAI API request failed: {resp.status_code}, {resp.text}")
+        raise httpx.HTTPStatusError(
+            f"OpenAI API request failed: {resp.status_code}, {resp.text}",
+            request=resp.request,
+            response=resp,
+        )
 
     # TODO validate 
     resp_json = resp.json()
     resp_obj = SiliconflowResponseScheme.model_validate(resp_json)
+    record_usage(resp_obj)
 
     return resp_obj
 
 
+def parse_llm_response(resp_raw: SiliconflowResponseScheme) -> LLMResponse:
+    """
+    Parse the message content as LLMResponse, keep the raw message as comment if invalid
+    """
+    logger.debug(f"OpenAI response: {resp_raw}")
+    resp_msg = resp_raw.choices[0].message.content
+
+    try:
+        resp = LLMResponse.model_validate_json(resp_msg)
+    except ValidationError as err:
+        logger.warning(f"Validation error: {err}, response: {resp_msg}")
+
+        return LLMResponse(comment=resp_msg, score=None)
+
+    return resp
+
+
+def parse_batch_llm_response(resp_raw: SiliconflowResponseScheme, papers: Sequence[RSSItem]) -> dict[int, LLMResponse]:
+    """
+    Map the results of a batch response back to paper indices.
+    Only valid and scored results are kept, the caller decides what to do with the rest.
+    """
+    logger.debug(f"OpenAI batch response: {resp_raw}")
+    resp_msg = resp_raw.choices[0].message.content
+
+    try:
+        resp_json = json.loads(resp_msg)
+    except json.JSONDecodeError as err:
+        logger.warning(f"Batch response is not JSON: {err}, response: {resp_msg}")
+        return {}
+
+    # json_object mode requires an object, but a bare array is also accepted
+    if isinstance(resp_json, dict):
+        resp_json = resp_json.get("results", [])
+    if not isinstance(resp_json, list):
+        logger.warning(f"Batch response has no result list: {resp_msg}")
+        return {}
+
+    link_index = {paper.link: index for index, paper in enumerate(papers)}
+    results = {}
+    for raw_item in resp_json:
+        try:
+            item = BatchLLMItem.model_validate(raw_item)
+        except ValidationError as err:
+            logger.warning(f"Validation error in batch item: {err}, item: {raw_item}")
+            continue
+
+        index = link_index.get(item.link, item.index)
+        if index is None or not 0 <= index < len(papers) or item.score is None:
+            continue
+        results[index] = LLMResponse(comment=item.comment, score=item.score)
+
+    return results
+
+
 def get_openai_response(paper: RSSItem, config: AppSettings):
     """
     Get the response from OpenAI API
@@ -100,56 +206,336 @@ def get_openai_response(paper: RSSItem, config: AppSettings):
     #     **llm_config.model_args,
     # )
     resp_raw = request_llm_response(prompt, llm_config)
-    logger.debug(f"OpenAI response: {resp_raw}")
-    resp_msg = resp_raw.choices[0].message.content
+    return parse_llm_response(resp_raw)
 
-    try:
-        resp = LLMResponse.model_validate_json(resp_msg)
-    except ValidationError as err:
-        logger.warning(f"Validation error: {err}, response: {resp_msg}")
 
-        return LLMResponse(comment=resp_msg, score=None)
+# concurrent rating engine
+# ==========================
+def estimate_tokens(prompt: str, llm_config: LLM_Config, n_papers: int = 1) -> int:
+    """
+    Upper estimation of tokens used by a request, before the real usage is known.
+    CJK characters are about one token each, so we count characters.
+    """
+    return len(prompt) + llm_config.model_args.get("max_tokens", 256 * n_papers)
+
+
+def retry_delay(attempt: int, resp: httpx.Response | None = None) -> float:
+    """
+    Seconds to wait before a retry, prefer Retry-After of the server
+    """
+    if resp is not None:
+        retry_after = resp.headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return min(2 ** attempt, 60) + random.uniform(0, 1)
 
-    return resp
 
+# errors of a single request, the paper is counted as failed and the others are rated.
+# a body that is not JSON raises ValueError, a completion without choices IndexError
+REQUEST_ERRORS = (httpx.HTTPError, ValidationError, ValueError, IndexError, KeyError)
 
-def rate_papers(papers: Sequence[RSSItem], config: AppSettings, rerate: bool = False, session: Session | None = None):
-    """ """
-    rated_papers = []
+
+async def async_request_llm_response(
+    client: httpx.AsyncClient, prompt: str, llm_config: LLM_Config, limiter: RateLimiter, n_papers: int = 1
+) -> SiliconflowResponseScheme:
+    """
+    Request the LLM response on a shared async client, respecting the rate limits.
+    Retry on 429, 5xx and network errors.
+    """
+    url, headers, payload = llm_request_args(prompt, llm_config)
+    estimated_tokens = estimate_tokens(prompt, llm_config, n_papers)
+
+    for attempt in range(llm_config.max_retries + 1):
+        await limiter.acquire(estimated_tokens)
+        start = time.perf_counter()
+        try:
+            resp = await client.post(url, headers=headers, json=payload)
+        except httpx.TransportError as err:
+            LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, model=llm_config.model_name, status="error")
+            limiter.settle(estimated_tokens, 0)
+            if attempt >= llm_config.max_retries:
+                raise
+            delay = retry_delay(attempt)
+            logger.warning(f"OpenAI API request error: {err!r}, retry in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, model=llm_config.model_name, status=resp.status_code)
+        if resp.status_code == 200:
+            resp_obj = SiliconflowResponseScheme.model_validate(resp.json())
+            limiter.settle(estimated_tokens, resp_obj.usage.total_tokens)
+            record_usage(resp_obj)
+            return resp_obj
+
+        limiter.settle(estimated_tokens, 0)
+        retryable = resp.status_code == 429 or resp.status_code >= 500
+        if not retryable or attempt >= llm_config.max_retries:
+            logger.warning(f"OpenAI API request failed: {resp.status_code}, {resp.text}")
+            raise httpx.HTTPStatusError(
+                f"OpenAI API request failed: {resp.status_code}, {resp.text}",
+                request=resp.request,
+                response=resp,
+            )
+
+        delay = retry_delay(attempt, resp)
+        logger.info(f"OpenAI API returned {resp.status_code}, retry in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+async def async_get_openai_response(
+    client: httpx.AsyncClient, paper: RSSItem, config: AppSettings, limiter: RateLimiter
+) -> LLMResponse:
+    """
+    Async version of `get_openai_response`
+    """
+    logger.info(f"Getting LLM response for paper: {paper.title}")
+
+    llm_config = config.LLM_API
+    prompt = generate_prompt(paper, llm_config)
+    resp_raw = await async_request_llm_response(client, prompt, llm_config, limiter)
+    return parse_llm_response(resp_raw)
+
+
+async def async_get_batch_openai_response(
+    client: httpx.AsyncClient, papers: Sequence[RSSItem], config: AppSettings, limiter: RateLimiter
+) -> dict[int, LLMResponse]:
+    """
+    Rate several papers in one request, results are keyed by paper index
+    """
+    logger.info(f"Getting LLM response for a batch of {len(papers)} papers")
+
+    llm_config = config.LLM_API
+    prompt = generate_batch_prompt(papers, llm_config)
+    resp_raw = await async_request_llm_response(client, prompt, llm_config, limiter, n_papers=len(papers))
+    return parse_batch_llm_response(resp_raw, papers)
+
+
+def commit_papers(session: Session, papers: list[RSSItem]):
+    """
+    write rated papers back, invalidating cached API responses.
+    relevance_score is cleared, to be computed again from the new rating by `update_relevance`.
+    Near-duplicates of the papers get the same rating
+    """
+    session.add_all(papers)
+    session.flush()
+    refresh_relevance(session, [paper.uuid for paper in papers])
+    copy_canonical_ratings(session, [paper.uuid for paper in papers])
+    session.commit()
+    bump_version("data")
+
+
+async def rate_papers_async(
+    papers: Sequence[RSSItem],
+    config: AppSettings,
+    rerate: bool = False,
+    session: Session | None = None,
+    use_cache: bool = True,
+    transport: httpx.AsyncBaseTransport | None = None,
+    on_rated: Callable[[RSSItem, LLMResponse | None], None] | None = None,
+    prefilter: RelevancePrefilter | None = None,
+    client: httpx.AsyncClient | None = None,
+    limiter: RateLimiter | None = None,
+):
+    """
+    Rate papers with bounded concurrency on one pooled client.
+    With a session, identical prompts are answered from the LLM cache before any request.
+    With a `prefilter`, papers it is confident to be irrelevant are auto-scored instead of requested.
+    Results are committed every `commit_batch_size` papers, failed papers are left unrated.
+    `on_rated(paper, response)` is called for every paper as soon as it is rated,
+    with None as response if it failed.
+    A `client` and `limiter` can be shared by concurrent runs against the same API, they are not closed.
+    `transport` is only used to replace the network in tests.
+    """
+    llm_config = config.LLM_API
+    if limiter is None:
+        limiter = RateLimiter(llm_config.requests_per_minute, llm_config.tokens_per_minute)
+    semaphore = asyncio.Semaphore(llm_config.max_concurrency)
+
+    to_rate = []
     for ipaper, paper in enumerate(papers):
         if not rerate and paper.llm_score is not None:
             # This paper is already rated
             logger.debug(f"Paper #{ipaper}: {paper.link} already rated, skipping")
             continue
+        to_rate.append(paper)
+
+    # look up the cache first
+    use_cache = use_cache and session is not None
+    cache_keys = {}
+    if use_cache:
+        cache_keys = {
+            paper.uuid: llm_cache_key(generate_prompt(paper, llm_config), llm_config)
+            for paper in to_rate
+        }
+        cached = get_cached_responses(session, list(cache_keys.values()))
+
+        to_request = []
+        for paper in to_rate:
+            record = cached.get(cache_keys[paper.uuid])
+            if record is None:
+                to_request.append(paper)
+                continue
+            paper.llm_comments = record.comment
+            paper.llm_score = record.score
+            paper.auto_scored = False
+
+        cached_papers = [paper for paper in to_rate if cache_keys[paper.uuid] in cached]
+        if cached_papers:
+            logger.info(f"{len(cached_papers)} papers rated from LLM cache")
+            RATINGS.inc(len(cached_papers), result="cached")
+            commit_papers(session, cached_papers)
+            if on_rated is not None:
+                for paper in cached_papers:
+                    on_rated(paper, LLMResponse(comment=paper.llm_comments, score=paper.llm_score))
+
+        # identical prompts within this run are requested only once
+        same_prompt: dict[str, list[RSSItem]] = {}
+        for paper in to_request:
+            same_prompt.setdefault(cache_keys[paper.uuid], []).append(paper)
+        to_rate = [group[0] for group in same_prompt.values()]
+
+    # papers the local model is confident to be irrelevant are not sent to the LLM
+    if prefilter is not None and to_rate:
+        proba = prefilter.paper_proba(to_rate)
+        skipped = [(paper, p) for paper, p in zip(to_rate, proba) if p >= prefilter.config.threshold]
+        skipped_ids = {id(paper) for paper, _ in skipped}
+        to_rate = [paper for paper in to_rate if id(paper) not in skipped_ids]
 
-        logger.debug(f"Rating paper #{ipaper}: {paper.link}")
-        resp = get_openai_response(paper, config)
+        auto_scored = []
+        for paper, p in skipped:
+            group = same_prompt[cache_keys[paper.uuid]] if use_cache else [paper]
+            for auto_paper in group:
+                auto_paper.llm_score = prefilter.config.auto_score
+                auto_paper.llm_comments = f"本地预筛选：与研究方向无关的概率为{p:.2f}，未请求LLM评分"
+                auto_paper.auto_scored = True
+            auto_scored.extend(group)
+
+        if auto_scored:
+            logger.info(f"{len(auto_scored)} papers auto-scored by the pre-filter")
+            RATINGS.inc(len(auto_scored), result="auto")
+            if session is not None:
+                commit_papers(session, auto_scored)
+            if on_rated is not None:
+                for paper in auto_scored:
+                    on_rated(paper, LLMResponse(comment=paper.llm_comments, score=paper.llm_score))
+
+    async def rate_one(client: httpx.AsyncClient, paper: RSSItem):
+        async with semaphore:
+            logger.debug(f"Rating paper: {paper.link}")
+            try:
+                resp = await async_get_openai_response(client, paper, config, limiter)
+            except REQUEST_ERRORS as err:
+                logger.error(f"Failed to rate paper {paper.link}: {err!r}")
+                return [(paper, None)]
         logger.debug(f"Rating Response: {resp}")
-        paper.llm_comments = resp.comment
-        paper.llm_score = resp.score
-        rated_papers.append(paper)
+        return [(paper, resp)]
+
+    async def rate_batch(client: httpx.AsyncClient, batch: list[RSSItem]):
+        async with semaphore:
+            try:
+                results = await async_get_batch_openai_response(client, batch, config, limiter)
+            except REQUEST_ERRORS as err:
+                logger.error(f"Failed to rate a batch of {len(batch)} papers: {err!r}")
+                results = {}
+
+        rated = [(paper, results[index]) for index, paper in enumerate(batch) if index in results]
+        failed = [paper for index, paper in enumerate(batch) if index not in results]
+        if failed and llm_config.batch_fallback:
+            logger.info(f"{len(failed)} papers failed in batch, rating them one by one")
+            for single in await asyncio.gather(*(rate_one(client, paper) for paper in failed)):
+                rated.extend(single)
+        else:
+            rated.extend((paper, None) for paper in failed)
+        return rated
+
+    if client is None:
+        limits = httpx.Limits(max_connections=llm_config.max_concurrency)
+        client_context = httpx.AsyncClient(limits=limits, timeout=llm_config.timeout, transport=transport)
+    else:
+        client_context = nullcontext(client)
+    async with client_context as client:
+        pending = []
+        if llm_config.batch_size > 1:
+            tasks = [
+                asyncio.create_task(rate_batch(client, to_rate[i:i + llm_config.batch_size]))
+                for i in range(0, len(to_rate), llm_config.batch_size)
+            ]
+        else:
+            tasks = [asyncio.create_task(rate_one(client, paper)) for paper in to_rate]
+
+        for task in asyncio.as_completed(tasks):
+            for paper, resp in await task:
+                if resp is None:
+                    RATINGS.inc(result="failed")
+                    if on_rated is not None:
+                        on_rated(paper, None)
+                    continue
+
+                rated = [paper]
+                if use_cache:
+                    # batch results are cached under the single paper prompt as well,
+                    # so they are reused whether batch mode is on or not
+                    key = cache_keys[paper.uuid]
+                    rated = same_prompt[key]
+                    add_cached_response(session, key, llm_config, resp.comment, resp.score)
+
+                RATINGS.inc(len(rated), result="rated")
+                for rated_paper in rated:
+                    rated_paper.llm_comments = resp.comment
+                    rated_paper.llm_score = resp.score
+                    rated_paper.auto_scored = False
+                    if on_rated is not None:
+                        on_rated(rated_paper, resp)
+                pending.extend(rated)
 
-    if session is not None:
-        session.add_all(rated_papers)
-        session.commit()
+            if session is not None and len(pending) >= llm_config.commit_batch_size:
+                commit_papers(session, pending)
+                pending = []
+
+    if session is not None and pending:
+        commit_papers(session, pending)
 
     return papers
 
 
-def rate_all_db(session: Session, config: AppSettings, rerate: bool = False, specify_paper_link: str | None = None):
+def rate_papers(papers: Sequence[RSSItem], config: AppSettings, rerate: bool = False, session: Session | None = None,
+    use_cache: bool = True, on_rated: Callable[[RSSItem, LLMResponse | None], None] | None = None,
+    prefilter: RelevancePrefilter | None = None):
     """
-    Rate all papers in the database
+    Rate papers concurrently.
+    Must be called from a thread without a running event loop.
     """
+    return asyncio.run(rate_papers_async(
+        papers, config, rerate=rerate, session=session, use_cache=use_cache, on_rated=on_rated,
+        prefilter=prefilter,
+    ))
+
+
+def papers_to_rate(rerate: bool = False, specify_paper_link: str | None = None):
+    """selection of the papers rated by `rate_all_db`"""
     if specify_paper_link is not None:
-        papers = session.exec(select(RSSItem).where(RSSItem.link == specify_paper_link)).all()
-        if not papers:
-            logger.warning(f"Paper {specify_paper_link} not found in database")
-            return {}
-    else:
-        if rerate:
-            papers = session.exec(select(RSSItem)).all()
-        else:
-            papers = session.exec(select(RSSItem).where(RSSItem.llm_score.is_(None))).all()
+        return select(RSSItem).where(RSSItem.link == specify_paper_link)
+    # near-duplicates take the rating of their canonical paper
+    selection = select(RSSItem).where(RSSItem.canonical_uuid.is_(None))
+    if rerate:
+        return selection
+    return selection.where(RSSItem.llm_score.is_(None))
+
+
+def rate_all_db(session: Session, config: AppSettings, rerate: bool = False, specify_paper_link: str | None = None,
+    use_cache: bool = True):
+    """
+    Rate all papers in the database
+    """
+    papers = session.exec(papers_to_rate(rerate, specify_paper_link)).all()
+    if specify_paper_link is not None and not papers:
+        logger.warning(f"Paper {specify_paper_link} not found in database")
+        return {}
 
-    papers = rate_papers(papers, config, rerate=rerate, session=session)
-    return {paper.link: {"comment": paper.llm_comments, "score": paper.llm_score} for paper in papers}
\ No newline at end of file
+    # a paper asked for explicitly is always rated by the LLM
+    prefilter = load_prefilter(session, config) if specify_paper_link is None else None
+    papers = rate_papers(papers, config, rerate=rerate, session=session, use_cache=use_cache, prefilter=prefilter)
+    return {paper.link: {"comment": paper.llm_comments, "score": paper.llm_score} for paper in papers}
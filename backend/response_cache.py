@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable
+import hashlib
+
+# versions of the data behind cached responses.
+# "data" is bumped when rss_items are committed by retrieve or rating,
+# "config" when the config is reloaded
+_versions: dict[str, int] = {"data": 0, "config": 0}
+_versions_lock = Lock()
+
+
+def bump_version(name: str = "data"):
+    """invalidate cached responses depending on `name`"""
+    with _versions_lock:
+        _versions[name] += 1
+
+
+def get_version(name: str = "data") -> int:
+    return _versions[name]
+
+
+class CachedResponse:
+    """rendered body of a response, with its ETag"""
+
+    def __init__(self, body: bytes, headers: dict[str, str] | None = None):
+        self.body = body
+        self.headers = headers or {}
+        self.etag = f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache of rendered responses.
+    Keys should contain the versions the response depends on, so stale entries
+    are never hit and are evicted as least recently used.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
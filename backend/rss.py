@@ -1,108 +1,464 @@
-from sqlmodel import SQLModel, Field, Session, select
+from sqlmodel import SQLModel, Field, Session, select, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import feedparser
+import httpx
+import asyncio
+import time
+import hashlib
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from urllib.parse import urlsplit
+from pydantic import BaseModel
+from typing import Callable
 
-from .models import RSS_Journal, RSSItem, DateFormat
+from .models import RSS_Journal, RSSItem, FeedCache
 from .logger import custom_logger
-from .config import AppSettings, get_config
+from .config import AppSettings, RSSFetch_Config, get_config
+from .database import SQLITE_CHUNK_SIZE
+from .rater.queue import enqueue_papers
+from .dedup import link_duplicates
+from .relevance import refresh_relevance
+from .response_cache import bump_version
+from .metrics import FEED_FETCH_SECONDS, FEED_PARSE_SECONDS, FEED_ITEMS
 
-config = get_config()
-logger = custom_logger(__name__, debug=config.DEBUG)
+logger = custom_logger(__name__)
 
-def retrieve(journal: RSS_Journal, session: Session | None = None, update_duplicate: bool = True
-    ) -> list[RSSItem]:
-        """ """
-        # TODO separate feed stream, use robust httpx request
-        # direct use cause 403 for PoP
 
-        # feed_stream = httpx.get(journal.feed)
-        # logger.info(f"Feed stream: {feed_stream.text}")
-        # feed_objs = feedparser.parse(feed_stream.content)
+class FeedFetchResult(BaseModel):
+    """raw result of downloading one feed"""
+    journal_key: str
+    content: bytes | None = None
+    headers: dict[str, str] = {}
+    status_code: int | None = None
+    elapsed: float = 0
+    error: str | None = None
 
+    # validators for the next conditional GET
+    etag: str | None = None
+    last_modified: str | None = None
+    content_hash: str | None = None
+    # 304 or identical content, nothing to parse
+    not_modified: bool = False
+
+
+def journal_schema_hash(journal: RSS_Journal) -> str:
+    """hash of the journal schema, so editing rss.yml invalidates the feed cache"""
+    return hashlib.sha256(journal.model_dump_json().encode()).hexdigest()
+
+
+def valid_feed_cache(journal: RSS_Journal, cache: FeedCache | None) -> FeedCache | None:
+    """cache record is only valid for the same feed and schema"""
+    if cache is None:
+        return None
+    if cache.feed != journal.feed or cache.schema_hash != journal_schema_hash(journal):
+        return None
+    return cache
+
+
+# fetch
+# ==========================
+async def fetch_feed(
+    client: httpx.AsyncClient,
+    journal_key: str,
+    journal: RSS_Journal,
+    host_limits: dict[str, asyncio.Semaphore],
+    fetch_config: RSSFetch_Config,
+    cache: FeedCache | None = None,
+) -> FeedFetchResult:
+    """
+    Download a single feed, holding the semaphore of its host.
+    With a cache record, validators are sent as a conditional GET.
+    """
+    host = urlsplit(journal.feed).netloc
+    semaphore = host_limits.setdefault(host, asyncio.Semaphore(fetch_config.max_per_host))
+
+    request_headers = {}
+    if cache is not None:
+        if cache.etag:
+            request_headers["If-None-Match"] = cache.etag
+        if cache.last_modified:
+            request_headers["If-Modified-Since"] = cache.last_modified
+
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            resp = await asyncio.wait_for(
+                client.get(journal.feed, headers=request_headers), timeout=fetch_config.timeout
+            )
+            # a 304 is only expected for a conditional GET, without a cache record there is nothing to reuse
+            if resp.status_code != 304 or cache is None:
+                resp.raise_for_status()
+        except (httpx.HTTPError, asyncio.TimeoutError) as err:
+            elapsed = time.perf_counter() - start
+            FEED_FETCH_SECONDS.observe(elapsed, journal=journal.source, status="error")
+            logger.warning(f"Failed to fetch {journal.source} after {elapsed:.2f}s: {err!r}")
+            return FeedFetchResult(journal_key=journal_key, elapsed=elapsed, error=repr(err))
+
+        elapsed = time.perf_counter() - start
+        FEED_FETCH_SECONDS.observe(elapsed, journal=journal.source, status=resp.status_code)
+
+        if resp.status_code == 304:
+            logger.debug(f"Feed {journal.source} not modified (304) in {elapsed:.2f}s")
+            return FeedFetchResult(
+                journal_key=journal_key,
+                status_code=resp.status_code,
+                elapsed=elapsed,
+                etag=cache.etag,
+                last_modified=cache.last_modified,
+                content_hash=cache.content_hash,
+                not_modified=True,
+            )
+
+        logger.debug(f"Fetched {journal.source}: {len(resp.content)} bytes in {elapsed:.2f}s")
+
+        # some publishers ignore validators, but the body may still be identical
+        content_hash = hashlib.sha256(resp.content).hexdigest()
+        not_modified = cache is not None and cache.content_hash == content_hash
+
+        return FeedFetchResult(
+            journal_key=journal_key,
+            content=None if not_modified else resp.content,
+            # feedparser uses content-type to detect encoding
+            headers={
+                "content-type": resp.headers.get("content-type", ""),
+                "content-location": str(resp.url),
+            },
+            status_code=resp.status_code,
+            elapsed=elapsed,
+            etag=resp.headers.get("etag"),
+            last_modified=resp.headers.get("last-modified"),
+            content_hash=content_hash,
+            not_modified=not_modified,
+        )
+
+
+async def fetch_feeds(
+    journals: dict[str, RSS_Journal],
+    fetch_config: RSSFetch_Config,
+    caches: dict[str, FeedCache] | None = None,
+    transport: httpx.AsyncBaseTransport | None = None,
+) -> dict[str, FeedFetchResult]:
+    """
+    Download all feeds concurrently on a shared client.
+    Total time is bounded by the slowest feed instead of the sum.
+    `caches` are valid feed cache records by journal key.
+    `transport` is only used to replace the network in tests.
+    """
+    if caches is None:
+        caches = {}
+
+    headers = {
+        "User-Agent": fetch_config.user_agent or feedparser.USER_AGENT,
+        "Accept": feedparser.http.ACCEPT_HEADER,
+    }
+    limits = httpx.Limits(max_connections=fetch_config.max_connections)
+    host_limits: dict[str, asyncio.Semaphore] = {}
+
+    async with httpx.AsyncClient(
+        headers=headers,
+        limits=limits,
+        timeout=fetch_config.timeout,
+        follow_redirects=True,
+        transport=transport,
+    ) as client:
+        results = await asyncio.gather(
+            *(
+                fetch_feed(client, key, journal, host_limits, fetch_config, caches.get(key))
+                for key, journal in journals.items()
+            )
+        )
+
+    return {result.journal_key: result for result in results}
+
+
+# parse
+# ==========================
+def entry_to_item(journal: RSS_Journal, feed) -> RSSItem:
+    """Map one feed entry to an RSSItem with the extractors compiled from the journal schema."""
+    return RSSItem.model_validate(journal.extract(feed))
+
+
+def parse_feed(journal: RSS_Journal, fetched: FeedFetchResult | None = None) -> list[RSSItem]:
+    """
+    Parse the feed into RSSItem objects according to the journal schema.
+    If nothing is fetched in advance, feedparser downloads the feed itself.
+    """
+    if fetched is None:
         feed_objs = feedparser.parse(journal.feed)
+    else:
+        feed_objs = feedparser.parse(fetched.content, response_headers=fetched.headers)
+
+    return [entry_to_item(journal, feed) for feed in feed_objs.entries]
+
+
+def parse_feed_rows(journal: RSS_Journal, content: bytes, headers: dict[str, str] | None = None) -> list[dict]:
+    """
+    Parse downloaded feed content into plain row dicts of FEED_FIELDS, ready for `store_rows`.
+    Runs in worker processes of `retrieve_all`, so only picklable plain data goes in and out.
+    """
+    feed_objs = feedparser.parse(content, response_headers=headers or {})
+    return [
+        entry_to_item(journal, feed).model_dump(include=set(FEED_FIELDS))
+        for feed in feed_objs.entries
+    ]
+
+
+def parse_feed_rows_timed(journal: RSS_Journal, content: bytes,
+                          headers: dict[str, str] | None = None) -> tuple[list[dict], float]:
+    """`parse_feed_rows` and its duration, measured in the worker so queueing in the pool is not counted"""
+    start = time.perf_counter()
+    rows = parse_feed_rows(journal, content, headers)
+    return rows, time.perf_counter() - start
+
+
+# store
+# ==========================
+# fields coming from the feed, other fields are scores filled later
+FEED_FIELDS = ("uuid", "title", "link", "summary", "source", "authors", "affiliation", "published")
+# an existing row is only updated if one of these changed
+UPDATE_FIELDS = ("title", "summary", "authors")
+
 
-        result_items = []
-        for feed in feed_objs.entries:
-            item_obj = {}
-            # print(feed)
-
-            for field_name in RSSItem.model_fields.keys():
-                # special case first
-                if field_name == "source":
-                    # We usually give a custom source name
-                    item_obj[field_name] = journal.source
-                    continue
-
-                elif field_name == "uuid":
-                    # use default factory function
-                    continue
-
-                elif hasattr(journal, field_name):
-                    #
-                    if isinstance(getattr(journal, field_name), str):
-                        # if the field is a string, it means to request the corresponding field
-                        item_obj[field_name] = getattr(
-                            feed, getattr(journal, field_name)
-                        )
-
-                    elif isinstance(getattr(journal, field_name), DateFormat):
-                        # used for date format
-                        date_format: DateFormat = getattr(journal, field_name)
-                        date_str = getattr(feed, date_format.datestr)
-                        item_obj[field_name] = datetime.strptime(
-                            date_str, date_format.format
-                        )
-
-                    elif getattr(journal, field_name) is None:
-                        # if field is None, it means this field is not provided
-                        pass
-
-                    else:
-                        raise NotImplementedError(
-                            f"Field {field_name} is type {type(getattr(journal, field_name))}, not implemented"
-                        )
-                else:
-                    # field not found in schema.
-                    # highly likely this is a field related to LLM/scores, not included in the RSS feed
-                    continue
-                    # raise ValueError(f"Field {field_name} not found in RSSItem model")
-
-            item = RSSItem.model_validate(item_obj)
-            result_items.append(item)
-
-        all_links = [item.link for item in result_items]
-
-        if session is not None:
-            # store to database, but check existing first
-            existing_items = session.exec(
-                select(RSSItem).where(RSSItem.link.in_(all_links))
-            ).all()
-
-            existing_links = [item.link for item in existing_items]
-            new_links = []
-            
-            for item in result_items:
-                # check duplicate
-                if item.link in existing_links:
-                    if update_duplicate:
-                        # TODO
-                        # update duplicate items
-                        logger.debug(
-                            f"Updating existing entries not implemented yet: {item.link}"
-                        )
-                        pass
-                else:
-                    logger.debug(f"Adding new item to database: {item.link}, {item.uuid}")
-                    new_links.append(item.link)
-                    session.add(item)
-
-            logger.info(f"New items: {len(new_links)} added to database")
-            session.commit()
-
-            return {"all": all_links, "new": new_links, "existing": existing_links}
+def store_items(result_items: list[RSSItem], session: Session, update_duplicate: bool = True) -> dict:
+    """
+    Bulk upsert parsed items by link.
+    With `update_duplicate`, existing rows are updated only if title, summary or authors changed.
+    """
+    return store_rows(
+        [item.model_dump(include=set(FEED_FIELDS)) for item in result_items],
+        session, update_duplicate=update_duplicate,
+    )
 
+
+def store_rows(result_rows: list[dict], session: Session, update_duplicate: bool = True) -> dict:
+    """
+    Same as `store_items`, for rows of FEED_FIELDS, e.g. from `parse_feed_rows`
+    """
+    # the last entry wins if a feed repeats a link
+    rows = {}
+    for row in result_rows:
+        rows[row["link"]] = row
+    all_links = [row["link"] for row in result_rows]
+
+    table = RSSItem.__table__
+    existing_links = set()
+    new_links = []
+    new_uuids = []
+    updated_links = []
+    updated_uuids = []
+
+    row_list = list(rows.values())
+    for i in range(0, len(row_list), SQLITE_CHUNK_SIZE):
+        chunk = row_list[i:i + SQLITE_CHUNK_SIZE]
+        existing_links.update(session.exec(
+            select(RSSItem.link).where(RSSItem.link.in_([row["link"] for row in chunk]))
+        ).all())
+
+        statement = sqlite_insert(table).values(chunk)
+        if update_duplicate:
+            excluded = statement.excluded
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.link],
+                set_={field: excluded[field] for field in UPDATE_FIELDS},
+                where=or_(*(table.c[field].is_distinct_from(excluded[field]) for field in UPDATE_FIELDS)),
+            )
         else:
-            return {"all": all_links}
+            statement = statement.on_conflict_do_nothing(index_elements=[table.c.link])
+
+        # only inserted or actually updated rows are returned
+        for item_uuid, link in session.exec(statement.returning(table.c.uuid, table.c.link)).all():
+            if link in existing_links:
+                updated_links.append(link)
+                updated_uuids.append(item_uuid)
+            else:
+                new_links.append(link)
+                new_uuids.append(item_uuid)
+
+    updated_set = set(updated_links)
+    unchanged_links = [link for link in existing_links if link not in updated_set]
+    item_counts = Counter(
+        (rows[link]["source"], result)
+        for result, links in (("inserted", new_links), ("updated", updated_links), ("unchanged", unchanged_links))
+        for link in links
+    )
+    for (source, result), count in item_counts.items():
+        FEED_ITEMS.inc(count, journal=source, result=result)
+
+    # new copies of stored papers take their rating instead of being rated again
+    duplicates = link_duplicates(
+        session,
+        [{**rows[link], "uuid": item_uuid} for link, item_uuid in zip(new_links, new_uuids)],
+        get_config().DEDUP,
+    )
+
+    # relevance rows of the new papers, the keyword hits of updated ones may change with the text
+    refresh_relevance(session, new_uuids + updated_uuids)
+
+    # queued in the same transaction, so no new paper is lost for rating
+    enqueue_papers(session, [item_uuid for item_uuid in new_uuids if item_uuid not in duplicates])
+
+    logger.info(
+        f"New items: {len(new_links)} added ({len(duplicates)} duplicates), {len(updated_links)} updated, "
+        f"{len(unchanged_links)} unchanged"
+    )
+    session.commit()
+    if new_links or updated_links:
+        bump_version("data")
+
+    return {
+        "all": all_links,
+        "new": new_links,
+        "updated": updated_links,
+        "unchanged": unchanged_links,
+        "duplicates": duplicates,
+        "counts": {
+            "inserted": len(new_links),
+            "updated": len(updated_links),
+            "unchanged": len(unchanged_links),
+        },
+    }
+
+
+def retrieve_summary(results: dict[str, dict]) -> dict[str, int]:
+    """counts over the results of `retrieve_all` by journal"""
+    return {
+        "total": len(results),
+        "inserted": sum(len(result.get("new", ())) for result in results.values()),
+        "updated": sum(len(result.get("updated", ())) for result in results.values()),
+        "skipped": sum(1 for result in results.values() if result.get("skipped")),
+        "failed": sum(1 for result in results.values() if "error" in result),
+    }
+
+
+def retrieve(journal: RSS_Journal, session: Session | None = None, update_duplicate: bool = True,
+    fetched: FeedFetchResult | None = None) -> dict:
+    """
+    Retrieve a single journal. `fetched` can be given by `fetch_feeds` to skip downloading.
+    """
+    result_items = parse_feed(journal, fetched)
+
+    if session is not None:
+        return store_items(result_items, session, update_duplicate=update_duplicate)
+
+    else:
+        return {"all": [item.link for item in result_items]}
+
+
+def load_feed_caches(journals: dict[str, RSS_Journal], session: Session) -> dict[str, FeedCache]:
+    """load valid feed cache records of the journals in one query"""
+    records = session.exec(
+        select(FeedCache).where(FeedCache.journal_key.in_(list(journals.keys())))
+    ).all()
+
+    caches = {}
+    for record in records:
+        cache = valid_feed_cache(journals[record.journal_key], record)
+        if cache is not None:
+            caches[record.journal_key] = cache
+    return caches
+
+
+def save_feed_cache(journal_key: str, journal: RSS_Journal, fetched: FeedFetchResult, session: Session):
+    """record validators after the feed is successfully stored"""
+    session.merge(FeedCache(
+        journal_key=journal_key,
+        feed=journal.feed,
+        schema_hash=journal_schema_hash(journal),
+        etag=fetched.etag,
+        last_modified=fetched.last_modified,
+        content_hash=fetched.content_hash,
+        updated=datetime.now(),
+    ))
+    session.commit()
+
+
+def retrieve_all(
+    journals: dict[str, RSS_Journal],
+    session: Session | None = None,
+    update_duplicate: bool = True,
+    fetch_config: RSSFetch_Config | None = None,
+    use_cache: bool = True,
+    on_result: Callable[[str, dict], None] | None = None,
+    transport: httpx.AsyncBaseTransport | None = None,
+) -> dict[str, dict]:
+    """
+    Download all feeds concurrently, then parse and store them one by one.
+    With a session, unchanged feeds are skipped by conditional GET or content hash,
+    unless `use_cache` is False.
+    `on_result(journal_key, result)` is called as soon as each journal is done.
+    With `parse_processes` in the fetch config, feeds are parsed in a process pool.
+    Must be called from a thread without a running event loop.
+    """
+    if fetch_config is None:
+        fetch_config = get_config().RSS_FETCH
+
+    caches = {}
+    if session is not None and use_cache:
+        caches = load_feed_caches(journals, session)
+
+    start = time.perf_counter()
+    fetched_all = asyncio.run(fetch_feeds(journals, fetch_config, caches=caches, transport=transport))
+    logger.info(f"Fetched {len(fetched_all)} feeds in {time.perf_counter() - start:.2f}s")
+
+    to_parse = {
+        key: fetched for key, fetched in fetched_all.items()
+        if fetched.error is None and not fetched.not_modified
+    }
+    # parsing is CPU bound, large feeds are parsed in worker processes while the previous ones are stored.
+    # spawn, as forking a process with scheduler and server threads is unsafe
+    pool = None
+    parsed = {}
+    if fetch_config.parse_processes > 0 and to_parse:
+        pool = ProcessPoolExecutor(
+            max_workers=min(fetch_config.parse_processes, len(to_parse)),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        parsed = {
+            key: pool.submit(parse_feed_rows_timed, journals[key], fetched.content, fetched.headers)
+            for key, fetched in to_parse.items()
+        }
+
+    def store_fetched(journal_key: str, journal: RSS_Journal) -> dict:
+        fetched = fetched_all[journal_key]
+        if fetched.error is not None:
+            return {"error": fetched.error}
+
+        if fetched.not_modified:
+            logger.info(f"Feed {journal.source} not modified, skipped")
+            # a server ignoring the validators may still send new ones with the identical body,
+            # they are kept for the next conditional GET
+            cache = caches.get(journal_key)
+            if cache is not None and (fetched.etag, fetched.last_modified) != (cache.etag, cache.last_modified):
+                save_feed_cache(journal_key, journal, fetched, session)
+            return {"skipped": True}
+
+        try:
+            if journal_key in parsed:
+                rows, parse_s = parsed[journal_key].result()
+            else:
+                rows, parse_s = parse_feed_rows_timed(journal, fetched.content, fetched.headers)
+            FEED_PARSE_SECONDS.observe(parse_s, journal=journal.source)
+            if session is None:
+                return {"all": [row["link"] for row in rows]}
+            result = store_rows(rows, session, update_duplicate=update_duplicate)
+        except (ValueError, AttributeError) as err:
+            # one broken feed should not block the others
+            logger.error(f"Failed to parse {journal.source}: {err!r}")
+            return {"error": repr(err)}
 
+        save_feed_cache(journal_key, journal, fetched, session)
+        return result
 
+    all_results = {}
+    try:
+        for journal_key, journal in journals.items():
+            all_results[journal_key] = store_fetched(journal_key, journal)
+            if on_result is not None:
+                on_result(journal_key, all_results[journal_key])
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
 
+    return all_results
@@ -0,0 +1,16 @@
+import pytest
+from sqlmodel import SQLModel, Session, create_engine
+
+
+@pytest.fixture
+def memory_engine():
+    """an in-memory database with the tables of the models"""
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+
+@pytest.fixture
+def memory_session(memory_engine):
+    with Session(memory_engine) as session:
+        yield session
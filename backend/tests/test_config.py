@@ -0,0 +1,61 @@
+import os
+import pytest
+import yaml
+from .. import config as config_module
+from ..config import get_config, reload_config, on_config_reload
+from ..response_cache import get_version
+
+
+PUBLISHED = {"datestr": "published", "format": "%a, %d %b %Y %H:%M:%S %Z"}
+
+
+def write_yml(path, content: dict, mtime: float):
+    path.write_text(yaml.safe_dump(content), encoding="utf-8")
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def config_files(tmp_path, monkeypatch):
+    """a config and rss.yml of their own, the config of the other tests is restored afterwards"""
+    app_yml, rss_yml = tmp_path / "app.yml", tmp_path / "rss.yml"
+    write_yml(app_yml, {"RSS_SCHEMA_YML": str(rss_yml), "LOG_OUTPUT": str(tmp_path / "app.log")}, 1000)
+    write_yml(rss_yml, {
+        "journal_a": {"feed": "https://example.org/a.xml", "source": "A", "published": PUBLISHED},
+    }, 1000)
+
+    monkeypatch.setenv("APP_CONFIG_PATH", str(app_yml))
+    monkeypatch.setattr(config_module, "_config", None)
+    monkeypatch.setattr(config_module, "_config_files", {})
+    monkeypatch.setattr(config_module, "_listeners", [])
+    return app_yml, rss_yml
+
+
+def test_reload_config(config_files):
+    app_yml, rss_yml = config_files
+    config = get_config()
+    assert list(config.RSS_JOURNALS) == ["journal_a"]
+    assert get_config() is config
+    # nothing changed, nothing read
+    assert reload_config(only_if_changed=True) is None
+
+    reloads = []
+    on_config_reload(lambda new, old: reloads.append((new, old)))
+    version = get_version("config")
+    write_yml(rss_yml, {
+        "journal_a": {"feed": "https://example.org/a.xml", "source": "A", "published": PUBLISHED},
+        "journal_b": {"feed": "https://example.org/b.xml", "source": "B", "published": PUBLISHED},
+    }, 2000)
+
+    new_config = reload_config(only_if_changed=True)
+    assert new_config is get_config()
+    assert list(new_config.RSS_JOURNALS) == ["journal_a", "journal_b"]
+    assert reloads == [(new_config, config)]
+    assert get_version("config") == version + 1
+
+    # an invalid config is rejected, and not read again until the files change
+    write_yml(rss_yml, {"journal_c": {"source": "C"}}, 3000)
+    with pytest.raises(ValueError):
+        reload_config(only_if_changed=True)
+    assert get_config() is new_config
+    assert reload_config(only_if_changed=True) is None
+    assert len(reloads) == 1
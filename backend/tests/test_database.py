@@ -0,0 +1,337 @@
+import pytest
+import random
+import asyncio
+from datetime import datetime, timedelta
+from sqlmodel import SQLModel, Session, create_engine, select, text, insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models import RSSItem, ProfileScore, RelevanceScore
+from ..config import SQLite_Config, get_config
+from ..database import migrate_db, create_db_engine, create_async_db_engine, create_profile_indexes
+from ..query import select_rss_items, query_rss_page, async_query_rss_page, encode_cursor
+from ..relevance import update_relevance
+from ..rater.req_openai_compat import commit_papers
+
+
+def test_migrate_duplicate_links(memory_engine):
+    """databases created before links were unique are deduplicated"""
+    with memory_engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_rss_items_link"))
+
+    with Session(memory_engine) as session:
+        for uuid, score in [("a", None), ("b", 3.0), ("c", None)]:
+            session.add(RSSItem(uuid=uuid, title="t", link="https://example.org/1", summary="",
+                                source="s", published=datetime(2025, 1, 1), llm_score=score))
+        session.commit()
+
+    migrate_db(memory_engine)
+
+    with Session(memory_engine) as session:
+        # the rated copy is kept
+        assert session.exec(select(RSSItem.uuid)).all() == ["b"]
+    with memory_engine.connect() as conn:
+        indexes = [row[1] for row in conn.execute(text("PRAGMA index_list(rss_items)"))]
+        assert "ix_rss_items_link" in indexes
+
+
+def test_migrate_added_columns(memory_engine):
+    """columns added to the models later are appended with their default"""
+    with memory_engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_rss_items_link"))
+        conn.execute(text("ALTER TABLE rss_items DROP COLUMN auto_scored"))
+        conn.execute(text(
+            "INSERT INTO rss_items (uuid, title, link, summary, source, published) "
+            "VALUES ('a', 't', 'https://example.org/1', '', 's', '2025-01-01 00:00:00')"
+        ))
+
+    migrate_db(memory_engine)
+
+    with Session(memory_engine) as session:
+        assert session.get(RSSItem, "a").auto_scored is False
+
+
+def test_migrate_obsolete_columns(memory_engine):
+    """relevance_score of rss_items, moved to relevance_scores, is dropped with its index"""
+    with memory_engine.begin() as conn:
+        conn.execute(text("ALTER TABLE rss_items ADD COLUMN relevance_score FLOAT"))
+        conn.execute(text("ALTER TABLE rss_items ADD COLUMN keyword_hits INTEGER"))
+        conn.execute(text(
+            "CREATE INDEX ix_rss_items_relevance_score_keyset ON rss_items (relevance_score, published, uuid, source)"
+        ))
+
+    migrate_db(memory_engine)
+
+    with memory_engine.connect() as conn:
+        columns = {row[1] for row in conn.execute(text("PRAGMA table_info(rss_items)"))}
+        indexes = {row[1] for row in conn.execute(text("PRAGMA index_list(rss_items)"))}
+    assert not {"relevance_score", "keyword_hits"} & columns
+    assert "ix_rss_items_relevance_score_keyset" not in indexes
+
+
+def test_relevance_scores(memory_engine):
+    """scores of the formula, recomputed for new ratings and for all papers after a weight change"""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    config = get_config().model_copy(deep=True)
+    config.RELEVANCE = config.RELEVANCE.model_copy(update={
+        "llm_weight": 1.0, "keywords": ["chorus", "Whistler"], "keyword_weight": 0.5, "max_keyword_hits": 1,
+        "journal_weights": {"weighted": 2.0}, "recency_weight": 0.5, "recency_half_life_days": 10,
+    })
+    with Session(memory_engine) as session:
+        for i, (title, source, days, score) in enumerate([
+            ("whistler chorus waves", "weighted", 0, 3.0),
+            ("plasma sheet", "other", 10, 2.0),
+            ("unrated", "other", 0, None),
+        ]):
+            session.add(RSSItem(uuid=str(i), title=title, link=f"https://example.org/{i}", summary="",
+                                source=source, published=today - timedelta(days=days), llm_score=score))
+        session.commit()
+
+        result = update_relevance(session, config)
+        assert result["full"] and result["added"] == 3 and result["changed"] == 2
+        scores = dict(session.exec(select(RelevanceScore.item_uuid, RelevanceScore.relevance_score)).all())
+        # keyword hits capped at 1, the weighted journal doubles, half the recency weight after 10 days
+        assert scores["0"] == pytest.approx((3.0 + 0.5) * 2.0)
+        assert scores["1"] == pytest.approx(2.0 * 0.75)
+        assert scores["2"] is None
+
+        # a new rating clears the score, only that paper is computed again
+        paper = session.get(RSSItem, "2")
+        paper.llm_score = 1.0
+        commit_papers(session, [paper])
+        result = update_relevance(session, config)
+        assert not result["full"] and result["changed"] == 1
+        assert session.get(RelevanceScore, "2").relevance_score == pytest.approx(1.0)
+
+        config.RELEVANCE.llm_weight = 2.0
+        result = update_relevance(session, config)
+        assert result["full"] and not result["recount"] and result["changed"] == 3
+        assert session.get(RelevanceScore, "0").relevance_score == pytest.approx((6.0 + 0.5) * 2.0)
+
+        # listed with their score, and ordered by it
+        items, _ = query_rss_page(session, ["weighted", "other"], today - timedelta(days=30), today,
+                                  order_by="relevance_score")
+        assert [(item.uuid, item.relevance_score) for item in items] == [
+            ("0", pytest.approx(13.0)), ("1", pytest.approx(3.0)), ("2", pytest.approx(2.0)),
+        ]
+
+
+@pytest.fixture(scope="module")
+def populated_engine():
+    """three years of papers from six journals, scored on the 0.1 grid as the LLM does"""
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+
+    rng = random.Random(0)
+    now = datetime(2026, 1, 1)
+    rows = [
+        RSSItem(
+            title=f"paper {i}", link=f"https://example.org/{i}", summary="", source=f"journal {i % 6}",
+            published=now - timedelta(minutes=rng.randrange(3 * 365 * 24 * 60)),
+            llm_score=rng.choice([None] + [x / 10 for x in range(51)]),
+        ).model_dump()
+        for i in range(6000)
+    ]
+    with engine.begin() as conn:
+        conn.execute(insert(RSSItem), rows)
+        conn.execute(insert(ProfileScore), [
+            {"item_uuid": row["uuid"], "profile": profile, "published": row["published"],
+             "source": row["source"], "llm_score": row["llm_score"]}
+            for profile in ("waves", "storms") for row in rows
+        ])
+        create_profile_indexes(conn, ["waves", "storms"])
+    with Session(engine) as session:
+        update_relevance(session, get_config())
+
+    migrate_db(engine)
+    return engine
+
+
+def query_plan(engine, selection) -> list[str]:
+    sql = str(selection.compile(engine, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        return [row[3] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql))]
+
+
+@pytest.mark.parametrize("order_by", ["llm_score", "relevance_score", "published"])
+@pytest.mark.parametrize("days", [7, 365 * 3])
+@pytest.mark.parametrize("desc", [True, False])
+@pytest.mark.parametrize("collapse", [False, True])
+def test_rss_query_plan(populated_engine, order_by, days, desc, collapse):
+    """the dashboard queries use an index, without full scans or sorting"""
+    sources = [f"journal {i}" for i in range(5)]
+    now = datetime(2026, 1, 1)
+    selection = select_rss_items(sources, now - timedelta(days=days), now, order_by=order_by, desc=desc,
+                                 collapse=collapse)
+
+    plan = query_plan(populated_engine, selection)
+    assert not any(step.startswith("SCAN rss_items") and "INDEX" not in step for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+    assert any("USING INDEX" in step or "USING COVERING INDEX" in step for step in plan), plan
+
+
+@pytest.mark.parametrize("order_by", ["llm_score", "published"])
+@pytest.mark.parametrize("desc", [True, False])
+def test_profile_query_plan(populated_engine, order_by, desc):
+    """papers of a profile are read from its partial index or its range of the published index"""
+    sources = [f"journal {i}" for i in range(5)]
+    now = datetime(2026, 1, 1)
+    selection = select_rss_items(sources, now - timedelta(days=365), now, order_by=order_by, desc=desc,
+                                 profile="waves")
+
+    plan = query_plan(populated_engine, selection)
+    assert any(step.startswith("SEARCH profile_scores USING") and "INDEX ix_profile_scores" in step
+               for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+@pytest.mark.parametrize("order_by", ["llm_score", "relevance_score", "published"])
+@pytest.mark.parametrize("desc", [True, False])
+def test_rss_keyset_query_plan(populated_engine, order_by, desc):
+    """later pages are served by the same index scan"""
+    sources = [f"journal {i}" for i in range(5)]
+    now = datetime(2026, 1, 1)
+    with Session(populated_engine) as session:
+        first_page, cursor = query_rss_page(session, sources, now - timedelta(days=365), now,
+                                            order_by=order_by, desc=desc)
+    selection = select_rss_items(sources, now - timedelta(days=365), now,
+                                 order_by=order_by, desc=desc, cursor=cursor)
+
+    plan = query_plan(populated_engine, selection)
+    assert not any(step.startswith("SCAN rss_items") and "INDEX" not in step for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+@pytest.mark.parametrize("order_by", ["llm_score", "relevance_score", "published"])
+@pytest.mark.parametrize("desc", [True, False])
+def test_rss_keyset_pagination(populated_engine, order_by, desc):
+    """walking all pages gives the same rows as one big query, NULL scores included"""
+    sources = [f"journal {i}" for i in range(6)]
+    now = datetime(2026, 1, 1)
+    since = now - timedelta(days=60)
+
+    with Session(populated_engine) as session:
+        expected, _ = query_rss_page(session, sources, since, now, max_number=10000, order_by=order_by, desc=desc)
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = query_rss_page(session, sources, since, now, max_number=50,
+                                          order_by=order_by, desc=desc, cursor=cursor)
+            pages.extend(page)
+            if cursor is None:
+                break
+
+    assert [item.uuid for item in pages] == [item.uuid for item in expected]
+
+
+def test_rss_cursor_mismatch():
+    item = RSSItem(uuid="a", title="", link="", summary="", source="", published=datetime(2025, 1, 1))
+    cursor = encode_cursor(item, "llm_score", True)
+    with pytest.raises(ValueError):
+        select_rss_items([], datetime(2025, 1, 1), datetime(2026, 1, 1), order_by="published", cursor=cursor)
+    with pytest.raises(ValueError):
+        select_rss_items([], datetime(2025, 1, 1), datetime(2026, 1, 1), cursor="not a cursor")
+
+
+@pytest.fixture
+def search_session(memory_engine):
+    migrate_db(memory_engine)
+    with Session(memory_engine) as session:
+        session.add_all([
+            RSSItem(uuid="a", title="Chorus waves in the radiation belts", link="https://example.org/a",
+                    summary="Whistler-mode chorus scatters electrons.", source="s", published=datetime(2025, 1, 1)),
+            RSSItem(uuid="b", title="Dark matter halos", link="https://example.org/b",
+                    summary="Galaxy formation with a chorus of simulations.", source="s", published=datetime(2025, 1, 2)),
+            RSSItem(uuid="c", title="Magnetic reconnection", link="https://example.org/c",
+                    summary="Reconnection onset in the magnetotail.", source="s", published=datetime(2025, 1, 3)),
+        ])
+        session.commit()
+        yield session
+
+
+def search(session, q, **kwargs) -> list[str]:
+    items, _ = query_rss_page(session, ["s"], datetime(2025, 1, 1), datetime(2025, 2, 1), q=q, **kwargs)
+    return [item.uuid for item in items]
+
+
+def test_fts_search(search_session):
+    assert search(search_session, "reconnection") == ["c"]
+    # prefix and stemming
+    assert search(search_session, "magnetot") == ["c"]
+    assert sorted(search(search_session, "wave")) == ["a"]
+    # words are combined by AND
+    assert search(search_session, "chorus galaxy") == ["b"]
+    # bm25 ranks the title match first
+    assert search(search_session, "chorus", order_by="rank") == ["a", "b"]
+    # FTS5 syntax in user input is quoted
+    assert search(search_session, 'chorus" OR "dark') == []
+    assert search(search_session, "NEAR(chorus") == []
+
+
+def test_fts_sync(search_session):
+    # rating updates the comments
+    item = search_session.get(RSSItem, "c")
+    item.llm_comments = "Highly relevant to substorm research."
+    search_session.add(item)
+    search_session.commit()
+    assert search(search_session, "substorm") == ["c"]
+
+    search_session.delete(item)
+    search_session.commit()
+    assert search(search_session, "substorm") == []
+
+
+def test_fts_rank_pagination(search_session):
+    pages = []
+    cursor = None
+    while True:
+        items, cursor = query_rss_page(search_session, ["s"], datetime(2025, 1, 1), datetime(2025, 2, 1),
+                                       max_number=1, order_by="rank", q="chorus", cursor=cursor)
+        pages.extend(item.uuid for item in items)
+        if cursor is None:
+            break
+    assert pages == ["a", "b"]
+
+
+def test_engine_pragmas(tmp_path):
+    """file databases are opened in WAL mode with the configured PRAGMAs"""
+    sqlite_config = SQLite_Config(busy_timeout=1234, cache_size=-1000, pool_size=3)
+    file_engine = create_db_engine(f"sqlite:///{tmp_path / 'test.db'}", sqlite_config)
+
+    with file_engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 1234
+        assert conn.execute(text("PRAGMA cache_size")).scalar() == -1000
+    assert file_engine.pool.size() == 3
+
+    # in-memory databases accept the same config
+    memory_engine = create_db_engine("sqlite://", sqlite_config)
+    with memory_engine.connect() as conn:
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 1234
+
+
+def test_async_query_rss_page(tmp_path):
+    """async routes get the same pages as the sync query"""
+    url = f"sqlite:///{tmp_path / 'test.db'}"
+    sync_engine = create_db_engine(url)
+    SQLModel.metadata.create_all(sync_engine)
+    with Session(sync_engine) as session:
+        for i in range(5):
+            session.add(RSSItem(title=f"Paper {i}", link=f"https://example.org/{i}", summary="",
+                                source="A", published=datetime(2025, 1, 1 + i), llm_score=i % 3))
+        session.commit()
+        expected, expected_cursor = query_rss_page(
+            session, ["A"], datetime(2024, 1, 1), datetime(2026, 1, 1), max_number=3
+        )
+        expected = [item.uuid for item in expected]
+
+    async def query():
+        async_engine = create_async_db_engine(url)
+        async with AsyncSession(async_engine) as session:
+            items, cursor = await async_query_rss_page(
+                session, ["A"], datetime(2024, 1, 1), datetime(2026, 1, 1), max_number=3
+            )
+            result = [item.uuid for item in items], cursor
+        await async_engine.dispose()
+        return result
+
+    assert asyncio.run(query()) == (expected, expected_cursor)
@@ -0,0 +1,70 @@
+import csv
+import gzip
+import io
+import json
+import pytest
+from datetime import datetime
+from sqlmodel import select
+
+from ..models import RSSItem
+from ..export import stream_export, check_export_args, EXPORT_COLUMNS
+from ..query import filter_rss_items
+
+
+def example_chunks(n_chunks: int = 3, chunk_size: int = 4):
+    for i in range(n_chunks):
+        yield [
+            {
+                "uuid": f"{i}-{j}", "title": f"Paper {i}-{j}", "link": f"https://example.org/{i}/{j}",
+                "summary": "Chorus, waves\nand \"quotes\"", "source": "Example Journal",
+                "authors": "", "affiliation": "", "published": datetime(2025, 1, 1, 8),
+                "llm_comments": "", "llm_score": 5.0, "relevance_score": None,
+            }
+            for j in range(chunk_size)
+        ]
+
+
+def test_export_ndjson_gzip():
+    data = b"".join(stream_export("ndjson", "gzip", chunks=example_chunks()))
+    lines = gzip.decompress(data).decode().splitlines()
+
+    assert len(lines) == 12
+    row = json.loads(lines[0])
+    assert row["uuid"] == "0-0" and row["published"] == "2025-01-01T08:00:00"
+
+
+def test_export_csv():
+    data = b"".join(stream_export("csv", chunks=example_chunks()))
+    rows = list(csv.DictReader(io.StringIO(data.decode())))
+
+    assert len(rows) == 12
+    assert list(rows[0]) == EXPORT_COLUMNS
+    assert rows[-1]["summary"] == "Chorus, waves\nand \"quotes\""
+
+    # an empty export still has the header
+    data = b"".join(stream_export("csv", chunks=iter([])))
+    assert data.decode().strip() == ",".join(EXPORT_COLUMNS)
+
+
+def test_export_args():
+    with pytest.raises(ValueError):
+        check_export_args("xml", None)
+    with pytest.raises(ValueError):
+        check_export_args("ndjson", "bz2")
+
+
+def test_export_filters(memory_session):
+    """export shares the filters of /api/rss, None means unfiltered"""
+    for i, source in enumerate(["A", "B", "A"]):
+        memory_session.add(RSSItem(
+            title=f"Paper {i}", link=f"https://example.org/{i}", summary="",
+            source=source, published=datetime(2025, 1, i + 1),
+        ))
+    memory_session.commit()
+
+    def count(*args):
+        return len(memory_session.exec(filter_rss_items(select(RSSItem.uuid), *args)).all())
+
+    assert count(None, None, None) == 3
+    assert count(["A"], None, None) == 2
+    assert count(["A"], datetime(2025, 1, 2), None) == 1
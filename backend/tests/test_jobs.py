@@ -0,0 +1,139 @@
+import time
+import threading
+import pytest
+from datetime import datetime
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlmodel import SQLModel, Session, create_engine
+from .. import crons
+from ..config import AppSettings
+from ..models import RSS_Journal, RSSItem
+from ..jobs import JobRegistry, JobProgress
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = BackgroundScheduler()
+    scheduler.start()
+    yield scheduler
+    scheduler.shutdown(wait=False)
+
+
+def wait_finished(registry: JobRegistry, job_id: str, timeout: float = 5):
+    start = time.perf_counter()
+    while registry.get(job_id).active:
+        assert time.perf_counter() - start < timeout
+        time.sleep(0.01)
+    return registry.get(job_id)
+
+
+def test_job_progress_and_dedup(scheduler):
+    registry = JobRegistry()
+    release = threading.Event()
+
+    def fn(progress: JobProgress, items: list[str]):
+        progress.set_total(len(items))
+        for item in items:
+            release.wait()
+            progress.item(item, {"ok": item != "b"}, failed=item == "b")
+
+    job, created = registry.submit(scheduler, "test", {"items": ["a", "b"]}, fn)
+    assert created and job.state in ("pending", "running")
+
+    # same kind and params while active, the running job is returned
+    duplicate, created = registry.submit(scheduler, "test", {"items": ["a", "b"]}, fn)
+    assert not created and duplicate.id == job.id
+    other, created = registry.submit(scheduler, "test", {"items": ["c"]}, fn)
+    assert created and other.id != job.id
+
+    release.set()
+    job = wait_finished(registry, job.id)
+    assert job.state == "done"
+    assert (job.total, job.done, job.failed) == (2, 2, 1)
+    assert job.results == {"a": {"ok": True}, "b": {"ok": False}}
+
+    # finished jobs do not block new ones
+    _, created = registry.submit(scheduler, "test", {"items": ["a", "b"]}, fn)
+    assert created
+
+
+def test_job_failed(scheduler):
+    registry = JobRegistry(max_finished=1)
+
+    def fn(progress: JobProgress):
+        raise ValueError("broken")
+
+    job, _ = registry.submit(scheduler, "test", {}, fn)
+    job = wait_finished(registry, job.id)
+    assert job.state == "failed" and "broken" in job.error
+
+    # only the last finished job is kept
+    second, _ = registry.submit(scheduler, "test", {}, fn)
+    wait_finished(registry, second.id)
+    registry.submit(scheduler, "other", {}, fn)
+    assert registry.get(job.id) is None
+
+
+def test_retrieve_job_summary(scheduler, monkeypatch):
+    """the job of /api/rss/update counts journals and papers over all feeds"""
+    results = {
+        "a": {"new": ["https://example.org/1", "https://example.org/2"], "updated": ["https://example.org/3"]},
+        "b": {"skipped": True},
+        "c": {"error": "timeout"},
+    }
+
+    def fake_retrieve_all(journals, session, on_result, **kwargs):
+        for key in journals:
+            on_result(key, results[key])
+        return {key: results[key] for key in journals}
+
+    def no_session():
+        yield None
+
+    monkeypatch.setattr(crons, "retrieve_all", fake_retrieve_all)
+    monkeypatch.setattr(crons, "update_relevance", lambda session, config: None)
+    monkeypatch.setattr(crons, "wakeup_rating_queue", lambda: None)
+    monkeypatch.setattr(crons, "get_db_session", no_session)
+    journal = RSS_Journal(feed="https://example.org/feed.xml", source="mock",
+                          published={"datestr": "published", "format": "%Y"})
+    config = AppSettings(RSS_JOURNALS={key: journal for key in results})
+    monkeypatch.setattr(crons, "get_config", lambda: config)
+
+    registry = JobRegistry()
+    job, _ = registry.submit(scheduler, "retrieve", {"journal_keys": ["a", "b", "c"]}, crons.job_retrieve)
+    job = wait_finished(registry, job.id)
+    assert job.state == "done" and (job.total, job.done, job.failed) == (3, 3, 1)
+    assert job.model_dump(mode="json")["result"] == {
+        "total": 3, "inserted": 2, "updated": 1, "skipped": 1, "failed": 1,
+    }
+
+
+def test_admin_jobs(scheduler, monkeypatch, tmp_path):
+    """relevance, duplicates and pre-filter run as jobs, their summary is the result"""
+    # a file database, the jobs run on the threads of the scheduler
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        for i in range(2):
+            session.add(RSSItem(title=f"paper {i}", link=f"https://example.org/{i}", summary="", source="mock",
+                                published=datetime(2025, 1, 1), llm_score=i))
+        session.commit()
+
+    def engine_session():
+        with Session(engine) as session:
+            yield session
+
+    monkeypatch.setattr(crons, "get_db_session", engine_session)
+    monkeypatch.setattr(crons, "get_config", lambda: AppSettings())
+
+    registry = JobRegistry()
+    job, _ = registry.submit(scheduler, "relevance", {"full": True}, crons.job_relevance)
+    job = wait_finished(registry, job.id)
+    assert job.state == "done" and job.result["full"] and job.result["changed"] == 2
+
+    job, _ = registry.submit(scheduler, "rebuild_duplicates", {}, crons.job_rebuild_duplicates)
+    job = wait_finished(registry, job.id)
+    assert job.state == "done" and job.result == {"papers": 2, "duplicates": 0}
+
+    job, _ = registry.submit(scheduler, "prefilter", {"retrain": True}, crons.job_prefilter)
+    job = wait_finished(registry, job.id)
+    assert job.state == "failed" and "Not enough LLM ratings" in job.error
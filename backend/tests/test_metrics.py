@@ -0,0 +1,56 @@
+import pytest
+from sqlmodel import create_engine, text
+from ..metrics import (
+    MetricsRegistry, DB_QUERY_SECONDS, current_route, listen_query_metrics, route_label,
+)
+
+
+def test_metrics_render():
+    registry = MetricsRegistry()
+    items = registry.counter("items_total", "Items", ["journal", "result"])
+    latency = registry.histogram("latency_seconds", "Latency", ["route"], buckets=[0.1, 1])
+
+    items.inc(3, journal='The "Journal"', result="inserted")
+    items.inc(journal='The "Journal"', result="inserted")
+    latency.observe(0.05, route="/api/rss")
+    latency.observe(0.5, route="/api/rss")
+    latency.observe(5, route="/api/rss")
+
+    assert items.get(journal='The "Journal"', result="inserted") == 4
+    assert latency.count(route="/api/rss") == 3
+    lines = registry.render().splitlines()
+    assert "# TYPE items_total counter" in lines
+    assert 'items_total{journal="The \\"Journal\\"",result="inserted"} 4' in lines
+    # buckets are cumulative
+    assert 'latency_seconds_bucket{route="/api/rss",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/api/rss",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{route="/api/rss",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{route="/api/rss"} 5.55' in lines
+    assert 'latency_seconds_count{route="/api/rss"} 3' in lines
+
+    with pytest.raises(ValueError):
+        items.inc(journal="J")
+    with pytest.raises(ValueError):
+        registry.counter("items_total", "Items again")
+
+
+def test_query_metrics_by_route():
+    """statements are timed under the route of the request running them"""
+    engine = create_engine("sqlite://")
+    listen_query_metrics(engine)
+
+    class Route:
+        path = "/api/test/{item_id}"
+
+    before = DB_QUERY_SECONDS.count(route=Route.path)
+    token = current_route.set({"route": Route()})
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            conn.execute(text("SELECT 2"))
+    finally:
+        current_route.reset(token)
+
+    assert DB_QUERY_SECONDS.count(route=Route.path) == before + 2
+    assert route_label(None) == "background"
+    assert route_label({}) == "unmatched"
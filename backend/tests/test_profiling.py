@@ -0,0 +1,79 @@
+import pstats
+import threading
+import time
+from ..config import Profiling_Config
+from ..profiling import Profiler
+
+
+def busy_work(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+def test_cprofile_runs(tmp_path):
+    """each run is profiled, the session stops itself after `max_runs`"""
+    profiler = Profiler(Profiling_Config(directory=str(tmp_path)))
+    assert not profiler.wants("crons")
+
+    session = profiler.start(mode="cprofile", seconds=60, max_runs=2, target="crons")
+    assert profiler.wants("crons") and not profiler.wants("requests")
+    for _ in range(2):
+        profile = profiler.begin_run()
+        busy_work(0.01)
+        profiler.end_run(profile)
+
+    session = profiler.get(session.id)
+    assert session.state == "done" and session.runs == 2
+    assert profiler.session is None
+    stats = pstats.Stats(str(profiler.path(session)))
+    assert any(func[2] == "busy_work" for func in stats.stats)
+
+
+def test_cprofile_concurrent_runs(tmp_path):
+    """runs on two threads at once: one is profiled, the other skipped, neither fails"""
+    profiler = Profiler(Profiling_Config(directory=str(tmp_path)))
+    session = profiler.start(mode="cprofile", seconds=60, target="crons")
+    started, errors = threading.Barrier(2), []
+
+    def run():
+        try:
+            profile = profiler.begin_run()
+            started.wait()
+            busy_work(0.05)
+            profiler.end_run(profile)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    running = profiler.get(session.id)
+    assert running.runs == 1 and running.skipped_runs == 1
+    # the lock is released, the next run is profiled again
+    profile = profiler.begin_run()
+    assert profile is not None
+    profiler.end_run(profile)
+
+    session = profiler.stop(session.id)
+    assert session.runs == 2
+    stats = pstats.Stats(str(profiler.path(session)))
+    assert any(func[2] == "busy_work" for func in stats.stats)
+
+
+def test_sampling_window(tmp_path):
+    """the sampler sees all threads, and stops at the end of the window"""
+    profiler = Profiler(Profiling_Config(directory=str(tmp_path), sampling_interval=0.001))
+    worker = threading.Thread(target=busy_work, args=(0.3,), name="busy worker")
+    worker.start()
+    session = profiler.start(mode="sampling", seconds=0.1)
+    worker.join()
+
+    session = profiler.get(session.id)
+    assert session.state == "done" and session.samples > 0
+    stacks = profiler.path(session).read_text().splitlines()
+    assert any(line.startswith("busy worker;") and "busy_work (" in line for line in stacks)
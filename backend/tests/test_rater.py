@@ -1,12 +1,30 @@
 import pytest
 from sqlmodel import Session, select, create_engine
 import random
-from ..config import get_config, AppSettings
-from ..models import RSSItem, RSS_Journal
-from ..rater.req_openai_compat import get_openai_response, rate_all_db, LLMResponse
+import asyncio
+import json
+import re
+import time
+import httpx
+from datetime import datetime, timedelta
+from pathlib import Path
+from yaml import safe_load
+from ..config import get_config, AppSettings, LLM_Config, Profile_Config
+from ..models import RSSItem, RSS_Journal, RatingQueue, ProfileScore
+from ..rss import store_items
+from ..rater.req_openai_compat import get_openai_response, rate_all_db, rate_papers_async, LLMResponse
+from ..rater.ratelimit import TokenBucket
+from ..rater.cache import evict_llm_cache
+from ..rater.queue import drain_rating_queue
+from ..rater.prefilter import train_prefilter, trained_prefilter, load_prefilter, prompt_keywords
+from ..rater.profiles import rate_profiles_async
+from ..query import query_rss_page
+from ..metrics import LLM_REQUEST_SECONDS, LLM_TOKENS, RATINGS
 from ..logger import custom_logger
 
-logger = custom_logger("uvicorn.error", __name__)
+logger = custom_logger("uvicorn.error")
+
+DEFAULT_CONFIG = Path(__file__).parents[1] / "config" / "default.yml"
 
 @pytest.fixture
 def db_session():
@@ -39,4 +57,323 @@ def test_get_llm_response(example_paper):
 def test_db_llm_rater(db_session):
     config = get_config()
 
-    rate_all_db(db_session, config, rerate=False)
\ No newline at end of file
+    rate_all_db(db_session, config, rerate=False)
+
+# offline tests of the concurrent rating engine
+# ==========================
+def mock_llm_config(**kwargs) -> AppSettings:
+    llm_config = LLM_Config(
+        base_url="http://llm.test/v1", api_key="", model_name="mock", prompt="{title}", **kwargs
+    )
+    return AppSettings(LLM_API=llm_config)
+
+
+def mock_papers(n: int) -> list[RSSItem]:
+    return [
+        RSSItem(title=f"paper {i}", link=f"https://example.org/{i}", summary="", source="mock",
+                published=datetime(2025, 1, 1))
+        for i in range(n)
+    ]
+
+
+def mock_completion(content: str) -> dict:
+    return {
+        "id": "mock", "model": "mock", "object": "chat.completion",
+        "choices": [{"message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+    }
+
+
+def mock_llm_transport(delay: float = 0, fail_first: int = 0):
+    """LLM server answering score 3, the first `fail_first` requests get 429"""
+    state = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+
+    async def handler(request: httpx.Request):
+        state["requests"] += 1
+        if state["requests"] <= fail_first:
+            return httpx.Response(429, headers={"retry-after": "0"})
+
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        await asyncio.sleep(delay)
+        state["in_flight"] -= 1
+        return httpx.Response(200, json=mock_completion('{"comment": "ok", "score": 3}'))
+
+    return httpx.MockTransport(handler), state
+
+
+def test_rate_papers_concurrent():
+    config = mock_llm_config(max_concurrency=4)
+    papers = mock_papers(8)
+    transport, state = mock_llm_transport(delay=0.1)
+
+    start = time.perf_counter()
+    asyncio.run(rate_papers_async(papers, config, transport=transport))
+    elapsed = time.perf_counter() - start
+
+    assert all(paper.llm_score == 3 for paper in papers)
+    assert state["max_in_flight"] == 4
+    assert elapsed < 0.1 * len(papers) / 2
+
+
+def test_rate_papers_retry_429():
+    config = mock_llm_config(max_concurrency=1, max_retries=3)
+    papers = mock_papers(1)
+    transport, state = mock_llm_transport(fail_first=2)
+    throttled = LLM_REQUEST_SECONDS.count(model="mock", status=429)
+    tokens = LLM_TOKENS.get(model="mock", kind="completion")
+    rated = RATINGS.get(result="rated")
+
+    asyncio.run(rate_papers_async(papers, config, transport=transport))
+    assert papers[0].llm_score == 3
+    assert state["requests"] == 3
+    # every attempt is timed, tokens are counted from the usage of the answer
+    assert LLM_REQUEST_SECONDS.count(model="mock", status=429) == throttled + 2
+    assert LLM_TOKENS.get(model="mock", kind="completion") == tokens + 10
+    assert RATINGS.get(result="rated") == rated + 1
+
+
+def test_rate_papers_gives_up():
+    config = mock_llm_config(max_concurrency=1, max_retries=1)
+    papers = mock_papers(1)
+    transport, state = mock_llm_transport(fail_first=10)
+
+    reported = []
+    asyncio.run(rate_papers_async(
+        papers, config, transport=transport, on_rated=lambda paper, resp: reported.append(resp)
+    ))
+    assert papers[0].llm_score is None
+    assert state["requests"] == 2
+    # failures are reported to background jobs as well
+    assert reported == [None]
+
+
+@pytest.mark.parametrize("bad_response", [
+    httpx.Response(200, text="<html>gateway error</html>"),
+    httpx.Response(200, json={**mock_completion(""), "choices": []}),
+])
+def test_rate_papers_bad_response(bad_response):
+    """a 200 without JSON or without choices fails its paper only"""
+    config = mock_llm_config(max_concurrency=1, max_retries=0)
+    papers = mock_papers(3)
+
+    async def handler(request: httpx.Request):
+        if b"paper 1" in request.content:
+            return bad_response
+        return httpx.Response(200, json=mock_completion('{"comment": "ok", "score": 3}'))
+
+    reported = {}
+    asyncio.run(rate_papers_async(
+        papers, config, transport=httpx.MockTransport(handler),
+        on_rated=lambda paper, resp: reported.__setitem__(paper.title, resp),
+    ))
+    assert [paper.llm_score for paper in papers] == [3, None, 3]
+    assert reported["paper 1"] is None
+
+
+def test_token_bucket():
+    async def acquire_all():
+        bucket = TokenBucket(6000)  # 100 tokens per second
+        await bucket.acquire(6000)
+        start = time.perf_counter()
+        await bucket.acquire(10)
+        return time.perf_counter() - start
+
+    assert 0.05 < asyncio.run(acquire_all()) < 0.5
+
+
+def test_llm_cache(memory_session):
+    config = mock_llm_config()
+    papers = mock_papers(3)
+    # same title as paper 0, the prompt is identical
+    papers.append(RSSItem(title="paper 0", link="https://example.org/copy", summary="", source="mock",
+                          published=datetime(2025, 1, 1)))
+    memory_session.add_all(papers)
+    memory_session.commit()
+
+    transport, state = mock_llm_transport()
+    asyncio.run(rate_papers_async(papers, config, session=memory_session, transport=transport))
+    assert state["requests"] == 3
+    assert all(paper.llm_score == 3 for paper in papers)
+
+    # rerate is answered by the cache
+    transport, state = mock_llm_transport()
+    asyncio.run(rate_papers_async(papers, config, rerate=True, session=memory_session, transport=transport))
+    assert state["requests"] == 0
+
+    # another model misses the cache
+    transport, state = mock_llm_transport()
+    other_config = mock_llm_config()
+    other_config.LLM_API.model_name = "other"
+    asyncio.run(rate_papers_async(papers, other_config, rerate=True, session=memory_session, transport=transport))
+    assert state["requests"] == 3
+
+    assert evict_llm_cache(memory_session, model_name="other") == 3
+    assert evict_llm_cache(memory_session, older_than=datetime.now()) == 3
+
+
+def mock_batch_transport(drop_last: bool = True):
+    """LLM server answering batches, the last paper of each batch gets no result"""
+    state = {"batch_requests": 0, "single_requests": 0}
+
+    async def handler(request: httpx.Request):
+        prompt = json.loads(request.content)["messages"][0]["content"]
+        indices = re.findall(r"### (\d+)", prompt)
+        if not indices:
+            state["single_requests"] += 1
+            return httpx.Response(200, json=mock_completion('{"comment": "single", "score": 1}'))
+
+        state["batch_requests"] += 1
+        if drop_last:
+            indices = indices[:-1]
+        results = [{"index": int(i), "comment": "batch", "score": 4} for i in indices]
+        return httpx.Response(200, json=mock_completion(json.dumps({"results": results})))
+
+    return httpx.MockTransport(handler), state
+
+
+def test_rate_papers_batch():
+    config = mock_llm_config(batch_size=4, batch_prompt="{papers}", batch_paper_template="### {index} {title}\n")
+    papers = mock_papers(8)
+    transport, state = mock_batch_transport()
+
+    asyncio.run(rate_papers_async(papers, config, transport=transport))
+    assert state == {"batch_requests": 2, "single_requests": 2}
+    assert [paper.llm_comments for paper in papers] == ["batch"] * 3 + ["single"] + ["batch"] * 3 + ["single"]
+
+    # without fallback, the dropped papers stay unrated
+    config.LLM_API.batch_fallback = False
+    papers = mock_papers(8)
+    transport, state = mock_batch_transport()
+    asyncio.run(rate_papers_async(papers, config, transport=transport))
+    assert state["single_requests"] == 0
+    assert [paper.llm_score for paper in papers].count(None) == 2
+
+
+def test_rating_queue(memory_session, monkeypatch):
+    config = mock_llm_config()
+    config.RATING_QUEUE.max_attempts = 2
+    papers = mock_papers(5)
+    store_items(papers, memory_session)
+    assert len(memory_session.exec(select(RatingQueue)).all()) == 5
+
+    # paper 0 always fails
+    def fake_rate_papers(papers, config, rerate=False, session=None, **kwargs):
+        for paper in papers:
+            if paper.title != "paper 0":
+                paper.llm_score = 3
+        session.add_all(papers)
+        session.commit()
+        return papers
+
+    monkeypatch.setattr("backend.rater.queue.rate_papers", fake_rate_papers)
+
+    assert drain_rating_queue(memory_session, config) == {"rated": 4, "failed": 1}
+    assert drain_rating_queue(memory_session, config) == {"rated": 0, "failed": 1}
+    # given up after max_attempts, left for the sweeper
+    assert drain_rating_queue(memory_session, config) == {"rated": 0, "failed": 0}
+
+
+def test_prefilter(memory_session, monkeypatch):
+    """papers like the ones the LLM found irrelevant are auto-scored, without a request"""
+    monkeypatch.setattr("backend.rater.prefilter._prefilter", None)
+    rng = random.Random(0)
+    relevant = "whistler chorus wave electron radiation belt magnetosphere reconnection".split()
+    irrelevant = "galaxy cosmology redshift exoplanet stellar cluster supernova halo".split()
+    common = "we present observation simulation model results data analysis".split()
+    for i in range(400):
+        is_relevant = i % 3 == 0
+        words = rng.choices(relevant if is_relevant else irrelevant, k=8) + rng.choices(common, k=20)
+        memory_session.add(RSSItem(
+            title=" ".join(words[:8]), link=f"https://example.org/{i}", summary=" ".join(words[8:]),
+            source="mock", published=datetime(2025, 1, 1), llm_score=4 if is_relevant else 0.5,
+        ))
+    memory_session.commit()
+
+    config = mock_llm_config()
+    config.PREFILTER.enabled = True
+    config.PREFILTER.min_samples = 100
+    # the default prompt, with sections of related and unrelated keywords
+    config.LLM_API.prompt = safe_load(DEFAULT_CONFIG.read_text(encoding="utf-8"))["LLM_API"]["prompt"]
+    related, unrelated = prompt_keywords(config.LLM_API.prompt)
+    assert "solar wind" in related and "astrophysics" in unrelated
+    assert not set(related) & set(unrelated)
+
+    prefilter = train_prefilter(memory_session, config)
+    assert prefilter.report["precision"] >= 0.95 and prefilter.report["recall"] > 0.5
+    assert load_prefilter(memory_session, config) is not None
+
+    # words of the unrelated keywords only, not found in the rated papers
+    astrophysics = "Astrophysics of black holes and neutron stars".split()
+    papers = [
+        RSSItem(title=" ".join(topic), link=f"https://example.org/new/{i}", summary=" ".join(common * 2),
+                source="mock", published=datetime(2025, 1, 2))
+        for i, topic in enumerate([irrelevant, relevant, astrophysics])
+    ]
+    assert prefilter.paper_proba(papers[2:])[0] >= config.PREFILTER.threshold
+    transport, state = mock_llm_transport()
+    asyncio.run(rate_papers_async(papers, config, transport=transport, prefilter=prefilter))
+    assert papers[0].auto_scored and papers[0].llm_score == config.PREFILTER.auto_score
+    assert not papers[1].auto_scored and papers[1].llm_score == 3
+    assert papers[2].auto_scored and papers[2].llm_score < config.PREFILTER.irrelevant_below
+    assert state["requests"] == 1
+
+    # a new prompt means new labels, the model is trained again
+    assert trained_prefilter(memory_session, config) is trained_prefilter(memory_session, config)
+    previous = trained_prefilter(memory_session, config)
+    config.LLM_API.prompt += ", pulsations"
+    assert trained_prefilter(memory_session, config) is not previous
+
+    # without held-out papers, or none of them skipped, the precision is unknown and the model not trusted
+    config.PREFILTER.holdout = 0
+    prefilter = train_prefilter(memory_session, config)
+    assert prefilter.report["n_holdout"] == 0 and prefilter.report["precision"] is None
+    assert not prefilter.active
+    config.PREFILTER.holdout = 0.2
+    config.PREFILTER.threshold = 1.0
+    prefilter = train_prefilter(memory_session, config)
+    assert prefilter.report["n_skipped"] == 0 and not prefilter.active
+
+
+def test_rate_profiles(memory_session):
+    """each profile rates the papers with its own prompt, newest first, on one shared client"""
+    now = datetime.now().replace(microsecond=0)
+    for i in range(5):
+        memory_session.add(RSSItem(title=f"paper {i}", link=f"https://example.org/{i}", summary="",
+                                   source="mock", published=now - timedelta(hours=i)))
+    # older than the backfill window
+    memory_session.add(RSSItem(title="old paper", link="https://example.org/old", summary="",
+                               source="mock", published=now - timedelta(days=60)))
+    memory_session.commit()
+
+    config = mock_llm_config(max_concurrency=1)
+    config.RATING_QUEUE.batch_size = 2
+    config.PROFILES = {
+        "waves": Profile_Config(prompt="waves: {title}"),
+        "storms": Profile_Config(prompt="storms: {title}", model_name="other"),
+    }
+    requested = {"waves": [], "storms": []}
+
+    async def handler(request: httpx.Request):
+        payload = json.loads(request.content)
+        profile, title = payload["messages"][0]["content"].split(": ")
+        requested[profile].append(title)
+        score = 4 if profile == "waves" else 1
+        return httpx.Response(200, json=mock_completion(json.dumps({"comment": profile, "score": score})))
+
+    results = asyncio.run(rate_profiles_async(memory_session, config, transport=httpx.MockTransport(handler)))
+    assert results["waves"] == {"added": 5, "rated": 5, "failed": 0}
+    assert requested["waves"] == [f"paper {i}" for i in range(5)]
+
+    scores = memory_session.exec(select(ProfileScore.profile, ProfileScore.llm_score)).all()
+    assert sorted(scores) == [("storms", 1.0)] * 5 + [("waves", 4.0)] * 5
+    # the default scores are not touched
+    assert all(paper.llm_score is None for paper in memory_session.exec(select(RSSItem)).all())
+
+    items, _ = query_rss_page(memory_session, ["mock"], now - timedelta(days=7), now, profile="waves",
+                              max_number=3)
+    assert [item.llm_score for item in items] == [4.0] * 3 and items[0].llm_comments == "waves"
+
+    # nothing left to rate
+    results = asyncio.run(rate_profiles_async(memory_session, config, transport=httpx.MockTransport(handler)))
+    assert results["storms"] == {"added": 0, "rated": 0, "failed": 0}
@@ -0,0 +1,29 @@
+from ..response_cache import ResponseCache, CachedResponse, bump_version, get_version
+
+
+def test_response_cache_lru():
+    cache = ResponseCache(max_size=2)
+    cache.put("a", CachedResponse(b"[1]"))
+    cache.put("b", CachedResponse(b"[2]"))
+
+    # "a" becomes the most recently used, so "b" is evicted
+    assert cache.get("a").body == b"[1]"
+    cache.put("c", CachedResponse(b"[3]"))
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_response_cache_versions():
+    cache = ResponseCache()
+    key = ("/api/rss", (), (get_version("data"),))
+    cache.put(key, CachedResponse(b"[]"))
+    assert cache.get(("/api/rss", (), (get_version("data"),))) is not None
+
+    bump_version("data")
+    assert cache.get(("/api/rss", (), (get_version("data"),))) is None
+
+
+def test_cached_response_etag():
+    assert CachedResponse(b"[1]").etag == CachedResponse(b"[1]").etag
+    assert CachedResponse(b"[1]").etag != CachedResponse(b"[2]").etag
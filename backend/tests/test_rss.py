@@ -0,0 +1,297 @@
+import pytest
+import asyncio
+import pickle
+import sqlite3
+import feedparser
+from datetime import datetime
+import time
+import httpx
+from sqlmodel import select, func
+from ..models import RSS_Journal, RSSItem, RatingQueue, RelevanceScore
+from ..config import RSSFetch_Config, get_config
+from ..rss import (
+    fetch_feeds, parse_feed, parse_feed_rows, store_items, load_feed_caches, save_feed_cache, retrieve_all,
+)
+from ..database import SQLITE_CHUNK_SIZE
+from ..benchmarks.fixtures import example_journal_feed
+from ..rater.req_openai_compat import commit_papers
+from ..query import query_rss_page
+
+EXAMPLE_FEED = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+<channel>
+<title>Example Journal</title>
+<item>
+<title>Chorus waves in the outer radiation belt</title>
+<link>https://example.org/paper/1</link>
+<description>Whistler-mode chorus scatters energetic electrons.</description>
+<pubDate>Mon, 06 Jan 2025 08:00:00 GMT</pubDate>
+</item>
+<item>
+<title>Magnetic reconnection in the magnetotail</title>
+<link>https://example.org/paper/2</link>
+<description>Observations of reconnection onset.</description>
+<pubDate>Tue, 07 Jan 2025 08:00:00 GMT</pubDate>
+</item>
+</channel>
+</rss>
+"""
+
+
+def example_journal(feed: str) -> RSS_Journal:
+    return RSS_Journal.model_validate({
+        "feed": feed,
+        "source": "Example Journal",
+        "authors": None,
+        "affiliation": None,
+        "published": {"datestr": "published", "format": "%a, %d %b %Y %H:%M:%S %Z"},
+    })
+
+
+def mock_transport(delay: float = 0):
+    async def handler(request: httpx.Request):
+        await asyncio.sleep(delay)
+        if request.url.path.endswith("missing.xml"):
+            return httpx.Response(404)
+        return httpx.Response(
+            200, content=EXAMPLE_FEED, headers={"content-type": "application/rss+xml"}
+        )
+
+    return httpx.MockTransport(handler)
+
+
+def test_fetch_feeds_concurrent():
+    """feeds on different hosts are downloaded at the same time"""
+    journals = {f"j{i}": example_journal(f"https://host{i}.example.org/feed.xml") for i in range(5)}
+
+    start = time.perf_counter()
+    results = asyncio.run(fetch_feeds(journals, RSSFetch_Config(), transport=mock_transport(0.2)))
+    elapsed = time.perf_counter() - start
+
+    assert set(results) == set(journals)
+    assert all(r.error is None for r in results.values())
+    assert elapsed < 0.2 * len(journals) / 2
+
+
+def test_fetch_feeds_per_host_limit():
+    """feeds on the same host respect max_per_host"""
+    journals = {f"j{i}": example_journal(f"https://example.org/feed{i}.xml") for i in range(4)}
+    fetch_config = RSSFetch_Config(max_per_host=1)
+
+    start = time.perf_counter()
+    asyncio.run(fetch_feeds(journals, fetch_config, transport=mock_transport(0.1)))
+    elapsed = time.perf_counter() - start
+
+    assert elapsed >= 0.1 * len(journals)
+
+
+def test_fetch_feeds_errors_isolated():
+    """a failing or slow feed does not affect the others"""
+    journals = {
+        "ok": example_journal("https://a.example.org/feed.xml"),
+        "missing": example_journal("https://b.example.org/missing.xml"),
+    }
+    results = asyncio.run(fetch_feeds(journals, RSSFetch_Config(), transport=mock_transport()))
+    assert results["ok"].error is None
+    assert results["missing"].error is not None
+
+    # a 304 without a cache record, e.g. deleted, is a failed fetch of that feed only
+    async def not_modified(request: httpx.Request):
+        if request.url.host == "b.example.org":
+            return httpx.Response(304)
+        return httpx.Response(200, content=EXAMPLE_FEED)
+
+    results = asyncio.run(fetch_feeds(journals, RSSFetch_Config(), transport=httpx.MockTransport(not_modified)))
+    assert results["ok"].error is None
+    assert results["missing"].error is not None and not results["missing"].not_modified
+
+    fetch_config = RSSFetch_Config(timeout=0.05)
+    results = asyncio.run(fetch_feeds(journals, fetch_config, transport=mock_transport(0.5)))
+    assert all(r.error is not None for r in results.values())
+
+
+def test_parse_fetched_feed():
+    journal = example_journal("https://example.org/feed.xml")
+    results = asyncio.run(fetch_feeds({"j": journal}, RSSFetch_Config(), transport=mock_transport()))
+
+    items = parse_feed(journal, results["j"])
+    assert [item.link for item in items] == ["https://example.org/paper/1", "https://example.org/paper/2"]
+    assert all(item.source == "Example Journal" for item in items)
+
+
+def conditional_transport(etag: str, ignore_validators: bool = False):
+    """serves 304 when the etag matches, unless validators are ignored"""
+    async def handler(request: httpx.Request):
+        if not ignore_validators and request.headers.get("if-none-match") == etag:
+            return httpx.Response(304)
+        return httpx.Response(200, content=EXAMPLE_FEED, headers={"etag": etag})
+
+    return httpx.MockTransport(handler)
+
+
+def test_conditional_get(memory_session):
+    journal = example_journal("https://example.org/feed.xml")
+    journals = {"j": journal}
+
+    # first fetch has no cache
+    results = asyncio.run(fetch_feeds(journals, RSSFetch_Config(), transport=conditional_transport('"v1"')))
+    assert not results["j"].not_modified
+    save_feed_cache("j", journal, results["j"], memory_session)
+
+    # same etag, server answers 304
+    caches = load_feed_caches(journals, memory_session)
+    results = asyncio.run(fetch_feeds(
+        journals, RSSFetch_Config(), caches=caches, transport=conditional_transport('"v1"')
+    ))
+    assert results["j"].not_modified and results["j"].status_code == 304
+
+    # server ignores validators but the body is identical
+    results = asyncio.run(fetch_feeds(
+        journals, RSSFetch_Config(), caches=caches,
+        transport=conditional_transport('"v2"', ignore_validators=True),
+    ))
+    assert results["j"].not_modified and results["j"].content is None
+
+    # the new validators of the identical body are saved, with the same content hash
+    content_hash = caches["j"].content_hash
+    results = retrieve_all(
+        journals, session=memory_session, fetch_config=RSSFetch_Config(),
+        transport=conditional_transport('"v2"', ignore_validators=True),
+    )
+    assert results["j"] == {"skipped": True}
+    cache = load_feed_caches(journals, memory_session)["j"]
+    assert cache.etag == '"v2"' and cache.content_hash == content_hash
+
+
+def test_feed_cache_invalidated_by_schema(memory_session):
+    journal = example_journal("https://example.org/feed.xml")
+    results = asyncio.run(fetch_feeds({"j": journal}, RSSFetch_Config(), transport=conditional_transport('"v1"')))
+    save_feed_cache("j", journal, results["j"], memory_session)
+
+    changed = journal.model_copy(update={"source": "Renamed Journal"})
+    assert load_feed_caches({"j": changed}, memory_session) == {}
+
+
+def test_store_items_upsert(memory_session):
+    journal = example_journal("https://example.org/feed.xml")
+    results = asyncio.run(fetch_feeds({"j": journal}, RSSFetch_Config(), transport=mock_transport()))
+
+    result = store_items(parse_feed(journal, results["j"]), memory_session)
+    assert result["counts"] == {"inserted": 2, "updated": 0, "unchanged": 0}
+    assert len(memory_session.exec(select(RatingQueue)).all()) == 2
+
+    # same feed again, nothing is touched
+    result = store_items(parse_feed(journal, results["j"]), memory_session)
+    assert result["counts"] == {"inserted": 0, "updated": 0, "unchanged": 2}
+
+    # publisher corrected a title
+    items = parse_feed(journal, results["j"])
+    items[0].title = "Corrected title"
+    uuid_before = memory_session.exec(select(RSSItem.uuid).where(RSSItem.link == items[0].link)).one()
+
+    result = store_items(items, memory_session, update_duplicate=False)
+    assert result["counts"] == {"inserted": 0, "updated": 0, "unchanged": 2}
+
+    result = store_items(items, memory_session)
+    assert result["counts"] == {"inserted": 0, "updated": 1, "unchanged": 1}
+    stored = memory_session.exec(select(RSSItem).where(RSSItem.link == items[0].link)).one()
+    assert stored.title == "Corrected title" and stored.uuid == uuid_before
+
+
+def test_store_items_variable_limit(memory_session):
+    """lists of uuids are sent in chunks, a feed longer than the variable limit of SQLite is stored"""
+    # a chunk of rows in one upsert binds at most a variable per column
+    limit = SQLITE_CHUNK_SIZE * len(RSSItem.__table__.columns)
+    memory_session.connection().connection.driver_connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+    items = [
+        RSSItem(title=f"Paper number {i}", link=f"https://example.org/many/{i}", summary="", source="A",
+                published=datetime(2025, 1, 6))
+        for i in range(limit + 1)
+    ]
+    result = store_items(items, memory_session)
+    assert result["counts"]["inserted"] == len(items)
+    assert memory_session.exec(select(func.count()).select_from(RelevanceScore)).one() == len(items)
+
+
+def test_store_near_duplicates(memory_session):
+    """the same paper from another feed is linked to the first copy, rated with it and listed once"""
+    summary = (
+        "Whistler-mode chorus waves scatter energetic electrons in the outer radiation belt. "
+        "We present two years of Van Allen Probes observations and a quasi-linear diffusion model."
+    )
+    first = RSSItem(title="Chorus waves in the outer radiation belt", link="https://a.example.org/1",
+                    summary=summary, source="A", published=datetime(2025, 1, 6))
+    other = RSSItem(title="Plasmaspheric hiss below 100 Hz", link="https://a.example.org/2",
+                    summary="Hiss waves at low frequencies are observed inside the plasmasphere.",
+                    source="A", published=datetime(2025, 1, 6))
+    store_items([first, other], memory_session)
+
+    copy = RSSItem(title="Chorus Waves in the Outer Radiation Belt", link="https://b.example.org/paper?id=1",
+                   summary=f"<p>{summary}</p>", source="B", published=datetime(2025, 1, 7))
+    result = store_items([copy], memory_session)
+    first_uuid = memory_session.exec(select(RSSItem.uuid).where(RSSItem.link == first.link)).one()
+    copy_uuid = memory_session.exec(select(RSSItem.uuid).where(RSSItem.link == copy.link)).one()
+    assert result["duplicates"] == {copy_uuid: first_uuid}
+    assert copy_uuid not in memory_session.exec(select(RatingQueue.item_uuid)).all()
+
+    stored = memory_session.get(RSSItem, first_uuid)
+    stored.llm_score, stored.llm_comments = 4.0, "relevant"
+    commit_papers(memory_session, [stored])
+    assert memory_session.get(RSSItem, copy_uuid).llm_score == 4.0
+
+    now = datetime(2025, 2, 1)
+    items, _ = query_rss_page(memory_session, ["A", "B"], datetime(2025, 1, 1), now, collapse=True)
+    assert sorted(item.link for item in items) == [first.link, other.link]
+    # the copy is listed if its canonical paper is not
+    items, _ = query_rss_page(memory_session, ["B"], datetime(2025, 1, 1), now, collapse=True)
+    assert [item.link for item in items] == [copy.link]
+
+
+def test_retrieve_all_process_pool(memory_session):
+    """feeds parsed in worker processes are stored like feeds parsed in the thread"""
+    journals = {f"j{i}": example_journal(f"https://host{i}.example.org/feed.xml") for i in range(3)}
+    journals["missing"] = example_journal("https://host0.example.org/missing.xml")
+
+    results = retrieve_all(
+        journals, session=memory_session, fetch_config=RSSFetch_Config(parse_processes=2),
+        transport=mock_transport(), use_cache=False,
+    )
+    assert results["j0"]["counts"]["inserted"] == 2
+    assert results["j1"]["counts"] == {"inserted": 0, "updated": 0, "unchanged": 2}
+    assert "error" in results["missing"]
+
+    serial = retrieve_all(
+        journals, fetch_config=RSSFetch_Config(parse_processes=0), transport=mock_transport(),
+    )
+    assert serial["j2"]["all"] == results["j2"]["all"]
+
+
+def test_journal_extractors():
+    """journals are compiled once into extractors, which survive pickling to parser processes"""
+    journal = example_journal("https://example.org/feed.xml")
+    assert [name for name, _ in journal._extractors] == ["title", "link", "summary", "published"]
+
+    entry = feedparser.parse(EXAMPLE_FEED).entries[0]
+    fields = pickle.loads(pickle.dumps(journal)).extract(entry)
+    assert fields == {
+        "title": "Chorus waves in the outer radiation belt",
+        "link": "https://example.org/paper/1",
+        "summary": "Whistler-mode chorus scatters energetic electrons.",
+        "published": datetime(2025, 1, 6, 8),
+        "source": "Example Journal",
+    }
+
+    # a copy with another schema reads the entries by it
+    copy = journal.model_copy(update={"title": "description", "summary": None})
+    assert [name for name, _ in copy._extractors] == ["title", "link", "published"]
+    assert copy.extract(entry)["title"] == "Whistler-mode chorus scatters energetic electrons."
+    assert journal.extract(entry)["title"] == "Chorus waves in the outer radiation belt"
+
+
+def test_benchmark_feeds_match_journals():
+    """the generated benchmark feeds parse into complete items for every configured journal"""
+    for key, journal in get_config().RSS_JOURNALS.items():
+        journal = journal.model_copy(update={"feed": f"http://127.0.0.1/{key}.xml"})
+        rows = parse_feed_rows(journal, example_journal_feed(journal, 3))
+        assert len(rows) == 3, key
+        assert all(row["title"] and row["link"] and row["published"] for row in rows), key